@@ -6,32 +6,1794 @@
 整合LLM API自動識別驗證碼
 """
 
+import io
 import json
 import time
 import os
+import re
+import queue
+import random
+import asyncio
+import fnmatch
+import functools
+import math
+import contextlib
 import base64
+import hashlib
+import uuid
+import sqlite3
+import mimetypes
+import shutil
+import subprocess
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+from urllib.parse import urlparse, parse_qs, urljoin
+from html.parser import HTMLParser
+from collections import Counter, deque
+from PIL import Image, ImageChops, features
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-from anthropic import Anthropic
-from openai import OpenAI
+from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
+from anthropic import Anthropic, AsyncAnthropic
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
 # 載入環境變數
 load_dotenv()
 
+class RunMetrics:
+    """執行指標 - 記錄各階段耗時（span）與計數器，結束時輸出JSONL與p50/p95統計表"""
+    
+    def __init__(self, config):
+        metrics_config = config.get('metrics', {})
+        self.enabled = metrics_config.get('enabled', True)
+        self.output_dir = metrics_config.get('output_dir', './metrics')
+        self.run_id = time.strftime('%Y%m%d_%H%M%S')
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def span(self, stage, **attrs):
+        """計時區塊；可在區塊內設定 span['ok'] 標記成敗（預設成功，發生例外為失敗）"""
+        record = {'stage': stage, 'start': time.time(), 'ok': True}
+        record.update(attrs)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - start
+            with self._lock:
+                self.spans.append(record)
+    
+    def record_span(self, stage, duration, ok=True, **attrs):
+        """記錄已量測好的耗時"""
+        record = {'stage': stage, 'start': time.time() - duration, 'duration': duration, 'ok': ok}
+        record.update(attrs)
+        with self._lock:
+            self.spans.append(record)
+    
+    def incr(self, name, amount=1):
+        """計數器加一"""
+        with self._lock:
+            self.counters[name] += amount
+    
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        if not sorted_values:
+            return 0.0
+        index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+        return sorted_values[index]
+    
+    def summary(self):
+        """依階段彙總：次數、失敗數、p50、p95、最大值、總耗時"""
+        with self._lock:
+            spans = list(self.spans)
+        durations = {}
+        failures = Counter()
+        for record in spans:
+            durations.setdefault(record['stage'], []).append(record['duration'])
+            if not record['ok']:
+                failures[record['stage']] += 1
+        stats = {}
+        for stage, values in durations.items():
+            values.sort()
+            stats[stage] = {
+                'count': len(values),
+                'failures': failures[stage],
+                'p50': self.percentile(values, 0.5),
+                'p95': self.percentile(values, 0.95),
+                'max': values[-1],
+                'total': sum(values)
+            }
+        return stats
+    
+    def export_jsonl(self, path=None):
+        """將所有span與計數器輸出為JSONL，回傳檔案路徑"""
+        if not self.enabled:
+            return None
+        path = path or os.path.join(self.output_dir, f"run_{self.run_id}.jsonl")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in spans:
+                f.write(json.dumps(dict(record, type='span', run_id=self.run_id), ensure_ascii=False, default=str) + '\n')
+            for name, value in counters.items():
+                f.write(json.dumps({'type': 'counter', 'run_id': self.run_id, 'name': name, 'value': value}, ensure_ascii=False) + '\n')
+        print(f"[INFO] 執行指標已輸出: {path}")
+        return path
+    
+    def print_summary(self):
+        """輸出各階段耗時統計表與計數器"""
+        if not self.enabled:
+            return
+        stats = self.summary()
+        if stats:
+            print("\n=== 階段耗時統計（秒）===")
+            print(f"  {'階段':<28}{'次數':>6}{'失敗':>6}{'p50':>9}{'p95':>9}{'最大':>9}{'總計':>10}")
+            for stage, entry in sorted(stats.items(), key=lambda item: -item[1]['total']):
+                print(f"  {stage:<28}{entry['count']:>6}{entry['failures']:>6}{entry['p50']:>9.3f}"
+                      f"{entry['p95']:>9.3f}{entry['max']:>9.3f}{entry['total']:>10.2f}")
+        if self.counters:
+            print("\n=== 計數器 ===")
+            for name, value in sorted(self.counters.items()):
+                print(f"  {name}: {value}")
+    
+    def finish(self):
+        """執行結束：輸出統計表與JSONL"""
+        self.print_summary()
+        self.export_jsonl()
+
+def timed(stage):
+    """方法計時裝飾器：以 self.metrics 記錄耗時，回傳值為假時標記為失敗"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(stage) as span:
+                result = method(self, *args, **kwargs)
+                span['ok'] = bool(result)
+                return result
+        return wrapper
+    return decorator
+
+class WaitEngine:
+    """條件式等待引擎 - 以頁面實際就緒訊號取代固定秒數等待"""
+
+    # 檢查頁面狀態：readyState、已載入資源數量、jQuery進行中的請求
+    NETWORK_STATE_SCRIPT = """
+        var jq = (window.jQuery && window.jQuery.active) || 0;
+        return [document.readyState, performance.getEntriesByType('resource').length, jq];
+    """
+
+    IMAGES_COMPLETE_SCRIPT = """
+        var imgs = arguments[0] ? [arguments[0]] : Array.prototype.slice.call(document.images);
+        return imgs.every(function (img) { return img.complete; });
+    """
+
+    def __init__(self, driver, config, metrics=None):
+        self.driver = driver
+        self.metrics = metrics
+        waits_config = config.get('waits', {})
+        self.default_timeout = config.get('settings', {}).get('timeout', 30)
+        self.poll_interval = waits_config.get('poll_interval', 0.1)
+        self.network_idle_ms = waits_config.get('network_idle_ms', 500)
+        self.navigation_start_timeout = waits_config.get('navigation_start_timeout', 5)
+        self.stage_timeouts = waits_config.get('stage_timeouts', {})
+        self.records = []
+
+    def timeout_for(self, stage):
+        """取得指定階段的等待上限（秒）"""
+        return self.stage_timeouts.get(stage, self.default_timeout)
+
+    def until(self, stage, condition, description, timeout=None):
+        """等待條件成立並記錄實際耗時，逾時回傳None"""
+        if timeout is None:
+            timeout = self.timeout_for(stage)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = WebDriverWait(self.driver, timeout, poll_frequency=self.poll_interval).until(condition)
+        except TimeoutException:
+            print(f"[WARN] 等待逾時 ({stage}: {description}, {timeout}秒)")
+        elapsed = time.perf_counter() - start
+        self.records.append({
+            'stage': stage,
+            'condition': description,
+            'elapsed': elapsed,
+            'ok': result is not None
+        })
+        if self.metrics:
+            self.metrics.record_span(f"wait:{stage}", elapsed, result is not None, condition=description)
+        return result
+
+    def document_ready(self, stage):
+        """等待 document.readyState 為 complete"""
+        return self.until(
+            stage,
+            lambda d: d.execute_script("return document.readyState") == "complete",
+            "document_ready"
+        )
+
+    def element_present(self, stage, locators):
+        """等待任一選擇器對應的元素出現，回傳找到的元素"""
+        def condition(driver):
+            for locator in locators:
+                elements = driver.find_elements(*locator)
+                if elements:
+                    return elements[0]
+            return False
+        return self.until(stage, condition, "element_present")
+
+    def element_visible(self, stage, locators):
+        """等待任一選擇器對應的元素可見"""
+        def condition(driver):
+            for locator in locators:
+                for element in driver.find_elements(*locator):
+                    try:
+                        if element.is_displayed():
+                            return element
+                    except StaleElementReferenceException:
+                        continue
+            return False
+        return self.until(stage, condition, "element_visible")
+
+    def element_clickable(self, stage, target):
+        """等待元素可點擊，target可為選擇器或WebElement"""
+        return self.until(stage, EC.element_to_be_clickable(target), "element_clickable")
+
+    def network_idle(self, stage, idle_ms=None):
+        """等待頁面載入完成且一段時間內沒有新的網路請求"""
+        idle_seconds = (idle_ms if idle_ms is not None else self.network_idle_ms) / 1000.0
+        state = {'count': None, 'since': time.perf_counter()}
+
+        def condition(driver):
+            ready_state, resource_count, active_requests = driver.execute_script(self.NETWORK_STATE_SCRIPT)
+            now = time.perf_counter()
+            if ready_state != "complete" or active_requests or resource_count != state['count']:
+                state['count'] = resource_count
+                state['since'] = now
+                return False
+            return now - state['since'] >= idle_seconds
+        return self.until(stage, condition, "network_idle")
+
+    def images_complete(self, stage, element=None):
+        """等待頁面上（或指定）的圖片載入完成"""
+        return self.until(
+            stage,
+            lambda d: d.execute_script(self.IMAGES_COMPLETE_SCRIPT, element),
+            "images_complete"
+        )
+
+    def page_settled(self, stage):
+        """等待DOM就緒及網路閒置"""
+        return self.document_ready(stage) and self.network_idle(stage)
+
+    def navigation(self, stage, old_url, anchor=None):
+        """點擊後等待頁面跳轉（URL改變或原元素失效），再等待新頁面穩定"""
+        def navigation_started(driver):
+            if driver.current_url != old_url:
+                return True
+            if anchor is not None:
+                try:
+                    anchor.is_enabled()
+                except StaleElementReferenceException:
+                    return True
+            return False
+        self.until(stage, navigation_started, "navigation_start", timeout=self.navigation_start_timeout)
+        return self.page_settled(stage)
+
+    def summary(self):
+        """依階段彙總等待次數與耗時"""
+        stats = {}
+        for record in self.records:
+            entry = stats.setdefault(record['stage'], {'count': 0, 'total': 0.0, 'max': 0.0, 'timeouts': 0})
+            entry['count'] += 1
+            entry['total'] += record['elapsed']
+            entry['max'] = max(entry['max'], record['elapsed'])
+            if not record['ok']:
+                entry['timeouts'] += 1
+        return stats
+
+    def print_summary(self):
+        """輸出等待耗時統計"""
+        stats = self.summary()
+        if not stats:
+            return
+        print("\n=== 等待耗時統計 ===")
+        for stage, entry in stats.items():
+            print(f"  {stage}: {entry['count']} 次, 共 {entry['total']:.2f} 秒, "
+                  f"最長 {entry['max']:.2f} 秒, 逾時 {entry['timeouts']} 次")
+
+class SelectorRegistry:
+    """選擇器快取 - 記錄每個查找目標最近成功的選擇器並優先嘗試，學習結果與命中統計保存於磁碟"""
+    
+    def __init__(self, config, metrics=None):
+        self.metrics = metrics
+        selectors_config = config.get('selectors', {})
+        self.enabled = selectors_config.get('learn', True)
+        self.cache_path = selectors_config.get('cache_path', './cache/selectors.json')
+        self.preferred = {}  # 目標 -> 最近成功的選擇器
+        self.stats = {}      # 目標 -> {選擇器: {'hits': n, 'misses': n}}
+        self._lock = threading.Lock()
+        self.load()
+    
+    @staticmethod
+    def label(locator):
+        by, value = locator
+        return f"{by}={value}"
+    
+    def load(self):
+        """讀取已學習的選擇器順序"""
+        if not self.enabled:
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.preferred = data.get('preferred', {})
+            self.stats = data.get('stats', {})
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[WARN] 選擇器快取無法讀取: {e}")
+    
+    def save(self):
+        """保存學習結果"""
+        if not self.enabled:
+            return
+        with self._lock:
+            data = {'preferred': self.preferred, 'stats': self.stats}
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            temp_path = f"{self.cache_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.cache_path)
+    
+    def ordered(self, target, candidates):
+        """將最近成功的選擇器排到最前面"""
+        preferred = self.preferred.get(target)
+        if not self.enabled or not preferred:
+            return list(candidates)
+        return sorted(candidates, key=lambda locator: self.label(locator) != preferred)
+    
+    def _record(self, target, locator, hit, promote=True):
+        label = self.label(locator)
+        with self._lock:
+            entry = self.stats.setdefault(target, {}).setdefault(label, {'hits': 0, 'misses': 0})
+            entry['hits' if hit else 'misses'] += 1
+            if hit and promote:
+                self.preferred[target] = label
+            elif not promote:
+                # 舊版快取可能已提升過此目標的選擇器，一併清除
+                self.preferred.pop(target, None)
+        if self.metrics and not hit:
+            self.metrics.incr("selector_misses")
+            self.metrics.incr(f"selector_misses.{target}")
+    
+    def find_elements(self, driver, target, candidates, predicate=None, multiple=False, **params):
+        """依學習順序嘗試選擇器，回傳第一個有結果（且符合predicate）的元素清單
+        
+        選擇器可包含 {name} 佔位符，以params代入（學習時以樣板為鍵，不同參數共用學習結果）
+        multiple=True 用於需要完整清單的目標（學生連結、題目卡片）：較後面的選擇器可能只涵蓋部分元素
+        （例如只取第一行），因此一律依宣告順序嘗試，只統計命中而不提升順序
+        """
+        ordered = list(candidates) if multiple else self.ordered(target, candidates)
+        for locator in ordered:
+            by, template = locator
+            value = template.format(**params) if params else template
+            try:
+                elements = driver.find_elements(by, value)
+                if predicate:
+                    elements = [element for element in elements if predicate(element)]
+            except Exception:
+                elements = []
+            self._record(target, locator, bool(elements), promote=not multiple)
+            if elements:
+                return elements
+        return []
+    
+    def find_element(self, driver, target, candidates, predicate=None, **params):
+        """同find_elements，回傳第一個元素或None"""
+        elements = self.find_elements(driver, target, candidates, predicate, **params)
+        return elements[0] if elements else None
+    
+    def print_report(self):
+        """輸出各選擇器的命中／未命中統計"""
+        if not self.stats:
+            return
+        print("\n=== 選擇器命中統計 ===")
+        for target, entries in self.stats.items():
+            print(f"  {target}（優先: {self.preferred.get(target, '-')}）")
+            for label, entry in entries.items():
+                print(f"    {label}: 命中 {entry['hits']} / 未命中 {entry['misses']}")
+
+def is_interactable(element):
+    """元素是否可見且可操作"""
+    return element.is_displayed() and element.is_enabled()
+
+class SessionStore:
+    """登入狀態儲存 - 將瀏覽器cookies保存到磁碟，下次執行時直接沿用"""
+
+    def __init__(self, config):
+        session_config = config.get('session', {})
+        self.enabled = session_config.get('enabled', True)
+        self.path = session_config.get('path', './session/session.json')
+        self.ttl = session_config.get('ttl_hours', 8) * 3600
+        self.probe_timeout = session_config.get('probe_timeout', 10)
+        parsed = urlparse(config['login']['url'])
+        self.base_url = f"{parsed.scheme}://{parsed.netloc}/"
+        self.probe_url = session_config.get('probe_url') or self.base_url
+
+    def save(self, cookies):
+        """儲存cookies，有效期限取TTL與cookie本身期限較早者"""
+        if not self.enabled or not cookies:
+            return False
+        now = time.time()
+        expires_at = now + self.ttl
+        for cookie in cookies:
+            if cookie.get('expiry'):
+                expires_at = min(expires_at, cookie['expiry'])
+        
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': now, 'expires_at': expires_at, 'cookies': cookies}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        print(f"[INFO] 已儲存登入狀態: {self.path}")
+        return True
+
+    def load(self):
+        """讀取尚未過期的cookies，不存在或已過期時回傳None"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[WARN] 登入狀態檔案無法讀取: {e}")
+            return None
+        
+        if data.get('expires_at', 0) <= time.time():
+            print("[INFO] 已儲存的登入狀態已過期")
+            self.clear()
+            return None
+        return data.get('cookies') or None
+
+    def clear(self):
+        """刪除已儲存的登入狀態"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def probe(self, cookies):
+        """以HTTP請求快速確認cookies是否仍為登入狀態（不經過瀏覽器）"""
+        try:
+            response = requests.get(
+                self.probe_url,
+                cookies={cookie['name']: cookie['value'] for cookie in cookies},
+                timeout=self.probe_timeout
+            )
+        except Exception as e:
+            print(f"[WARN] 登入狀態檢查失敗: {e}")
+            return False
+        
+        # 被導回登入頁或頁面仍包含驗證碼，表示session已失效
+        if response.status_code != 200 or "signOut" in response.url or "NewCode.php" in response.text:
+            return False
+        return True
+
+class ImagePayload:
+    """記憶體中的圖片 - 保存原始bytes，base64編碼只計算一次並由各識別方式共用"""
+    
+    def __init__(self, data, media_type="image/png", name=None, path=None):
+        self.data = data
+        self.media_type = media_type or "image/png"
+        self.name = name
+        self.path = path
+        self._base64 = None
+        self._write_future = None
+        self._variants = {}  # ImagePreprocessor產生的各設定版本
+        self.group = None  # 同一張截圖切出的圖塊共用group（計算每位學生的圖片上限時視為一張）
+    
+    @classmethod
+    def from_file(cls, path):
+        """從檔案讀取圖片"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        return cls(data, mimetypes.guess_type(path)[0], os.path.basename(path), path)
+    
+    @property
+    def view(self):
+        """不複製資料的唯讀檢視"""
+        return memoryview(self.data)
+    
+    @property
+    def base64(self):
+        """base64編碼（只計算一次）"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.view).decode('utf-8')
+        return self._base64
+    
+    def open_image(self):
+        """以Pillow開啟圖片"""
+        image = Image.open(io.BytesIO(self.data))
+        image.load()
+        return image
+    
+    def ensure_file(self, directory):
+        """確保圖片已寫入磁碟（需要檔案路徑的識別方式使用），回傳檔案路徑"""
+        if self._write_future is not None:
+            self._write_future.result()
+        if self.path and os.path.exists(self.path):
+            return self.path
+        os.makedirs(directory, exist_ok=True)
+        self.path = self.path or os.path.join(directory, self.name or f"image_{int(time.time() * 1000)}.png")
+        with open(self.path, 'wb') as f:
+            f.write(self.view)
+        return self.path
+    
+    def __str__(self):
+        return self.path or self.name or f"<{self.media_type} {len(self.data)} bytes>"
+
+class ImageSink:
+    """非同步圖片寫檔 - 在背景執行緒將圖片寫入磁碟，不阻塞擷取與識別流程"""
+    
+    def __init__(self, config):
+        self.enabled = config.get('images', {}).get('save_to_disk', True)
+        self.directory = config['captcha']['save_path']
+        self._executor = ThreadPoolExecutor(max_workers=1)
+    
+    def submit(self, payload):
+        """排程寫入圖片，立即設定payload.path（停用時不寫入）"""
+        if not self.enabled or not payload.name:
+            return payload
+        payload.path = os.path.join(self.directory, payload.name)
+        payload._write_future = self._executor.submit(self._write, payload.path, payload.data)
+        return payload
+    
+    def _write(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"[WARN] 寫入圖片失敗 {path}: {e}")
+    
+    def close(self):
+        """等待所有寫入完成"""
+        self._executor.shutdown(wait=True)
+
+def otsu_threshold(gray):
+    """計算灰階陣列（uint8）的Otsu二值化門檻值"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = gray.size - weight_bg
+    sum_bg = np.cumsum(levels * hist)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    return np.argmax(weight_bg * weight_fg * (mean_bg - mean_fg) ** 2)
+
+class ImagePreprocessor:
+    """圖片前處理 - 送出給識別服務前裁切空白、轉灰階或二值化、依服務縮小尺寸並選擇精簡的編碼
+    
+    設定分為圖片種類（captcha／exam：裁切、色彩模式、編碼格式）與識別服務（openai／anthropic／cli：尺寸上限），
+    相同設定的結果快取在ImagePayload上，多個識別方式共用同一版本。
+    """
+    
+    DEFAULT_KINDS = {
+        'captcha': {'crop': True, 'mode': 'grayscale', 'format': 'PNG', 'quality': 85},
+        'exam': {'crop': True, 'mode': 'grayscale', 'format': 'JPEG', 'quality': 80}
+    }
+    
+    # OpenAI高解析度模式會縮到短邊768，Anthropic建議長邊不超過1568
+    DEFAULT_PROVIDERS = {
+        'openai': {'max_long_edge': 2048, 'max_short_edge': 768},
+        'anthropic': {'max_long_edge': 1568},
+        'cli': {'max_long_edge': 1568}
+    }
+    
+    MEDIA_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+    EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp'}
+    
+    def __init__(self, config):
+        preprocess_config = config.get('preprocess', {})
+        self.enabled = preprocess_config.get('enabled', True)
+        self.crop_margin = preprocess_config.get('crop_margin', 8)
+        self.crop_tolerance = preprocess_config.get('crop_tolerance', 24)
+        self.kinds = {
+            kind: dict(defaults, **preprocess_config.get('kinds', {}).get(kind, {}))
+            for kind, defaults in self.DEFAULT_KINDS.items()
+        }
+        self.providers = dict(self.DEFAULT_PROVIDERS, **preprocess_config.get('providers', {}))
+        self.webp_supported = features.check('webp')
+    
+    def settings_for(self, kind, provider):
+        settings = dict(self.kinds.get(kind, {}))
+        settings.update(self.providers.get(provider, {}))
+        return settings
+    
+    def prepare(self, payload, kind, provider):
+        """回傳前處理後的ImagePayload；停用或處理失敗時回傳原圖"""
+        if not self.enabled:
+            return payload
+        settings = self.settings_for(kind, provider)
+        key = tuple(sorted(settings.items()))
+        if key in payload._variants:
+            return payload._variants[key]
+        try:
+            result = self._process(payload, settings)
+        except Exception as e:
+            print(f"[WARN] 圖片前處理失敗，使用原圖 {payload}: {e}")
+            result = payload
+        payload._variants[key] = result
+        return result
+    
+    def _process(self, payload, settings):
+        image = payload.open_image()
+        original_size = image.size
+        image = self._flatten(image)
+        if settings.get('crop', True):
+            image = self.crop_to_content(image)
+        
+        mode = settings.get('mode', 'grayscale')
+        if mode == 'binarize':
+            gray = np.asarray(image.convert('L'), dtype=np.uint8)
+            image = Image.fromarray(np.where(gray <= otsu_threshold(gray), 0, 255).astype(np.uint8))
+        elif mode == 'grayscale':
+            image = image.convert('L')
+        
+        image = self._downscale(image, settings.get('max_long_edge'), settings.get('max_short_edge'))
+        data, image_format = self._encode(image, settings.get('format', 'auto'), settings.get('quality', 85))
+        
+        # 編碼後反而變大（例如線條圖的PNG改存JPEG）時改用PNG，仍未變小就直接使用原圖
+        if len(data) >= len(payload.data) and image_format != 'PNG':
+            data, image_format = self._encode(image, 'PNG', settings.get('quality', 85))
+        if len(data) >= len(payload.data):
+            return payload
+        name = payload.name and os.path.splitext(payload.name)[0] + "_prep" + self.EXTENSIONS[image_format]
+        print(f"[DEBUG] 圖片前處理 {payload.name}: {original_size[0]}x{original_size[1]} {len(payload.data)} bytes → "
+              f"{image.size[0]}x{image.size[1]} {len(data)} bytes ({self.MEDIA_TYPES[image_format]})")
+        return ImagePayload(data, self.MEDIA_TYPES[image_format], name)
+    
+    @staticmethod
+    def _flatten(image):
+        """透明背景合成為白底，其他模式轉為RGB或L"""
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        if image.mode not in ('RGB', 'L'):
+            return image.convert('RGB')
+        return image
+    
+    def crop_to_content(self, image):
+        """以四角的背景色為準裁掉周圍空白（保留crop_margin像素邊界）"""
+        background_color = image.getpixel((0, 0))
+        background = Image.new(image.mode, image.size, background_color)
+        difference = ImageChops.difference(image, background).convert('L')
+        box = difference.point(lambda value: 255 if value > self.crop_tolerance else 0).getbbox()
+        if not box:
+            return image
+        left, top, right, bottom = box
+        box = (
+            max(0, left - self.crop_margin), max(0, top - self.crop_margin),
+            min(image.width, right + self.crop_margin), min(image.height, bottom + self.crop_margin)
+        )
+        return image.crop(box) if box != (0, 0, image.width, image.height) else image
+    
+    @staticmethod
+    def _downscale(image, max_long_edge=None, max_short_edge=None):
+        """等比例縮小到長邊與短邊上限內（不放大）"""
+        scale = 1.0
+        if max_long_edge:
+            scale = min(scale, max_long_edge / max(image.size))
+        if max_short_edge:
+            scale = min(scale, max_short_edge / min(image.size))
+        if scale >= 1.0:
+            return image
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, Image.LANCZOS)
+    
+    def _encode(self, image, image_format, quality):
+        """依設定格式編碼；auto時比較PNG與JPEG（支援時含WebP）取最小者"""
+        image_format = image_format.upper()
+        if image_format == 'WEBP' and not self.webp_supported:
+            image_format = 'JPEG'
+        candidates = ['PNG', 'JPEG'] + (['WEBP'] if self.webp_supported else []) if image_format == 'AUTO' else [image_format]
+        best = None
+        for candidate in candidates:
+            buffer = io.BytesIO()
+            if candidate == 'PNG':
+                image.save(buffer, format='PNG', optimize=True)
+            else:
+                image.save(buffer, format=candidate, quality=quality)
+            data = buffer.getvalue()
+            if best is None or len(data) < len(best[0]):
+                best = (data, candidate)
+        return best
+
+class RecognitionCache:
+    """識別結果快取（SQLite）- 以圖片內容雜湊（可選感知雜湊）為鍵，依識別服務與prompt版本分別保存
+    
+    相同像素的圖片（空白考卷、重新執行同一位學生）不再重新呼叫識別服務；
+    超過 max_entries 筆時刪除最久未使用的紀錄（LRU）。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS recognitions (
+            kind TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            phash INTEGER,
+            result TEXT NOT NULL,
+            created_at REAL,
+            last_used REAL,
+            PRIMARY KEY (kind, provider, prompt_version, content_hash)
+        )
+    """
+    
+    def __init__(self, config, metrics=None):
+        cache_config = config.get('recognition_cache', {})
+        self.enabled = cache_config.get('enabled', True)
+        self.path = cache_config.get('path', './cache/recognitions.sqlite3')
+        self.max_entries = cache_config.get('max_entries', 5000)
+        # 感知雜湊比對（漢明距離上限）：預設關閉，只有內容完全相同才命中
+        self.perceptual = cache_config.get('perceptual', {'captcha': False, 'exam': False})
+        self.phash_distance = cache_config.get('phash_distance', 2)
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._connection = None
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(self.SCHEMA)
+            self._connection.commit()
+    
+    @staticmethod
+    def prompt_version(*parts):
+        """以prompt與模型名稱計算版本，prompt改變時舊結果自動失效"""
+        return hashlib.sha1("\n".join(str(part) for part in parts).encode('utf-8')).hexdigest()[:12]
+    
+    @staticmethod
+    def content_hash(payload):
+        return hashlib.sha256(payload.view).hexdigest()
+    
+    @staticmethod
+    def perceptual_hash(payload):
+        """64位元差異雜湊（dHash）"""
+        image = payload.open_image().convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = np.asarray(image, dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+        # SQLite INTEGER為有號64位元
+        return int(sum(1 << i for i, bit in enumerate(bits) if bit)) - (1 << 63)
+    
+    def _count(self, name):
+        if self.metrics:
+            self.metrics.incr(name)
+    
+    def get(self, kind, payload, versions):
+        """依序查詢各識別服務的快取結果
+        
+        Args:
+            versions (dict): {識別服務: prompt版本}，依優先順序排列
+        
+        Returns:
+            tuple: (結果, 識別服務)；未命中時為 (None, None)
+        """
+        if not self.enabled:
+            return None, None
+        content_hash = self.content_hash(payload)
+        placeholders = ",".join("?" * len(versions))
+        try:
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT provider, prompt_version, result, content_hash FROM recognitions "
+                    f"WHERE kind = ? AND content_hash = ? AND provider IN ({placeholders})",
+                    (kind, content_hash, *versions)
+                ).fetchall()
+                if not rows and self.perceptual.get(kind):
+                    rows = self._perceptual_rows(kind, payload, versions)
+                found = {
+                    provider: (result, matched_hash)
+                    for provider, prompt_version, result, matched_hash in rows
+                    if versions.get(provider) == prompt_version
+                }
+                for provider in versions:
+                    if provider in found:
+                        result, matched_hash = found[provider]
+                        with self._connection:
+                            self._connection.execute(
+                                "UPDATE recognitions SET last_used = ? WHERE kind = ? AND provider = ? "
+                                "AND prompt_version = ? AND content_hash = ?",
+                                (time.time(), kind, provider, versions[provider], matched_hash)
+                            )
+                        self._count(f"recognition_cache.hit.{kind}")
+                        return json.loads(result), provider
+        except sqlite3.Error as e:
+            print(f"[WARN] 讀取識別快取失敗: {e}")
+        self._count(f"recognition_cache.miss.{kind}")
+        return None, None
+    
+    def _perceptual_rows(self, kind, payload, versions):
+        """以感知雜湊尋找相近圖片的紀錄（呼叫端需持有鎖）"""
+        try:
+            target = self.perceptual_hash(payload)
+        except Exception:
+            return []
+        placeholders = ",".join("?" * len(versions))
+        rows = self._connection.execute(
+            f"SELECT provider, prompt_version, result, content_hash, phash FROM recognitions "
+            f"WHERE kind = ? AND phash IS NOT NULL AND provider IN ({placeholders})",
+            (kind, *versions)
+        ).fetchall()
+        return [
+            row[:4] for row in rows
+            if bin((row[4] ^ target) & ((1 << 64) - 1)).count('1') <= self.phash_distance
+        ]
+    
+    def put(self, kind, payload, provider, prompt_version, result):
+        """保存識別結果並依LRU淘汰超出上限的紀錄"""
+        if not self.enabled or result is None:
+            return
+        phash = None
+        if self.perceptual.get(kind):
+            try:
+                phash = self.perceptual_hash(payload)
+            except Exception:
+                pass
+        now = time.time()
+        with self._lock:
+            try:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO recognitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (kind, provider, prompt_version, self.content_hash(payload), phash,
+                         json.dumps(result, ensure_ascii=False), now, now)
+                    )
+                    self._connection.execute(
+                        "DELETE FROM recognitions WHERE rowid IN (SELECT rowid FROM recognitions "
+                        "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,)
+                    )
+            except sqlite3.Error as e:
+                print(f"[WARN] 寫入識別快取失敗: {e}")
+    
+    def close(self):
+        if self._connection:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
+
+class ScreenshotEngine:
+    """頁面截圖 - 以CDP Page.captureScreenshot 截取指定區域（可超出視窗範圍），直接回傳圖片bytes
+    
+    高度超過 tile_height 的頁面或元素切成多張圖塊，避免長篇作答被截斷，也避免單張圖片過高；
+    可輸出PNG/JPEG/WebP。瀏覽器不支援CDP時改用視窗截圖（只有可見範圍）。
+    """
+    
+    MEDIA_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+    
+    PAGE_SIZE_SCRIPT = """
+        var root = document.documentElement, body = document.body || root;
+        return [Math.max(root.scrollWidth, body.scrollWidth, root.clientWidth),
+                Math.max(root.scrollHeight, body.scrollHeight, root.clientHeight)];
+    """
+    
+    ELEMENT_RECT_SCRIPT = """
+        var rect = arguments[0].getBoundingClientRect();
+        return [rect.left + window.scrollX, rect.top + window.scrollY, rect.width, rect.height];
+    """
+    
+    def __init__(self, driver, config, metrics=None):
+        screenshot_config = config.get('screenshots', {})
+        self.driver = driver
+        self.metrics = metrics or RunMetrics(config)
+        self.format = screenshot_config.get('format', 'jpeg')
+        self.quality = screenshot_config.get('quality', 85)
+        self.tile_height = screenshot_config.get('tile_height', 4000)
+        self.max_height = screenshot_config.get('max_height', 20000)
+        self.use_cdp = screenshot_config.get('use_cdp', True) and hasattr(driver, 'execute_cdp_cmd')
+    
+    def _capture_clip(self, x, y, width, height, image_format):
+        """以CDP截取頁面座標中的一個區域，回傳圖片bytes"""
+        params = {
+            'format': image_format,
+            'clip': {'x': x, 'y': y, 'width': width, 'height': height, 'scale': 1},
+            'captureBeyondViewport': True,
+            'fromSurface': True,
+        }
+        if image_format != 'png':
+            params['quality'] = self.quality
+        return base64.b64decode(self.driver.execute_cdp_cmd('Page.captureScreenshot', params)['data'])
+    
+    def capture_region(self, x, y, width, height, image_format=None, max_tiles=None):
+        """截取頁面座標中的區域，過高時切成多張圖塊
+        
+        Returns:
+            list: [(圖片bytes, media_type)]，由上而下排列
+        """
+        image_format = image_format or self.format
+        if height > self.max_height:
+            print(f"[WARN] 截圖區域高度 {int(height)}px 超過上限 {self.max_height}px，超出部分不截取")
+            height = self.max_height
+        tops = list(range(int(y), int(y + height), self.tile_height))[:max_tiles]
+        tiles = []
+        with self.metrics.span("screenshot", tiles=len(tops), format=image_format):
+            for top in tops:
+                tile_height = min(self.tile_height, y + height - top)
+                tiles.append((self._capture_clip(x, top, width, tile_height, image_format),
+                              self.MEDIA_TYPES[image_format]))
+        return tiles
+    
+    def capture_page(self, image_format=None, max_tiles=None):
+        """截取整個頁面（包含視窗外的內容）"""
+        if self.use_cdp:
+            try:
+                width, height = self.driver.execute_script(self.PAGE_SIZE_SCRIPT)
+                return self.capture_region(0, 0, width, height, image_format, max_tiles)
+            except Exception as e:
+                print(f"[WARN] CDP截圖失敗，改用視窗截圖: {e}")
+        return [(self.driver.get_screenshot_as_png(), 'image/png')]
+    
+    def capture_element(self, element, rect=None, image_format=None):
+        """截取元素範圍（rect為已知的 (x, y, 寬, 高) 頁面座標時不需再查詢）"""
+        if self.use_cdp:
+            try:
+                x, y, width, height = rect or self.driver.execute_script(self.ELEMENT_RECT_SCRIPT, element)
+                return self.capture_region(x, y, width, height, image_format)
+            except Exception as e:
+                print(f"[WARN] CDP截圖失敗，改用元素截圖: {e}")
+        return [(element.screenshot_as_png, 'image/png')]
+
+class ImageDownloader:
+    """圖片下載器 - 共用連線池的requests.Session（keep-alive），cookies與瀏覽器同步，可並行下載原始圖片"""
+    
+    def __init__(self, config):
+        download_config = config.get('download', {})
+        self.enabled = download_config.get('enabled', True)
+        self.max_workers = download_config.get('max_workers', 4)
+        self.timeout = download_config.get('timeout', 15)
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers * 2,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._user_agent_synced = False
+    
+    def sync_cookies(self, driver):
+        """將瀏覽器目前的cookies（及User-Agent）同步到Session"""
+        try:
+            for cookie in driver.get_cookies():
+                self.session.cookies.set(
+                    cookie['name'], cookie['value'],
+                    domain=cookie.get('domain', ''), path=cookie.get('path', '/')
+                )
+            if not self._user_agent_synced:
+                self.session.headers['User-Agent'] = driver.execute_script("return navigator.userAgent")
+                self._user_agent_synced = True
+        except Exception as e:
+            print(f"[WARN] 同步瀏覽器cookies失敗: {e}")
+    
+    def fetch(self, url, referer=None):
+        """下載單張圖片，回傳(圖片bytes, media_type)；失敗時回傳(None, None)"""
+        if not url:
+            return None, None
+        if url.startswith('data:image'):
+            # 處理base64圖片
+            header, data = url.split(',', 1)
+            return base64.b64decode(data), header[5:].split(';')[0]
+        
+        try:
+            headers = {'Referer': referer} if referer else None
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except Exception as e:
+            print(f"[WARN] 下載圖片失敗 {url}: {e}")
+            return None, None
+        
+        media_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if response.status_code != 200 or not media_type.startswith('image/'):
+            print(f"[WARN] 下載圖片失敗 {url}: HTTP {response.status_code} {media_type}")
+            return None, None
+        return response.content, media_type
+    
+    def fetch_many(self, urls, referer=None):
+        """並行下載多張圖片，結果順序與urls相同"""
+        return list(self._executor.map(lambda url: self.fetch(url, referer), urls))
+    
+    @staticmethod
+    def extension_for(media_type):
+        """依media_type取得副檔名"""
+        if media_type == 'image/jpeg':
+            return '.jpg'
+        return mimetypes.guess_extension(media_type or '') or '.png'
+    
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+def rank_exam_images(candidates, limit=5, min_size=50):
+    """從頁面圖片中選出考卷圖片（依 src含exam/student → alt含考卷/exam → 位於考卷內容區 → 所有圖片 的順序）
+    
+    candidates 為 {'src', 'alt', 'in_content', 'width', 'height', 'visible'} 清單（依頁面順序），
+    寬高未知（None）時視為符合；只使用第一個有結果的條件，回傳最多limit張。
+    src比對使用原始屬性（src_attribute），避免網域名稱中的exam讓所有圖片都符合。
+    """
+    def source(candidate):
+        return candidate.get('src_attribute') or candidate['src']
+    
+    def large_enough(candidate):
+        return all(candidate.get(name) is None or candidate[name] > min_size for name in ('width', 'height'))
+    
+    usable = [
+        candidate for candidate in candidates
+        if candidate.get('src') and candidate.get('visible', True) and large_enough(candidate)
+    ]
+    rules = [
+        lambda candidate: 'exam' in source(candidate) or 'student' in source(candidate),
+        lambda candidate: '考卷' in (candidate.get('alt') or '') or 'exam' in (candidate.get('alt') or ''),
+        lambda candidate: candidate.get('in_content'),
+        lambda candidate: True,
+    ]
+    for rule in rules:
+        matched = [candidate for candidate in usable if rule(candidate)]
+        if matched:
+            return matched[:limit]
+    return []
+
+class ExamImageParser(HTMLParser):
+    """從考卷頁面HTML找出考卷圖片（與capture_exam_images相同，以rank_exam_images排序）"""
+    
+    CONTENT_CLASSES = ('exam-content', 'answer')
+    
+    def __init__(self):
+        super().__init__()
+        self.images = []
+        self._div_classes = []
+    
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'div':
+            self._div_classes.append(attrs.get('class') or '')
+        elif tag == 'img' and attrs.get('src'):
+            self.images.append({
+                'src': attrs['src'],
+                'alt': attrs.get('alt'),
+                'in_content': any(name in classes for classes in self._div_classes for name in self.CONTENT_CLASSES),
+                'width': self._dimension(attrs.get('width')),
+                'height': self._dimension(attrs.get('height')),
+            })
+    
+    def handle_endtag(self, tag):
+        if tag == 'div' and self._div_classes:
+            self._div_classes.pop()
+    
+    @staticmethod
+    def _dimension(value):
+        # 沒有寬高屬性（或為百分比等）時無法判斷，回傳None
+        value = str(value or '').strip()
+        if value.endswith('px'):
+            value = value[:-2]
+        return int(value) if value.isdigit() else None
+    
+    def exam_image_sources(self, limit=5):
+        """選出考卷圖片網址（規則見rank_exam_images）"""
+        return [candidate['src'] for candidate in rank_exam_images(self.images, limit)]
+
+class ExamPrefetcher:
+    """考卷預取 - 在目前學生分析時，以HTTP在背景下載接下來N位學生的考卷頁面與圖片
+    
+    使用ImageDownloader的Session（cookies與瀏覽器同步），結果放在最多depth位學生的記憶體緩衝區；
+    取得預取結果的學生不需由瀏覽器開啟考卷頁面。預取失敗時由瀏覽器照常開啟。
+    """
+    
+    def __init__(self, config, downloader, image_sink, metrics=None):
+        prefetch_config = config.get('prefetch', {})
+        self.enabled = prefetch_config.get('enabled', False) and downloader.enabled
+        self.depth = max(1, prefetch_config.get('depth', 3))
+        self.wait_timeout = prefetch_config.get('wait_timeout', 30)
+        self.downloader = downloader
+        self.image_sink = image_sink
+        self.metrics = metrics or RunMetrics(config)
+        self._buffer = {}  # url -> Future
+        self._executor = ThreadPoolExecutor(max_workers=self.depth) if self.enabled else None
+    
+    def schedule(self, entries):
+        """排程預取（依序填滿緩衝區，已在緩衝區的學生略過）"""
+        for entry in entries:
+            if len(self._buffer) >= self.depth:
+                break
+            url = entry['url']
+            if url and url not in self._buffer:
+                self._buffer[url] = self._executor.submit(self._fetch_exam, url)
+    
+    def _fetch_exam(self, url):
+        """下載考卷頁面並解析、下載其中的考卷圖片，回傳[(bytes, media_type)]"""
+        with self.metrics.span("prefetch"):
+            response = self.downloader.session.get(url, timeout=self.downloader.timeout)
+            if response.status_code != 200 or response.history:
+                # 被導回登入頁或其他頁面（例如session過期）
+                raise RuntimeError(f"HTTP {response.status_code} {response.url}")
+            parser = ExamImageParser()
+            parser.feed(response.text)
+            sources = [urljoin(response.url, source) for source in parser.exam_image_sources()]
+            if not sources:
+                raise RuntimeError("頁面中找不到考卷圖片")
+            downloads = self.downloader.fetch_many(sources, referer=response.url)
+            if not all(data for data, _ in downloads):
+                raise RuntimeError(f"{len(sources)} 張圖片中有下載失敗")
+            return downloads
+    
+    def take(self, url, student_id):
+        """取出預取的考卷圖片（ImagePayload清單）；未預取或預取失敗時回傳None"""
+        future = self._buffer.pop(url, None) if url else None
+        if future is None:
+            return None
+        try:
+            downloads = future.result(timeout=self.wait_timeout)
+        except Exception as e:
+            print(f"[WARN] 預取學生 {student_id} 的考卷失敗，改由瀏覽器開啟: {e}")
+            self.metrics.incr("prefetch_failures")
+            return None
+        
+        self.metrics.incr("prefetch_hits")
+        timestamp = int(time.time())
+        safe_id = re.sub(r'[^\w-]', '_', str(student_id))
+        images = []
+        for i, (image_data, media_type) in enumerate(downloads):
+            extension = ImageDownloader.extension_for(media_type)
+            payload = ImagePayload(image_data, media_type, f"exam_image_{timestamp}_{safe_id}_{i}{extension}")
+            images.append(self.image_sink.submit(payload))
+        print(f"[SUCCESS] 使用預取的考卷圖片 {len(images)} 張")
+        return images
+    
+    def clear(self):
+        """取消尚未開始的預取並清空緩衝區（換頁或結束時呼叫）"""
+        for future in self._buffer.values():
+            future.cancel()
+        self._buffer.clear()
+    
+    def close(self):
+        self.clear()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+class LocalCaptchaRecognizer:
+    """本地驗證碼識別器 - 以已確認答案的驗證碼圖片建立字元樣板，離線以最近鄰比對識別
+    
+    流程：灰階 → Otsu二值化（加上深色門檻濾除淺色干擾線） → 移除孤立雜點 → 垂直投影切割字元 → 正規化為固定大小 → 最近鄰比對
+    """
+    
+    GLYPH_SIZE = (12, 16)  # 字元樣板大小（寬, 高）
+    
+    def __init__(self, config):
+        captcha_config = config.get('captcha', {})
+        local_config = captcha_config.get('local', {})
+        self.save_path = captcha_config.get('save_path', './captcha_images/')
+        self.labels_path = local_config.get('labels_path') or os.path.join(self.save_path, 'labels.json')
+        self.min_confidence = local_config.get('min_confidence', 0.25)
+        self.min_samples = local_config.get('min_samples', 20)
+        self.max_templates_per_char = local_config.get('max_templates_per_char', 50)
+        self.max_image_size = tuple(local_config.get('max_image_size', [300, 120]))
+        # 字元像素的最大灰階值：Otsu門檻在白底圖片上偏高，會把淺灰干擾線也當成字元
+        self.ink_threshold = local_config.get('ink_threshold', 140)
+        self.labels = self._load_labels()
+        self.template_features = None
+        self.template_chars = []
+        self._lock = threading.Lock()
+    
+    def _load_labels(self):
+        """讀取已確認的驗證碼答案 {檔名: 答案}"""
+        try:
+            with open(self.labels_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[WARN] 驗證碼標記檔案無法讀取: {e}")
+            return {}
+    
+    def _save_labels(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.labels_path)), exist_ok=True)
+        temp_path = f"{self.labels_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.labels, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.labels_path)
+    
+    @property
+    def expected_length(self):
+        """驗證碼長度（取已標記答案中最常見的長度）"""
+        if not self.labels:
+            return None
+        return Counter(len(text) for text in self.labels.values()).most_common(1)[0][0]
+    
+    def is_ready(self):
+        """是否已累積足夠的標記樣本（至少一張，才能決定驗證碼長度）"""
+        return bool(self.labels) and len(self.labels) >= self.min_samples
+    
+    def _binarize(self, image):
+        """轉為二值化遮罩（True為字元像素）"""
+        # 不使用中值濾波：細字（1像素筆畫）會被整個濾掉
+        gray = np.asarray(image.convert('L'), dtype=np.uint8)
+        # 深色底淺色字時先反轉，讓字元一律是深色
+        if np.median(gray) < 128:
+            gray = 255 - gray
+        
+        mask = gray <= min(otsu_threshold(gray), self.ink_threshold)
+        # 移除八鄰域內沒有其他字元像素的孤立雜點
+        padded = np.pad(mask, 1)
+        neighbours = sum(
+            padded[1 + dy:1 + dy + mask.shape[0], 1 + dx:1 + dx + mask.shape[1]]
+            for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx
+        )
+        return mask & (neighbours > 0)
+    
+    def _segment(self, mask, count):
+        """依垂直投影將遮罩切割成count個字元區段"""
+        columns = mask.sum(axis=0) > 0
+        runs = []
+        start = None
+        for x, filled in enumerate(columns):
+            if filled and start is None:
+                start = x
+            elif not filled and start is not None:
+                runs.append([start, x])
+                start = None
+        if start is not None:
+            runs.append([start, len(columns)])
+        
+        # 移除過小的雜點區段
+        runs = [run for run in runs if mask[:, run[0]:run[1]].sum() >= 4]
+        if not runs:
+            return []
+        
+        # 區段過多：合併間距最小的相鄰區段
+        while len(runs) > count:
+            gaps = [runs[i + 1][0] - runs[i][1] for i in range(len(runs) - 1)]
+            i = gaps.index(min(gaps))
+            runs[i:i + 2] = [[runs[i][0], runs[i + 1][1]]]
+        
+        # 區段過少：從最寬的區段中間投影最低處切開（處理字元相連）
+        while len(runs) < count:
+            widths = [end - begin for begin, end in runs]
+            i = widths.index(max(widths))
+            begin, end = runs[i]
+            if end - begin < 2:
+                return []
+            quarter = max((end - begin) // 4, 1)
+            projection = mask[:, begin + quarter:end - quarter].sum(axis=0)
+            cut = begin + quarter + int(np.argmin(projection)) if projection.size else (begin + end) // 2
+            runs[i:i + 1] = [[begin, cut], [cut, end]]
+        
+        glyphs = []
+        for begin, end in runs:
+            column_slice = mask[:, begin:end]
+            rows = np.where(column_slice.any(axis=1))[0]
+            glyph = column_slice[rows[0]:rows[-1] + 1] if rows.size else column_slice
+            glyph_image = Image.fromarray((glyph * 255).astype(np.uint8)).resize(self.GLYPH_SIZE, Image.BILINEAR)
+            glyphs.append(np.asarray(glyph_image, dtype=np.float32).ravel() / 255.0)
+        return glyphs
+    
+    def _open_image(self, image):
+        if isinstance(image, ImagePayload):
+            return image.open_image()
+        image = Image.open(image)
+        image.load()
+        return image
+    
+    def train(self):
+        """以所有已標記的驗證碼圖片重建字元樣板"""
+        features = []
+        chars = []
+        per_char = Counter()
+        for filename, text in self.labels.items():
+            image_path = os.path.join(self.save_path, filename)
+            try:
+                glyphs = self._segment(self._binarize(self._open_image(image_path)), len(text))
+            except (OSError, ValueError):
+                continue
+            if len(glyphs) != len(text):
+                continue
+            for char, glyph in zip(text, glyphs):
+                if per_char[char] >= self.max_templates_per_char:
+                    continue
+                per_char[char] += 1
+                features.append(glyph)
+                chars.append(char)
+        
+        with self._lock:
+            self.template_features = np.vstack(features) if features else None
+            self.template_chars = chars
+        print(f"[INFO] 本地驗證碼樣板已建立: {len(self.labels)} 張圖片, {len(chars)} 個字元樣板")
+    
+    def add_sample(self, image, text):
+        """記錄登入成功的驗證碼答案並加入樣板"""
+        if not image or not text:
+            return
+        image_path = image.ensure_file(self.save_path) if isinstance(image, ImagePayload) else image
+        filename = os.path.relpath(os.path.abspath(image_path), os.path.abspath(self.save_path))
+        if filename.startswith('..'):
+            return
+        with self._lock:
+            self.labels[filename] = text
+            self._save_labels()
+        
+        if self.template_features is None:
+            return
+        try:
+            glyphs = self._segment(self._binarize(self._open_image(image)), len(text))
+        except (OSError, ValueError):
+            return
+        if len(glyphs) != len(text):
+            return
+        with self._lock:
+            counts = Counter(self.template_chars)
+            for char, glyph in zip(text, glyphs):
+                if counts[char] < self.max_templates_per_char:
+                    self.template_features = np.vstack([self.template_features, glyph])
+                    self.template_chars.append(char)
+                    counts[char] += 1
+    
+    def recognize(self, image):
+        """識別驗證碼（檔案路徑或ImagePayload），回傳(驗證碼, 信心值)；無法識別時回傳(None, 0.0)"""
+        if not self.is_ready():
+            return None, 0.0
+        if self.template_features is None:
+            self.train()
+            if self.template_features is None:
+                return None, 0.0
+        
+        image = self._open_image(image)
+        if image.size[0] > self.max_image_size[0] or image.size[1] > self.max_image_size[1]:
+            return None, 0.0
+        
+        count = self.expected_length
+        if not count:
+            return None, 0.0
+        glyphs = self._segment(self._binarize(image), count)
+        if len(glyphs) != count:
+            return None, 0.0
+        
+        with self._lock:
+            features = self.template_features
+            chars = np.array(self.template_chars)
+        
+        text = []
+        confidence = 1.0
+        for glyph in glyphs:
+            distances = np.linalg.norm(features - glyph, axis=1)
+            best = int(np.argmin(distances))
+            best_char = chars[best]
+            others = distances[chars != best_char]
+            # 信心值：最近樣板與最近的「其他字元」樣板的距離比
+            if others.size and others.min() > 0:
+                char_confidence = 1.0 - distances[best] / others.min()
+            else:
+                char_confidence = 1.0
+            confidence = min(confidence, char_confidence)
+            text.append(best_char)
+        return ''.join(text), float(max(confidence, 0.0))
+
+class ClaudeCliWorker:
+    """常駐的Claude CLI程序 - 以stream-json模式啟動一次，透過stdin送出請求並逐行解析stdout的回應"""
+    
+    def __init__(self, command, extra_args=None, cwd=None):
+        self.command = command
+        self.extra_args = list(extra_args or [])
+        self.cwd = cwd
+        self.requests = 0
+        self.process = None
+        self.closed = False
+        self._responses = queue.Queue()
+        self._stderr = deque(maxlen=20)
+    
+    def start(self):
+        """啟動CLI程序與讀取執行緒"""
+        self.process = subprocess.Popen(
+            [self.command, '-p', '--input-format', 'stream-json', '--output-format', 'stream-json', '--verbose']
+            + self.extra_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            bufsize=1,
+            cwd=self.cwd
+        )
+        threading.Thread(target=self._read_stdout, args=(self.process,), daemon=True).start()
+        threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True).start()
+        return self
+    
+    def _read_stdout(self, process):
+        """逐行解析stream-json輸出，只保留每次請求的最終結果（type為result）"""
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get('type') == 'result':
+                self._responses.put(event)
+        # 程序結束時喚醒等待中的請求
+        self._responses.put(None)
+    
+    def _read_stderr(self, process):
+        for line in process.stderr:
+            self._stderr.append(line.rstrip())
+    
+    def alive(self):
+        return not self.closed and self.process is not None and self.process.poll() is None
+    
+    def request(self, content, timeout, cancel_event=None):
+        """送出一則使用者訊息並等待結果
+        
+        Returns:
+            str: 回應文字；錯誤時回傳None。逾時或被取消時會終止程序（由呼叫端重新建立）
+        """
+        message = {'type': 'user', 'message': {'role': 'user', 'content': content}}
+        try:
+            self.process.stdin.write(json.dumps(message, ensure_ascii=False) + "\n")
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            print(f"[WARN] 無法送出請求給Claude CLI: {e}")
+            self.close()
+            return None
+        self.requests += 1
+        
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                event = self._responses.get(timeout=0.2)
+                break
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    reason = "已取消"
+                elif time.monotonic() >= deadline:
+                    reason = f"逾時 {timeout} 秒"
+                else:
+                    continue
+                # 未完成的回應會錯置到下一個請求，因此直接終止程序
+                self.close()
+                print(f"[INFO] Claude CLI程序已終止（{reason}）")
+                return None
+        
+        if event is None:
+            self.close()
+            stderr = " / ".join(self._stderr) or f"結束代碼 {self.process.returncode}"
+            print(f"[WARN] Claude CLI程序已結束: {stderr}")
+            return None
+        if event.get('is_error') or event.get('subtype') != 'success':
+            print(f"Claude CLI執行失敗: {event.get('result') or event.get('subtype')}")
+            return None
+        return (event.get('result') or '').strip()
+    
+    def close(self):
+        """結束程序（關閉stdin讓CLI自行結束，逾時則強制終止）"""
+        self.closed = True
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+        try:
+            self.process.wait(timeout=3)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+class ClaudeCliPool:
+    """Claude CLI常駐程序池 - 啟動時預先開啟程序，請求時取用閒置程序，程序異常結束時自動重新啟動
+    
+    同一程序會累積對話內容，處理 max_requests 個請求後即重新啟動以維持回應速度。
+    """
+    
+    def __init__(self, config):
+        cli_config = config.get('captcha', {}).get('cli', {})
+        self.command = shutil.which(cli_config.get('command', 'claude'))
+        self.size = cli_config.get('pool_size', 1)
+        self.max_requests = cli_config.get('max_requests', 20)
+        self.timeout = cli_config.get('timeout', 45)
+        self.extra_args = cli_config.get('extra_args', [])
+        self.cwd = config.get('captcha', {}).get('save_path', './captcha_images/')
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+    
+    def is_available(self):
+        """系統上是否找得到Claude CLI"""
+        return self.command is not None
+    
+    def _spawn(self):
+        os.makedirs(self.cwd, exist_ok=True)
+        return ClaudeCliWorker(self.command, self.extra_args, self.cwd).start()
+    
+    def prewarm(self):
+        """預先啟動所有程序，第一次識別不需等待CLI冷啟動"""
+        if not self.is_available():
+            return
+        with self._lock:
+            while self._created < self.size and not self._closed:
+                try:
+                    self._idle.put(self._spawn())
+                except OSError as e:
+                    print(f"[WARN] 無法啟動Claude CLI: {e}")
+                    return
+                self._created += 1
+        if not self._closed:
+            print(f"[INFO] 已預先啟動 {self.size} 個Claude CLI程序")
+    
+    def _acquire(self, cancel_event=None):
+        """取得可用的程序：優先使用閒置程序，未達上限時建立新程序，否則等待"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                worker = None
+                with self._lock:
+                    if self._created < self.size:
+                        self._created += 1
+                        create = True
+                    else:
+                        create = False
+                if create:
+                    try:
+                        return self._spawn()
+                    except OSError:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                try:
+                    worker = self._idle.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+            if worker.alive():
+                return worker
+            # 程序已異常結束：丟棄並以新程序取代
+            print("[WARN] Claude CLI程序已結束，重新啟動")
+            worker.close()
+            try:
+                return self._spawn()
+            except OSError:
+                # 名額釋出，之後的請求可重新建立程序而不會永遠等待
+                with self._lock:
+                    self._created -= 1
+                raise
+    
+    def _release(self, worker):
+        """歸還程序；已結束或達到請求上限的程序改為建立新程序"""
+        if worker.alive() and worker.requests < self.max_requests and not self._closed:
+            self._idle.put(worker)
+            return
+        worker.close()
+        if self._closed:
+            return
+        try:
+            self._idle.put(self._spawn())
+        except OSError as e:
+            with self._lock:
+                self._created -= 1
+            print(f"[WARN] 無法重新啟動Claude CLI: {e}")
+    
+    def request(self, content, cancel_event=None):
+        """以閒置程序處理一則請求，回傳回應文字或None"""
+        worker = self._acquire(cancel_event)
+        if worker is None:
+            return None
+        try:
+            return worker.request(content, self.timeout, cancel_event)
+        finally:
+            self._release(worker)
+    
+    def close(self):
+        """結束所有程序（等待進行中的預先啟動完成，避免關閉後才啟動的程序殘留）"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ProviderRouter:
+    """識別服務路由 - 追蹤各服務近期的成功率、延遲與估計費用，動態調整嘗試順序並以斷路器暫停故障的服務
+    
+    呼叫端給定的順序（成本效益與 api.preferred_provider）為預設順序；
+    近期（stats_ttl 秒內）成功率過低或平均延遲超過上限的服務移到健康服務之後，
+    連續失敗 failure_threshold 次時斷路（暫停 cooldown 秒），之後以半開狀態在原本的順序放行一次探測，成功即恢復。
+    """
+    
+    DEFAULT_COSTS = {'local': 0.0, 'cli': 0.0, 'openai': 0.0001, 'anthropic': 0.0006}
+    DEFAULT_SLOW_LATENCY = {'cli': 30, 'openai': 15, 'anthropic': 20}
+    
+    def __init__(self, config, name, metrics=None):
+        router_config = config.get('router', {})
+        self.name = name
+        self.metrics = metrics
+        self.enabled = router_config.get('enabled', True)
+        self.window = router_config.get('window', 20)
+        self.min_samples = router_config.get('min_samples', 5)
+        self.min_success_rate = router_config.get('min_success_rate', 0.5)
+        self.failure_threshold = router_config.get('failure_threshold', 3)
+        self.cooldown = router_config.get('cooldown', 60)
+        self.stats_ttl = router_config.get('stats_ttl', 300)
+        self.costs = dict(self.DEFAULT_COSTS, **router_config.get('costs', {}))
+        self.slow_latency = dict(self.DEFAULT_SLOW_LATENCY, **router_config.get('slow_latency', {}))
+        self.stats = {}
+        self._lock = threading.Lock()
+    
+    def _stats(self, provider):
+        if provider not in self.stats:
+            self.stats[provider] = {
+                'samples': deque(maxlen=self.window),  # (時間, 是否成功, 延遲)
+                'consecutive_failures': 0,
+                'state': 'closed',
+                'opened_at': None,
+                'probe_at': None,
+                'calls': 0,
+                'failures': 0,
+                'cost': 0.0
+            }
+        return self.stats[provider]
+    
+    def record(self, provider, ok, latency):
+        """記錄一次呼叫結果"""
+        with self._lock:
+            stats = self._stats(provider)
+            stats['samples'].append((time.monotonic(), bool(ok), latency))
+            stats['calls'] += 1
+            stats['cost'] += self.costs.get(provider, 0.0)
+            if ok:
+                stats['consecutive_failures'] = 0
+                if stats['state'] != 'closed':
+                    # 探測成功：清除故障期間的紀錄，回到預設順序
+                    print(f"[INFO] {self.name} 識別服務 {provider} 已恢復")
+                    stats['samples'].clear()
+                    stats['samples'].append((time.monotonic(), True, latency))
+                stats['state'] = 'closed'
+                return
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+            if stats['state'] == 'half_open' or (
+                stats['state'] == 'closed' and stats['consecutive_failures'] >= self.failure_threshold
+            ):
+                stats['state'] = 'open'
+                stats['opened_at'] = time.monotonic()
+                print(f"[WARN] {self.name} 識別服務 {provider} 連續失敗 {stats['consecutive_failures']} 次，"
+                      f"暫停使用 {self.cooldown} 秒")
+                if self.metrics:
+                    self.metrics.incr(f"router.circuit_open.{self.name}.{provider}")
+    
+    def is_open(self, provider):
+        """斷路中（尚未到半開時間）"""
+        with self._lock:
+            stats = self.stats.get(provider)
+            return bool(stats and stats['state'] == 'open'
+                        and time.monotonic() - stats['opened_at'] < self.cooldown)
+    
+    def _recent(self, stats, now):
+        """stats_ttl 秒內的 (成功次數, 樣本數, 平均延遲)；過舊的紀錄不再影響排序"""
+        samples = [sample for sample in stats['samples'] if now - sample[0] <= self.stats_ttl]
+        if not samples:
+            return 0, 0, 0.0
+        return sum(ok for _, ok, _ in samples), len(samples), sum(latency for _, _, latency in samples) / len(samples)
+    
+    def _degraded(self, provider, stats, now):
+        successes, count, latency = self._recent(stats, now)
+        if count < self.min_samples:
+            return False
+        return successes / count < self.min_success_rate or latency > self.slow_latency.get(provider, float('inf'))
+    
+    def _expected_seconds(self, stats, now):
+        """每次成功預期花費的秒數（延遲／成功率），用於排序狀況不佳的服務"""
+        successes, count, latency = self._recent(stats, now)
+        return latency / ((successes + 1) / (count + 1))
+    
+    def order(self, providers):
+        """依健康狀態排序識別服務（輸入順序為預設優先順序），斷路中的服務不列入
+        
+        所有服務都在斷路中時，回傳最早斷路的服務作為探測，避免完全停擺。
+        """
+        if not self.enabled:
+            return list(providers)
+        healthy, degraded, suspended = [], [], []
+        now = time.monotonic()
+        with self._lock:
+            for provider in providers:
+                stats = self._stats(provider)
+                if stats['state'] == 'open':
+                    if now - stats['opened_at'] < self.cooldown:
+                        suspended.append((stats['opened_at'], provider))
+                        continue
+                    stats['state'] = 'half_open'
+                    stats['probe_at'] = None
+                    print(f"[INFO] {self.name} 識別服務 {provider} 進入半開狀態，嘗試探測")
+                if stats['state'] == 'half_open':
+                    # 每個冷卻期間只放行一次探測
+                    if stats['probe_at'] is not None and now - stats['probe_at'] < self.cooldown:
+                        suspended.append((stats['opened_at'], provider))
+                        continue
+                    stats['probe_at'] = now
+                    healthy.append(provider)
+                elif self._degraded(provider, stats, now):
+                    degraded.append((self._expected_seconds(stats, now), provider))
+                else:
+                    healthy.append(provider)
+        ordered = healthy + [provider for _, provider in sorted(degraded, key=lambda item: item[0])]
+        if not ordered and suspended:
+            ordered = [min(suspended)[1]]
+        return ordered
+    
+    def print_report(self):
+        """輸出各識別服務的呼叫次數、近期成功率、平均延遲、估計費用與斷路狀態"""
+        with self._lock:
+            stats_items = [(provider, stats) for provider, stats in self.stats.items() if stats['calls']]
+        if not stats_items:
+            return
+        print(f"\n=== 識別服務狀態（{self.name}）===")
+        now = time.monotonic()
+        for provider, stats in stats_items:
+            successes, count, latency = self._recent(stats, now)
+            success_rate = successes / count * 100 if count else 0.0
+            print(f"  {provider}: 呼叫 {stats['calls']} 次，失敗 {stats['failures']} 次，近期成功率 {success_rate:.0f}%，"
+                  f"平均 {latency:.2f} 秒，估計費用 ${stats['cost']:.4f}，狀態 {stats['state']}")
+
 class CaptchaResolver:
     """驗證碼解析器 - 支援Claude CLI和API兩種方式"""
     
-    def __init__(self, config):
+    PROVIDER_MESSAGES = {
+        'cli': "[INFO] 使用Claude CLI識別驗證碼（免費）...",
+        'openai': "[INFO] 使用OpenAI gpt-4o-mini識別驗證碼（最划算）...",
+        'anthropic': "[INFO] 使用Anthropic Claude識別驗證碼..."
+    }
+    
+    # 快取只保存登入成功確認過的答案，與識別服務及prompt無關
+    CACHE_VERSIONS = {'confirmed': 'v1'}
+    
+    def __init__(self, config, metrics=None):
         self.config = config
+        self.metrics = metrics or RunMetrics(config)
         self.anthropic_client = None
         self.openai_client = None
         self.use_claude_cli = config.get('captcha', {}).get('use_claude_cli', True)  # 默認使用CLI
         
+        # Claude CLI常駐程序池（第一次識別時在背景預先啟動，沿用登入狀態而不需識別時不啟動）
+        self.cli_pool = None
+        self._cli_prewarm_started = False
+        if self.use_claude_cli:
+            self.cli_pool = ClaudeCliPool(config)
+            if not self.cli_pool.is_available():
+                print("[WARN] 找不到Claude CLI，改用API識別")
+                self.use_claude_cli = False
+        
         # 從環境變數讀取API密鑰
         anthropic_key = os.getenv('ANTHROPIC_API_KEY')
         openai_key = os.getenv('OPENAI_API_KEY')
@@ -43,34 +1805,35 @@ class CaptchaResolver:
         if openai_key:
             self.openai_client = OpenAI(api_key=openai_key)
         
-        print(f"[INFO] 驗證碼識別方式: {'Claude CLI' if self.use_claude_cli else 'API'}")
-    
-    def save_captcha_image(self, image_data, filename):
-        """儲存驗證碼圖片"""
-        os.makedirs(self.config['captcha']['save_path'], exist_ok=True)
-        filepath = os.path.join(self.config['captcha']['save_path'], filename)
+        # 本地識別器（離線、最優先）
+        self.local_recognizer = None
+        if config.get('captcha', {}).get('local', {}).get('enabled', True):
+            self.local_recognizer = LocalCaptchaRecognizer(config)
         
-        if isinstance(image_data, bytes):
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-        else:
-            image_data.save(filepath)
+        # 送出前的圖片前處理（裁切、灰階、縮小、精簡編碼）
+        self.preprocessor = ImagePreprocessor(config)
         
-        print(f"驗證碼圖片已儲存: {filepath}")
-        return filepath
+        # 已確認答案的驗證碼快取（相同圖片直接使用答案）
+        self.cache = RecognitionCache(config, self.metrics)
+        
+        # 依各識別服務的健康狀態調整順序
+        self.router = ProviderRouter(config, 'captcha', self.metrics)
+        
+        print(f"[INFO] 驗證碼識別方式: {'Claude CLI' if self.use_claude_cli else 'API'}")
     
-    def image_to_base64(self, image_path):
-        """將圖片轉換為base64編碼"""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+    def as_payload(self, image):
+        """將檔案路徑轉為ImagePayload（已是ImagePayload則直接回傳）"""
+        if isinstance(image, ImagePayload):
+            return image
+        return ImagePayload.from_file(image)
     
-    def recognize_captcha_with_anthropic(self, image_path):
+    def recognize_captcha_with_anthropic(self, image):
         """使用Claude API識別驗證碼"""
         if not self.anthropic_client:
             return None
         
         try:
-            image_base64 = self.image_to_base64(image_path)
+            payload = self.preprocessor.prepare(self.as_payload(image), 'captcha', 'anthropic')
             
             message = self.anthropic_client.messages.create(
                 model="claude-3-5-sonnet-20241022",
@@ -87,8 +1850,8 @@ class CaptchaResolver:
                                 "type": "image",
                                 "source": {
                                     "type": "base64",
-                                    "media_type": "image/png",
-                                    "data": image_base64
+                                    "media_type": payload.media_type,
+                                    "data": payload.base64
                                 }
                             }
                         ]
@@ -104,13 +1867,13 @@ class CaptchaResolver:
             print(f"Claude API識別失敗: {e}")
             return None
     
-    def recognize_captcha_with_openai(self, image_path):
+    def recognize_captcha_with_openai(self, image):
         """使用OpenAI API識別驗證碼（使用最划算的gpt-4o-mini模型）"""
         if not self.openai_client:
             return None
         
         try:
-            image_base64 = self.image_to_base64(image_path)
+            payload = self.preprocessor.prepare(self.as_payload(image), 'captcha', 'openai')
             
             response = self.openai_client.chat.completions.create(
                 model="gpt-4o-mini",  # 使用最划算的模型
@@ -125,7 +1888,7 @@ class CaptchaResolver:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}"
+                                    "url": f"data:{payload.media_type};base64,{payload.base64}"
                                 }
                             }
                         ]
@@ -142,103 +1905,750 @@ class CaptchaResolver:
             print(f"OpenAI API識別失敗: {e}")
             return None
     
-    def recognize_captcha_with_cli(self, image_path):
-        """使用Claude CLI識別驗證碼"""
-        try:
-            # 構建識別prompt
-            image_path = os.path.abspath(image_path)
-            prompt = f'請使用Read工具讀取驗證碼圖片文件: "{image_path}" 然後識別其中的驗證碼內容。只回答驗證碼的數字或字母，不要其他說明。'
-            
-            # 調用Claude CLI
-            import subprocess
-            process = subprocess.Popen([
-                'cmd', '/c', 'claude', 
-                '--print', 
-                '--output-format', 'text', 
-                prompt
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='cp950',
-            errors='replace',
-            cwd=os.path.dirname(image_path)
-            )
-            
-            stdout, stderr = process.communicate(timeout=45)
+    def recognize_captcha_with_local(self, image):
+        """使用本地樣板識別驗證碼，信心值不足時回傳None交由LLM識別"""
+        if not self.local_recognizer:
+            return None
+        try:
+            captcha_text, confidence = self.local_recognizer.recognize(image)
+        except Exception as e:
+            print(f"本地識別失敗: {e}")
+            return None
+        
+        if captcha_text and confidence >= self.local_recognizer.min_confidence:
+            print(f"本地識別驗證碼: {captcha_text} (信心值 {confidence:.2f})")
+            return captcha_text
+        if captcha_text:
+            print(f"[INFO] 本地識別信心值不足: {captcha_text} ({confidence:.2f})")
+        return None
+    
+    def confirm_captcha(self, image, captcha_text):
+        """登入成功後回報正確的驗證碼答案，作為本地識別器的訓練資料並寫入快取"""
+        if self.local_recognizer:
+            self.local_recognizer.add_sample(image, captcha_text)
+        self.cache.put('captcha', self.as_payload(image), 'confirmed', self.CACHE_VERSIONS['confirmed'], captcha_text)
+    
+    def recognize_captcha_with_cli(self, image, cancel_event=None):
+        """使用常駐的Claude CLI識別驗證碼（cancel_event被設定時會終止該次請求）"""
+        if not self.cli_pool:
+            return None
+        try:
+            payload = self.preprocessor.prepare(self.as_payload(image), 'captcha', 'cli')
+            content = [
+                {
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": payload.media_type, "data": payload.base64}
+                },
+                {
+                    "type": "text",
+                    "text": "請識別這個驗證碼圖片中的文字或數字。只回答驗證碼的數字或字母，不要其他說明。"
+                }
+            ]
             
-            if process.returncode == 0 and stdout.strip():
-                # 解析回應
-                import re
-                response = stdout.strip()
-                print(f"Claude CLI識別回應: {response}")
-                
-                # 驗證碼格式匹配
-                patterns = [
-                    r'\b[A-Z0-9]{4,6}\b',    # 4-6位大寫字母或數字
-                    r'\b[0-9]{4,6}\b',       # 4-6位純數字  
-                    r'\b[A-Za-z0-9]{3,8}\b'  # 3-8位混合
-                ]
-                
-                excluded_words = {'read', 'tool', 'file', 'image', 'captcha', 'code', 'text'}
-                
-                for pattern in patterns:
-                    matches = re.findall(pattern, response, re.IGNORECASE)
-                    for match in matches:
-                        if match.lower() not in excluded_words:
-                            print(f"Claude CLI識別驗證碼: {match}")
-                            return match
-                
-                return None
-            else:
-                print(f"Claude CLI執行失敗: {stderr}")
+            response = self.cli_pool.request(content, cancel_event)
+            if not response:
                 return None
+            print(f"Claude CLI識別回應: {response}")
+            
+            # 驗證碼格式匹配
+            patterns = [
+                r'\b[A-Z0-9]{4,6}\b',    # 4-6位大寫字母或數字
+                r'\b[0-9]{4,6}\b',       # 4-6位純數字  
+                r'\b[A-Za-z0-9]{3,8}\b'  # 3-8位混合
+            ]
+            
+            excluded_words = {'read', 'tool', 'file', 'image', 'captcha', 'code', 'text'}
+            
+            for pattern in patterns:
+                matches = re.findall(pattern, response, re.IGNORECASE)
+                for match in matches:
+                    if match.lower() not in excluded_words:
+                        print(f"Claude CLI識別驗證碼: {match}")
+                        return match
+            
+            return None
                 
         except Exception as e:
             print(f"Claude CLI識別失敗: {e}")
             return None
-
-    def recognize_captcha(self, image_path):
-        """識別驗證碼（按成本效益順序：Claude CLI > OpenAI > Anthropic）"""
+    
+    def close(self):
+        """結束Claude CLI常駐程序並關閉辨識快取"""
+        if self.cli_pool:
+            self.cli_pool.close()
+        self.cache.close()
+    
+    def validate_captcha_text(self, text):
+        """檢查識別結果是否符合驗證碼格式，回傳清理後的驗證碼或None"""
+        if not text:
+            return None
+        candidate = text.strip().strip('"\'`.,:;。：「」')
+        tokens = candidate.split()
+        # 允許以空白分隔的單一字元（如 "A B 1 2"），其他含空白的回應視為說明文字
+        if len(tokens) > 1 and all(len(token) == 1 for token in tokens):
+            candidate = ''.join(tokens)
+        if re.fullmatch(r'[A-Za-z0-9]{3,8}', candidate):
+            return candidate
+        return None
+    
+    def call_provider(self, name, func, image, cancel_event=None):
+        """呼叫單一識別方式並記錄耗時與失敗次數（本地識別以外的結果回報給路由）"""
+        args = (image, cancel_event) if cancel_event is not None else (image,)
+        start = time.perf_counter()
+        with self.metrics.span(f"captcha_recognize:{name}") as span:
+            result = func(*args)
+            span['ok'] = bool(result)
+        if not result:
+            self.metrics.incr(f"provider_failures.{name}")
+        # 競速中被取消的呼叫不代表服務狀況
+        if name != 'local' and not (cancel_event is not None and cancel_event.is_set() and not result):
+            self.router.record(name, bool(result), time.perf_counter() - start)
+        return result
+    
+    def get_captcha_providers(self):
+        """取得目前可用的識別方式：本地識別最先，其餘依路由的健康狀態排序
         
-        # 第一優先：Claude CLI（免費）
+        預設順序為成本效益（Claude CLI免費最先），付費API中 api.preferred_provider 優先。
+        """
+        providers = {}
         if self.use_claude_cli:
-            print("[INFO] 使用Claude CLI識別驗證碼（免費）...")
-            result = self.recognize_captcha_with_cli(image_path)
-            if result:
-                return result
-            print("[WARN] Claude CLI識別失敗，嘗試使用OpenAI API...")
+            providers['cli'] = self.recognize_captcha_with_cli
+        preferred = self.config.get('api', {}).get('preferred_provider', 'openai')
+        api_providers = {'openai': self.openai_client, 'anthropic': self.anthropic_client}
+        for name in [preferred] + [name for name in ('openai', 'anthropic') if name != preferred]:
+            if api_providers.get(name):
+                providers[name] = getattr(self, f"recognize_captcha_with_{name}")
         
-        # 第二優先：OpenAI gpt-4o-mini（最划算的API）
-        if self.openai_client:
-            print("[INFO] 使用OpenAI gpt-4o-mini識別驗證碼（最划算）...")
-            result = self.recognize_captcha_with_openai(image_path)
-            if result:
-                return result
-            print("[WARN] OpenAI識別失敗，嘗試使用Anthropic API...")
+        ordered = []
+        if self.local_recognizer and self.local_recognizer.is_ready():
+            ordered.append(('local', self.recognize_captcha_with_local))
+        ordered.extend((name, providers[name]) for name in self.router.order(list(providers)))
+        return ordered
+    
+    def recognize_captcha_race(self, image):
+        """同時向多個識別方式發送驗證碼，採用第一個通過格式檢查的結果
+        
+        依 captcha.race.start_delays_ms 的成本策略延後啟動付費API：
+        若較便宜的方式在延遲時間內沒有回應才啟動下一個；
+        某個方式失敗時，立即啟動下一個尚未開始的方式。本地識別在競速開始前同步執行，不參與競速。
+        """
+        race_config = self.config.get('captcha', {}).get('race', {})
+        start_delays = race_config.get('start_delays_ms', {})
+        race_timeout = race_config.get('timeout', 60)
+        
+        providers = self.get_captcha_providers()
+        # 本地識別只需數毫秒，先同步執行；信心不足時的放棄不算失敗，不會讓付費API提前啟動
+        if providers and providers[0][0] == 'local':
+            _, local = providers.pop(0)
+            captcha_text = self.validate_captcha_text(self.call_provider('local', local, image))
+            if captcha_text:
+                print(f"[SUCCESS] 本地識別驗證碼: {captcha_text}")
+                return captcha_text
+        if not providers:
+            print("[ERROR] 沒有可用的驗證碼識別方式")
+            return None
         
-        # 第三優先：Anthropic Claude（較貴的備援）
-        if self.anthropic_client:
-            print("[INFO] 使用Anthropic Claude識別驗證碼（備援）...")
-            result = self.recognize_captcha_with_anthropic(image_path)
+        race_start = time.monotonic()
+        waiting = sorted(
+            ((race_start + start_delays.get(name, 0) / 1000.0, name, func) for name, func in providers),
+            key=lambda item: item[0]
+        )
+        cancel_event = threading.Event()
+        results = queue.Queue()
+        
+        def run(name, func):
+            try:
+                text = self.call_provider(name, func, image, cancel_event if name == 'cli' else None)
+            except Exception as e:
+                print(f"[WARN] {name} 識別時發生錯誤: {e}")
+                text = None
+            results.put((name, text))
+        
+        def start(name, func):
+            print(f"[INFO] 競速識別：啟動 {name}（{(time.monotonic() - race_start) * 1000:.0f} ms）")
+            threading.Thread(target=run, args=(name, func), daemon=True).start()
+        
+        running = 0
+        deadline = race_start + race_timeout
+        try:
+            while waiting or running:
+                now = time.monotonic()
+                # 啟動已到時間的識別方式；若沒有任何方式在執行中，直接啟動下一個
+                while waiting and (waiting[0][0] <= now or running == 0):
+                    _, name, func = waiting.pop(0)
+                    start(name, func)
+                    running += 1
+                
+                wait_until = min(deadline, waiting[0][0]) if waiting else deadline
+                if now >= deadline:
+                    print(f"[ERROR] 競速識別逾時 ({race_timeout} 秒)")
+                    return None
+                try:
+                    name, text = results.get(timeout=max(wait_until - now, 0.01))
+                except queue.Empty:
+                    continue
+                
+                running -= 1
+                captcha_text = self.validate_captcha_text(text)
+                if captcha_text:
+                    elapsed_ms = (time.monotonic() - race_start) * 1000
+                    print(f"[SUCCESS] 競速識別由 {name} 勝出: {captcha_text}（{elapsed_ms:.0f} ms）")
+                    return captcha_text
+                
+                print(f"[WARN] {name} 未提供有效驗證碼: {text!r}")
+                if waiting:
+                    # 失敗時提前啟動下一個識別方式
+                    _, next_name, next_func = waiting.pop(0)
+                    start(next_name, next_func)
+                    running += 1
+            
+            print("[ERROR] 所有識別方法都失敗了")
+            return None
+        finally:
+            # 通知其他仍在執行的識別方式停止（CLI程序會被終止，API結果將被忽略）
+            cancel_event.set()
+    
+    def prewarm_cli(self):
+        """在背景啟動Claude CLI程序池（只執行一次），與本地識別同時進行"""
+        if not self.use_claude_cli or not self.cli_pool or self._cli_prewarm_started:
+            return
+        self._cli_prewarm_started = True
+        threading.Thread(target=self.cli_pool.prewarm, name="cli-prewarm", daemon=True).start()
+    
+    def recognize_captcha(self, image):
+        """識別驗證碼（本地識別 > 依健康狀態排序的Claude CLI／OpenAI／Anthropic）
+        
+        Args:
+            image: 圖片檔案路徑或ImagePayload，只讀取／編碼一次並由各識別方式共用
+        """
+        image = self.as_payload(image)
+        
+        cached, _ = self.cache.get('captcha', image, self.CACHE_VERSIONS)
+        if cached:
+            print(f"[INFO] 驗證碼快取命中: {cached}")
+            return cached
+        
+        self.prewarm_cli()
+        if self.config.get('captcha', {}).get('race', {}).get('enabled', False):
+            return self.recognize_captcha_race(image)
+        
+        # 依序嘗試：本地識別（離線、毫秒級，信心值足夠才採用），其餘依路由排序
+        for name, func in self.get_captcha_providers():
+            if name in self.PROVIDER_MESSAGES:
+                print(self.PROVIDER_MESSAGES[name])
+            result = self.call_provider(name, func, image)
             if result:
                 return result
-            print("[ERROR] 所有識別方法都失敗了")
+            if name != 'local':
+                print(f"[WARN] {name} 識別失敗，嘗試下一個識別方式...")
+        
+        print("[ERROR] 所有識別方法都失敗了")
+        return None
+
+class TokenBucket:
+    """令牌桶限流器（asyncio）- 每秒補充rate個令牌，最多累積capacity個"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """取得一個令牌，不足時等待補充"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AsyncAnalysisEngine:
+    """非同步考卷分析引擎 - 以非同步API客戶端同時分析多張圖片
+    
+    以 analysis.concurrency 限制同時進行的請求數，每個API各有令牌桶限流，
+    失敗時指數退避重試，連續失敗的API由ProviderRouter暫停，結果依送入順序回傳。
+    
+    所有分析在引擎自己的背景事件迴圈中執行：API客戶端、令牌桶與並行上限在引擎存續期間共用，
+    因此限流對所有學生、所有呼叫執行緒（批改管線、並行worker）一體適用，連線也能重複使用。
+    """
+    
+    DEFAULT_PROMPT = "請閱讀這張學生考卷的作答圖片，完整轉錄學生的作答內容（文字、算式與答案）。只回答轉錄內容，不要其他說明。"
+    
+    # 不需重試的錯誤（請求本身有問題）
+    NON_RETRYABLE_STATUS = {400, 401, 403, 404}
+    
+    def __init__(self, config, metrics=None):
+        self.metrics = metrics or RunMetrics(config)
+        analysis_config = config.get('analysis', {})
+        api_config = config.get('api', {})
+        self.prompt = analysis_config.get('prompt', self.DEFAULT_PROMPT)
+        self.concurrency = analysis_config.get('concurrency', 4)
+        self.max_retries = analysis_config.get('max_retries', 3)
+        self.backoff_base = analysis_config.get('backoff_base', 1.0)
+        self.max_tokens = analysis_config.get('max_tokens', 1000)
+        self.rate_limits = analysis_config.get('rate_limits', {})
+        self.preprocessor = ImagePreprocessor(config)
+        self.cache = RecognitionCache(config, self.metrics)
+        self.router = ProviderRouter(config, 'analysis', self.metrics)
+        self.openai_model = api_config.get('openai_model', 'gpt-4o-mini')
+        self.anthropic_model = api_config.get('anthropic_model', 'claude-3-5-sonnet-20241022')
+        
+        self.api_keys = {
+            'openai': os.getenv('OPENAI_API_KEY'),
+            'anthropic': os.getenv('ANTHROPIC_API_KEY')
+        }
+        # 優先使用 api.preferred_provider，其餘作為備援
+        preferred = api_config.get('preferred_provider', 'openai')
+        order = [preferred] + [name for name in ('openai', 'anthropic') if name != preferred]
+        self.providers = [name for name in order if self.api_keys.get(name)]
+        
+        # 背景事件迴圈與其上共用的客戶端、令牌桶、semaphore（第一次分析時建立）
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self._clients = None
+        self._buckets = None
+        self._semaphore = None
+    
+    def cache_versions(self):
+        """各識別服務的prompt版本（prompt、模型或前處理設定改變時快取失效）"""
+        models = {'openai': self.openai_model, 'anthropic': self.anthropic_model}
+        return {
+            provider: RecognitionCache.prompt_version(
+                self.prompt, models.get(provider), sorted(self.preprocessor.settings_for('exam', provider).items())
+            )
+            for provider in self.providers
+        }
+    
+    def is_available(self):
+        """是否有可用的API"""
+        return bool(self.providers)
+    
+    async def _call_openai(self, client, payload):
+        response = await client.chat.completions.create(
+            model=self.openai_model,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": self.prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:{payload.media_type};base64,{payload.base64}"}}
+                ]
+            }],
+            max_tokens=self.max_tokens
+        )
+        return response.choices[0].message.content.strip()
+    
+    async def _call_anthropic(self, client, payload):
+        message = await client.messages.create(
+            model=self.anthropic_model,
+            max_tokens=self.max_tokens,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": self.prompt},
+                    {"type": "image", "source": {"type": "base64", "media_type": payload.media_type, "data": payload.base64}}
+                ]
+            }]
+        )
+        return message.content[0].text.strip()
+    
+    async def _analyze_one(self, index, image, clients, buckets):
+        """分析單張圖片：依序嘗試各API，每個API失敗時退避重試"""
+        payload = image if isinstance(image, ImagePayload) else ImagePayload.from_file(image)
+        versions = self.cache_versions()
+        cached, cached_provider = self.cache.get('exam', payload, versions)
+        if cached is not None:
+            print(f"[INFO] 第 {index + 1} 張圖片使用快取結果（{cached_provider}）")
+            return cached
         
+        # 依健康狀態排序（預設順序為 api.preferred_provider 優先），斷路中的服務略過
+        for provider in self.router.order(self.providers):
+            call = self._call_openai if provider == 'openai' else self._call_anthropic
+            # 前處理在執行緒中進行，避免大圖阻塞事件迴圈
+            prepared = await asyncio.get_running_loop().run_in_executor(
+                None, self.preprocessor.prepare, payload, 'exam', provider
+            )
+            for attempt in range(self.max_retries):
+                if attempt > 0 and self.router.is_open(provider):
+                    print(f"[INFO] 第 {index + 1} 張圖片：{provider} 已暫停使用，改用下一個服務")
+                    break
+                await buckets[provider].acquire()
+                if attempt > 0:
+                    self.metrics.incr("analysis_retries")
+                start = time.perf_counter()
+                try:
+                    result = await call(clients[provider], prepared)
+                    self.metrics.record_span(f"analysis:{provider}", time.perf_counter() - start, True)
+                    self.router.record(provider, True, time.perf_counter() - start)
+                    self.cache.put('exam', payload, provider, versions[provider], result)
+                    print(f"[INFO] 第 {index + 1} 張圖片分析完成（{provider}）")
+                    return result
+                except Exception as e:
+                    self.metrics.record_span(f"analysis:{provider}", time.perf_counter() - start, False)
+                    self.router.record(provider, False, time.perf_counter() - start)
+                    self.metrics.incr(f"provider_failures.analysis_{provider}")
+                    status = getattr(e, 'status_code', None)
+                    print(f"[WARN] 第 {index + 1} 張圖片 {provider} 分析失敗（第 {attempt + 1} 次）: {e}")
+                    if status in self.NON_RETRYABLE_STATUS:
+                        break
+                    if attempt + 1 < self.max_retries:
+                        await asyncio.sleep(self.backoff_base * (2 ** attempt) + random.uniform(0, self.backoff_base))
+        print(f"[ERROR] 第 {index + 1} 張圖片分析失敗")
         return None
+    
+    def create_clients(self):
+        """建立各API的非同步客戶端（引擎存續期間共用，close時關閉）"""
+        clients = {}
+        if 'openai' in self.providers:
+            clients['openai'] = AsyncOpenAI(api_key=self.api_keys['openai'])
+        if 'anthropic' in self.providers:
+            clients['anthropic'] = AsyncAnthropic(api_key=self.api_keys['anthropic'])
+        return clients
+    
+    def _ensure_shared(self):
+        """在引擎事件迴圈中建立共用的客戶端、令牌桶與semaphore（只建立一次）"""
+        if self._clients is None:
+            self._clients = self.create_clients()
+            self._buckets = {
+                name: TokenBucket(
+                    self.rate_limits.get(name, {}).get('rate', 5),
+                    self.rate_limits.get(name, {}).get('burst', 5)
+                )
+                for name in self.providers
+            }
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._clients, self._buckets, self._semaphore
+    
+    async def analyze(self, images):
+        """分析圖片串流（一般或非同步iterable），回傳與送入順序相同的結果清單（失敗為None）
+        
+        必須在引擎的事件迴圈中執行（由analyze_sync排程），共用的令牌桶與semaphore綁定該迴圈。
+        """
+        # 以共用的semaphore限制所有呼叫合計的同時請求數，同時對輸入串流形成背壓
+        clients, buckets, semaphore = self._ensure_shared()
+        tasks = []
+        
+        async def worker(index, image):
+            try:
+                return await self._analyze_one(index, image, clients, buckets)
+            finally:
+                semaphore.release()
+        
+        # 同一批中內容相同的圖片（例如空白考卷）只分析一次
+        inflight = {}
+        
+        async def submit(image):
+            payload = image if isinstance(image, ImagePayload) else ImagePayload.from_file(image)
+            content_hash = RecognitionCache.content_hash(payload)
+            if content_hash in inflight:
+                tasks.append(inflight[content_hash])
+                return
+            await semaphore.acquire()
+            task = asyncio.create_task(worker(len(tasks), payload))
+            inflight[content_hash] = task
+            tasks.append(task)
+        
+        if hasattr(images, '__aiter__'):
+            async for image in images:
+                await submit(image)
+        else:
+            for image in images:
+                await submit(image)
+        return list(await asyncio.gather(*tasks))
+    
+    def _ensure_loop(self):
+        """啟動引擎的背景事件迴圈（只啟動一次）"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="analysis-loop", daemon=True)
+                self._loop_thread.start()
+            return self._loop
+    
+    def analyze_sync(self, images):
+        """同步介面（可由多個執行緒同時呼叫）：在引擎的事件迴圈中執行analyze並等待結果"""
+        future = asyncio.run_coroutine_threadsafe(self.analyze(images), self._ensure_loop())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+    
+    def close(self):
+        """關閉共用的API客戶端、背景事件迴圈與辨識快取"""
+        with self._loop_lock:
+            loop, thread, clients = self._loop, self._loop_thread, self._clients
+            self._loop = self._loop_thread = self._clients = None
+            self._buckets = self._semaphore = None
+        if loop is not None:
+            async def close_clients():
+                for client in (clients or {}).values():
+                    await client.close()
+            try:
+                asyncio.run_coroutine_threadsafe(close_clients(), loop).result(timeout=10)
+            except Exception as e:
+                print(f"[WARN] 關閉分析API客戶端失敗: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=5)
+            loop.close()
+        self.cache.close()
+
+class JobLedger:
+    """批改工作帳本（SQLite）- 記錄每個(題號, 學校, 學生)工作的狀態、圖片與識別結果
+    
+    重新執行時略過已完成的工作，只重試失敗（且未超過重試上限）的工作。
+    寫入先累積在記憶體，達到 batch_size 或超過 flush_interval 秒時以單一交易寫入；
+    查詢使用記憶體中的狀態，不需讀取資料庫。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            question_number INTEGER NOT NULL,
+            school_index INTEGER NOT NULL,
+            student TEXT NOT NULL,
+            student_index INTEGER,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            images TEXT,
+            results TEXT,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (question_number, school_index, student)
+        )
+    """
+    
+    UPSERT = """
+        INSERT INTO jobs (question_number, school_index, student, student_index, status, attempts,
+                          images, results, error, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (question_number, school_index, student) DO UPDATE SET
+            student_index = excluded.student_index, status = excluded.status, attempts = excluded.attempts,
+            images = excluded.images, results = excluded.results, error = excluded.error,
+            updated_at = excluded.updated_at
+    """
+    
+    def __init__(self, config):
+        ledger_config = config.get('ledger', {})
+        self.enabled = ledger_config.get('enabled', True)
+        self.path = ledger_config.get('path', './cache/ledger.sqlite3')
+        self.batch_size = ledger_config.get('batch_size', 20)
+        self.flush_interval = ledger_config.get('flush_interval', 10)
+        self.max_attempts = ledger_config.get('max_attempts', 3)
+        self.jobs = {}
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._connection = None
+        if self.enabled:
+            self._open()
+    
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(self.SCHEMA)
+        self._connection.commit()
+        for row in self._connection.execute(
+            "SELECT question_number, school_index, student, student_index, status, attempts, images, results, error FROM jobs"
+        ):
+            question_number, school_index, student, student_index, status, attempts, images, results, error = row
+            # 上次執行中斷時仍在進行的工作視為失敗
+            if status == 'running':
+                status = 'failed'
+                error = error or 'interrupted'
+            self.jobs[(question_number, school_index, student)] = {
+                'question_number': question_number,
+                'school_index': school_index,
+                'student': student,
+                'student_index': student_index,
+                'status': status,
+                'attempts': attempts,
+                'images': json.loads(images) if images else [],
+                'results': json.loads(results) if results else [],
+                'error': error
+            }
+        if self.jobs:
+            counts = Counter(job['status'] for job in self.jobs.values())
+            print(f"[INFO] 已載入工作帳本 {self.path}: 完成 {counts['done']}、失敗 {counts['failed']}")
+    
+    @staticmethod
+    def student_key(student_id):
+        """學生識別鍵：學生ID（同一次執行中重複的ID已改為考卷網址，見AutoGrader._assign_student_ids）"""
+        return str(student_id)
+    
+    def get(self, question_number, school_index, student):
+        with self._lock:
+            return self.jobs.get((question_number, school_index, student))
+    
+    def should_run(self, question_number, school_index, student):
+        """工作是否需要執行：未完成且失敗次數未達上限"""
+        if not self.enabled:
+            return True
+        job = self.get(question_number, school_index, student)
+        if job is None:
+            return True
+        if job['status'] == 'done':
+            return False
+        return job['attempts'] < self.max_attempts
+    
+    def start(self, question_number, school_index, student, student_index=None):
+        """標記工作開始執行（嘗試次數加一）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            job = self.jobs.setdefault((question_number, school_index, student), {
+                'question_number': question_number,
+                'school_index': school_index,
+                'student': student,
+                'images': [],
+                'results': [],
+                'attempts': 0
+            })
+            job.update({'student_index': student_index, 'status': 'running', 'error': None})
+            job['attempts'] += 1
+            self._queue(job)
+    
+    def finish(self, question_number, school_index, student, job_result, error=None):
+        """記錄工作結果（圖片路徑與雜湊、識別結果），ok為假或有錯誤時標記為失敗"""
+        if not self.enabled:
+            return
+        images = []
+        for image in job_result.get('images', []):
+            if isinstance(image, ImagePayload):
+                images.append({
+                    'name': image.name,
+                    'path': image.path,
+                    'media_type': image.media_type,
+                    'sha256': hashlib.sha256(image.view).hexdigest()
+                })
+            else:
+                images.append({'path': str(image)})
+        with self._lock:
+            job = self.jobs.get((question_number, school_index, student))
+            if job is None:
+                return
+            job.update({
+                'status': 'done' if job_result.get('ok') and not error else 'failed',
+                'images': images,
+                'results': job_result.get('results', []),
+                'error': error
+            })
+            self._queue(job)
+    
+    def _queue(self, job):
+        """加入待寫入清單，達到批次大小或時間間隔時寫入（呼叫端需持有鎖）"""
+        self._pending[(job['question_number'], job['school_index'], job['student'])] = (
+            job['question_number'], job['school_index'], job['student'], job.get('student_index'),
+            job['status'], job['attempts'],
+            json.dumps(job['images'], ensure_ascii=False),
+            json.dumps(job['results'], ensure_ascii=False, default=str),
+            job.get('error'), time.time()
+        )
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush_locked()
+    
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._pending or not self._connection:
+            return
+        rows = list(self._pending.values())
+        try:
+            with self._connection:
+                self._connection.executemany(self.UPSERT, rows)
+            self._pending.clear()
+        except sqlite3.Error as e:
+            print(f"[WARN] 寫入工作帳本失敗: {e}")
+    
+    def flush(self):
+        """立即寫入所有待寫入的紀錄"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._flush_locked()
+    
+    def close(self):
+        """寫入剩餘紀錄並關閉資料庫"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._flush_locked()
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+    
+    def print_summary(self):
+        """輸出各狀態工作數"""
+        if not self.enabled:
+            return
+        with self._lock:
+            counts = Counter(job['status'] for job in self.jobs.values())
+            exhausted = sum(
+                1 for job in self.jobs.values()
+                if job['status'] != 'done' and job['attempts'] >= self.max_attempts
+            )
+        print("\n=== 工作帳本 ===")
+        print(f"  完成: {counts['done']}  失敗: {counts['failed']}  執行中: {counts['running']}  已達重試上限: {exhausted}")
 
 class AutoGrader:
-    def __init__(self, config_file="config.json"):
-        """初始化自動改考卷系統"""
+    def __init__(self, config_file="config.json", worker_id=None, captcha_resolver=None, selectors=None, metrics=None,
+                 ledger=None, analysis_engine=None):
+        """初始化自動改考卷系統
+        
+        Args:
+            config_file (str): 配置檔案路徑
+            worker_id (int): 並行模式下的worker編號，用於分配獨立的除錯埠與瀏覽器設定檔
+            captcha_resolver (CaptchaResolver): 共用的驗證碼解析器（並行模式下由各worker共用）
+            selectors (SelectorRegistry): 共用的選擇器快取（並行模式下由各worker共用）
+            metrics (RunMetrics): 共用的執行指標（並行模式下由各worker共用）
+            ledger (JobLedger): 共用的工作帳本（並行模式下由各worker共用）
+            analysis_engine (AsyncAnalysisEngine): 共用的分析引擎（並行模式下共用限流與API連線）
+        """
         self.config = self.load_config(config_file)
+        self.worker_id = worker_id
         self.driver = None
         self.wait = None
-        self.captcha_resolver = None
+        self.waits = None
+        self.screenshots = None
+        self.captcha_resolver = captcha_resolver
+        self._owns_captcha_resolver = captcha_resolver is None
+        self.selectors = selectors
+        self.metrics = metrics
+        self.ledger = ledger
+        self.session_store = None
+        self.downloader = None
+        self.image_sink = None
+        self.prefetcher = None
+        self.analysis_engine = analysis_engine
+        self._owns_analysis_engine = analysis_engine is None
+        self.dashboard_url = None
+        self.dashboard_index = None  # index_dashboard 建立的 (題號, 學校索引) → 題目卡片 對照表
+        self.student_entries = []  # iter_student_exams 找到的學生（student_id, url, page）
+        self._seen_student_ids = set()  # 本次列表已使用的學生ID（偵測重複）
         
         if self.config:
-            self.captcha_resolver = CaptchaResolver(self.config)
-        
-    def load_config(self, config_file):
+            if self.metrics is None:
+                self.metrics = RunMetrics(self.config)
+            if self.captcha_resolver is None:
+                self.captcha_resolver = CaptchaResolver(self.config, self.metrics)
+            if self.selectors is None:
+                self.selectors = SelectorRegistry(self.config, self.metrics)
+            if self.ledger is None:
+                self.ledger = JobLedger(self.config)
+            self.session_store = SessionStore(self.config)
+            self.downloader = ImageDownloader(self.config)
+            self.image_sink = ImageSink(self.config)
+            self.prefetcher = ExamPrefetcher(self.config, self.downloader, self.image_sink, self.metrics)
+            if self.analysis_engine is None:
+                self.analysis_engine = AsyncAnalysisEngine(self.config, self.metrics)
+    
+    @staticmethod
+    def load_config(config_file):
         """載入配置檔案"""
         try:
             with open(config_file, 'r', encoding='utf-8') as f:
@@ -250,6 +2660,7 @@ class AutoGrader:
             print(f"配置檔案格式錯誤: {config_file}")
             return None
     
+    @timed('setup_driver')
     def setup_driver(self):
         """設置Chrome瀏覽器驅動"""
         chrome_options = Options()
@@ -260,21 +2671,104 @@ class AutoGrader:
         # 解決瀏覽器會話衝突問題
         chrome_options.add_argument("--no-sandbox")
         chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--remote-debugging-port=9222")
-        chrome_options.add_argument("--user-data-dir=C:\\temp\\chrome_user_data")
+        browser_config = self.config.get('browser', {})
+        debug_port = browser_config.get('debug_port', 9222)
+        user_data_dir = browser_config.get('user_data_dir', "C:\\temp\\chrome_user_data")
+        if self.worker_id is not None:
+            # 並行模式：每個worker使用獨立的除錯埠與設定檔，避免瀏覽器互相衝突
+            debug_port += self.worker_id
+            user_data_dir = f"{user_data_dir}_worker{self.worker_id}"
+        chrome_options.add_argument(f"--remote-debugging-port={debug_port}")
+        chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+        
+        performance_profile = browser_config.get('profile', 'default') == 'performance'
+        if performance_profile:
+            self.apply_performance_options(chrome_options)
         
         try:
             self.driver = webdriver.Chrome(options=chrome_options)
             self.driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+            if performance_profile:
+                self.apply_performance_cdp()
             self.wait = WebDriverWait(self.driver, self.config['settings']['timeout'])
+            self.waits = WaitEngine(self.driver, self.config, self.metrics)
+            self.screenshots = ScreenshotEngine(self.driver, self.config, self.metrics)
             print("Chrome瀏覽器驅動設置成功")
             return True
         except Exception as e:
             print(f"瀏覽器驅動設置失敗: {e}")
             return False
     
+    # 效能模式下關閉的瀏覽器功能
+    PERFORMANCE_ARGUMENTS = [
+        "--disable-extensions",
+        "--disable-background-networking",
+        "--disable-background-timer-throttling",
+        "--disable-renderer-backgrounding",
+        "--disable-sync",
+        "--disable-default-apps",
+        "--disable-component-update",
+        "--disable-notifications",
+        "--no-first-run",
+        "--mute-audio",
+        "--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication",
+    ]
+    
+    DEFAULT_BLOCK_PATTERNS = [
+        "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+        "*.mp4", "*.webm", "*.mp3", "*.ico",
+        "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+        "*facebook.net*", "*connect.facebook.*", "*hotjar.com*",
+    ]
+    
+    def apply_performance_options(self, chrome_options):
+        """效能模式：無頭、固定視窗大小、關閉非必要功能"""
+        performance_config = self.config.get('browser', {}).get('performance', {})
+        if performance_config.get('headless', True):
+            chrome_options.add_argument("--headless=new")
+        width, height = performance_config.get('window_size', [1366, 900])
+        chrome_options.add_argument(f"--window-size={width},{height}")
+        for argument in self.PERFORMANCE_ARGUMENTS:
+            chrome_options.add_argument(argument)
+        # DOMContentLoaded即返回，其餘就緒條件交給WaitEngine判斷
+        chrome_options.page_load_strategy = performance_config.get('page_load_strategy', 'eager')
+    
+    def blocked_url_patterns(self):
+        """計算要封鎖的網址樣式（排除會擋到白名單網址的樣式）"""
+        performance_config = self.config.get('browser', {}).get('performance', {})
+        patterns = list(performance_config.get('block_url_patterns', self.DEFAULT_BLOCK_PATTERNS))
+        if performance_config.get('block_stylesheets', False):
+            patterns.append("*.css")
+        allow_patterns = performance_config.get('allow_url_patterns', ["*NewCode.php*"])
+        
+        # CDP的封鎖清單不支援例外規則，因此移除任何會符合白名單樣式的封鎖樣式
+        blocked = []
+        for pattern in patterns:
+            conflicts = [allow for allow in allow_patterns if fnmatch.fnmatch(allow.strip('*'), pattern)]
+            if conflicts:
+                print(f"[WARN] 封鎖樣式 {pattern} 會擋到白名單 {conflicts}，已略過")
+                continue
+            blocked.append(pattern)
+        return blocked
+    
+    def apply_performance_cdp(self):
+        """透過CDP封鎖非必要資源並移除無頭模式的User-Agent標記"""
+        try:
+            blocked = self.blocked_url_patterns()
+            self.driver.execute_cdp_cmd('Network.enable', {})
+            self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked})
+            user_agent = self.driver.execute_script("return navigator.userAgent")
+            if 'HeadlessChrome' in user_agent:
+                self.driver.execute_cdp_cmd('Network.setUserAgentOverride', {
+                    'userAgent': user_agent.replace('HeadlessChrome', 'Chrome')
+                })
+            print(f"[INFO] 效能模式：已封鎖 {len(blocked)} 種非必要資源")
+        except Exception as e:
+            print(f"[WARN] 無法設定資源封鎖: {e}")
+    
+    @timed('captcha_capture')
     def capture_captcha_image(self):
-        """抓取驗證碼圖片"""
+        """抓取驗證碼圖片，回傳記憶體中的ImagePayload（寫檔在背景進行）"""
         try:
             # 尋找驗證碼圖片元素
             captcha_img_selectors = [
@@ -282,14 +2776,7 @@ class AutoGrader:
                 (By.CSS_SELECTOR, "img[src*='NewCode.php']")
             ]
             
-            captcha_img = None
-            for selector_type, selector_value in captcha_img_selectors:
-                try:
-                    captcha_img = self.driver.find_element(selector_type, selector_value)
-                    print(f"找到驗證碼圖片: {selector_type} = {selector_value}")
-                    break
-                except:
-                    continue
+            captcha_img = self.selectors.find_element(self.driver, 'captcha_image', captcha_img_selectors)
             
             if not captcha_img:
                 print("無法找到驗證碼圖片元素")
@@ -298,31 +2785,24 @@ class AutoGrader:
             # 截取驗證碼圖片
             timestamp = int(time.time())
             filename = f"captcha_{timestamp}.png"
-            os.makedirs(self.config['captcha']['save_path'], exist_ok=True)
             
             # 方法1：直接截取圖片元素
             try:
-                filepath = os.path.join(self.config['captcha']['save_path'], filename)
-                captcha_img.screenshot(filepath)
+                payload = ImagePayload(captcha_img.screenshot_as_png, "image/png", filename)
                 print(f"驗證碼圖片截取成功: {filename}")
-                return filepath
+                return self.image_sink.submit(payload)
             except:
                 pass
             
-            # 方法2：通過圖片URL下載
+            # 方法2：通過圖片URL下載（NewCode.php每次請求會產生新驗證碼，因此僅作為備援）
             try:
                 img_src = captcha_img.get_attribute('src')
                 if img_src:
-                    if img_src.startswith('data:image'):
-                        # 處理base64圖片
-                        header, data = img_src.split(',', 1)
-                        img_data = base64.b64decode(data)
-                        return self.captcha_resolver.save_captcha_image(img_data, filename)
-                    else:
-                        # 處理URL圖片
-                        response = requests.get(img_src, cookies=self.get_browser_cookies())
-                        if response.status_code == 200:
-                            return self.captcha_resolver.save_captcha_image(response.content, filename)
+                    self.downloader.sync_cookies(self.driver)
+                    img_data, media_type = self.downloader.fetch(img_src, referer=self.driver.current_url)
+                    if img_data:
+                        filename = f"captcha_{timestamp}{ImageDownloader.extension_for(media_type)}"
+                        return self.image_sink.submit(ImagePayload(img_data, media_type, filename))
             except Exception as e:
                 print(f"下載驗證碼圖片失敗: {e}")
             
@@ -332,15 +2812,58 @@ class AutoGrader:
             print(f"抓取驗證碼圖片時發生錯誤: {e}")
             return None
     
-    def get_browser_cookies(self):
-        """獲取瀏覽器cookies"""
+    def restore_session(self):
+        """嘗試沿用已儲存的登入狀態"""
+        cookies = self.session_store.load()
+        if not cookies:
+            return False
+        
+        print("[INFO] 檢查已儲存的登入狀態...")
+        if not self.session_store.probe(cookies):
+            print("[INFO] 已儲存的登入狀態失效")
+            self.session_store.clear()
+            return False
+        
+        try:
+            # 必須先進入同網域頁面才能設定cookies
+            self.driver.get(self.session_store.base_url)
+            for cookie in cookies:
+                try:
+                    self.driver.add_cookie(cookie)
+                except Exception as e:
+                    print(f"[WARN] 無法設定cookie {cookie.get('name')}: {e}")
+            
+            self.driver.get(self.session_store.probe_url)
+            self.waits.document_ready('login_result')
+            return self.check_login_success()
+        except Exception as e:
+            print(f"[WARN] 還原登入狀態時發生錯誤: {e}")
+            return False
+    
+    def save_session(self):
+        """將目前瀏覽器的登入狀態儲存到磁碟"""
         try:
-            cookies = {}
-            for cookie in self.driver.get_cookies():
-                cookies[cookie['name']] = cookie['value']
-            return cookies
-        except:
-            return {}
+            return self.session_store.save(self.driver.get_cookies())
+        except Exception as e:
+            print(f"[WARN] 儲存登入狀態失敗: {e}")
+            return False
+    
+    def ensure_login(self):
+        """確保已登入：優先沿用已儲存的登入狀態，失效時才執行自動登入"""
+        if not self.config:
+            print("配置檔案未載入")
+            return False
+        
+        if self.restore_session():
+            print("[SUCCESS] 已沿用儲存的登入狀態，略過登入流程")
+            self.dashboard_url = self.driver.current_url
+            return True
+        
+        if self.auto_login():
+            self.save_session()
+            self.dashboard_url = self.driver.current_url
+            return True
+        return False
     
     def auto_login(self):
         """完全自動化登入"""
@@ -349,71 +2872,231 @@ class AutoGrader:
             return False
         
         max_attempts = self.config['captcha']['max_attempts']
+        refresh_in_place = self.config['captcha'].get('refresh_in_place', True)
         
         for attempt in range(max_attempts):
             print(f"\n=== 登入嘗試 {attempt + 1}/{max_attempts} ===")
             
-            try:
-                # 訪問登入頁面
-                login_url = self.config['login']['url']
-                print(f"正在訪問登入頁面: {login_url}")
-                self.driver.get(login_url)
-                
-                # 等待頁面載入
-                time.sleep(self.config['settings']['wait_time'])
-                
-                # 等待模態框出現
-                self.wait_for_modal()
-                
-                print("正在查找登入表單元素...")
-                
-                # 填寫帳號
-                if not self.fill_username():
-                    print("無法填寫帳號")
-                    continue
-                
-                # 填寫密碼
-                if not self.fill_password():
-                    print("無法填寫密碼")
-                    continue
-                
-                # 抓取並識別驗證碼
-                captcha_image_path = self.capture_captcha_image()
-                if not captcha_image_path:
-                    print("無法抓取驗證碼圖片")
-                    continue
-                
-                captcha_text = self.captcha_resolver.recognize_captcha(captcha_image_path)
-                if not captcha_text:
-                    print("無法識別驗證碼")
-                    continue
-                
-                # 填寫驗證碼
-                if not self.fill_captcha(captcha_text):
-                    print("無法填寫驗證碼")
-                    continue
-                
-                # 點擊登入按鈕
-                if not self.click_login_button():
-                    print("無法點擊登入按鈕")
-                    continue
-                
-                # 等待登入結果
-                time.sleep(self.config['settings']['wait_time'])
-                
-                # 檢查是否登入成功
-                if self.check_login_success():
-                    print("[SUCCESS] 登入成功！")
-                    return True
-                else:
-                    print(f"登入失敗，第 {attempt + 1} 次嘗試")
+            if attempt > 0:
+                self.metrics.incr("login_retries")
+            with self.metrics.span("login_attempt", attempt=attempt + 1) as span:
+                span['ok'] = False
+                try:
+                    # 重試時優先只更新驗證碼圖片，表單狀態遺失時才重新載入登入頁面
+                    credentials_filled = False
+                    refreshed = attempt > 0 and refresh_in_place and self.refresh_captcha()
+                    if refreshed:
+                        credentials_filled = refreshed['credentials_filled']
+                    else:
+                        # 訪問登入頁面
+                        login_url = self.config['login']['url']
+                        print(f"正在訪問登入頁面: {login_url}")
+                        self.driver.get(login_url)
+                        
+                        # 等待頁面載入
+                        self.waits.document_ready('login_page')
+                        
+                        # 等待模態框出現
+                        self.wait_for_modal()
+                    
+                    # 抓取並識別驗證碼
+                    captcha_image = self.capture_captcha_image()
+                    if not captcha_image:
+                        print("無法抓取驗證碼圖片")
+                        continue
+                    
+                    captcha_text = self.captcha_resolver.recognize_captcha(captcha_image)
+                    if not captcha_text:
+                        print("無法識別驗證碼")
+                        continue
+                    
+                    # 填寫表單並送出（帳號密碼仍在表單上時只填驗證碼）
+                    pre_login_url = self.driver.current_url
+                    if not self.submit_login_form(captcha_text, captcha_only=credentials_filled):
+                        continue
+                    
+                    # 等待登入結果
+                    self.waits.navigation('login_result', pre_login_url)
+                    
+                    # 檢查是否登入成功
+                    if self.check_login_success():
+                        print("[SUCCESS] 登入成功！")
+                        span['ok'] = True
+                        self.captcha_resolver.confirm_captcha(captcha_image, captcha_text)
+                        return True
+                    else:
+                        print(f"登入失敗，第 {attempt + 1} 次嘗試")
+                        
+                except Exception as e:
+                    print(f"登入嘗試 {attempt + 1} 發生錯誤: {e}")
                     
-            except Exception as e:
-                print(f"登入嘗試 {attempt + 1} 發生錯誤: {e}")
-                
         print(f"經過 {max_attempts} 次嘗試後仍無法登入")
         return False
     
+    # 一次填寫帳號、密碼、驗證碼並送出，回傳各欄位是否找到
+    SCRIPTED_LOGIN_SCRIPT = """
+        var values = arguments[0];
+        function visible(el) {
+            if (!el || el.disabled) { return false; }
+            var style = window.getComputedStyle(el);
+            return style.display !== 'none' && style.visibility !== 'hidden' && el.getClientRects().length > 0;
+        }
+        function find(name) {
+            var candidates = [document.getElementById(name)].concat(
+                Array.prototype.slice.call(document.getElementsByName(name)));
+            for (var i = 0; i < candidates.length; i++) {
+                if (visible(candidates[i])) { return candidates[i]; }
+            }
+            return null;
+        }
+        var result = {found: {}, missing: [], submitted: false};
+        var fields = {};
+        Object.keys(values).forEach(function (name) {
+            fields[name] = find(name);
+            result.found[name] = !!fields[name];
+            if (!fields[name]) { result.missing.push(name); }
+        });
+        // 送出按鈕：優先在帳號欄位所屬的表單內尋找明確的submit按鈕，其次為文字包含「登入」的按鈕
+        var scope = (fields.UID && fields.UID.form) || document;
+        var submit = null;
+        [scope.querySelectorAll("button[type='submit'], input[type='submit']"),
+         document.querySelectorAll("button[type='submit']"),
+         document.querySelectorAll("button")].forEach(function (buttons) {
+            for (var i = 0; i < buttons.length && !submit; i++) {
+                var button = buttons[i];
+                var isLogin = button.getAttribute('type') === 'submit' || (button.innerText || '').indexOf('登入') >= 0;
+                if (visible(button) && isLogin) { submit = button; }
+            }
+        });
+        result.found.submit = !!submit;
+        if (result.missing.length || !submit) { return result; }
+
+        // 使用原生setter並觸發事件，確保頁面框架能取得輸入值
+        var setter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+        Object.keys(values).forEach(function (name) {
+            setter.call(fields[name], values[name]);
+            fields[name].dispatchEvent(new Event('input', {bubbles: true}));
+            fields[name].dispatchEvent(new Event('change', {bubbles: true}));
+        });
+        submit.click();
+        result.submitted = true;
+        return result;
+    """
+    
+    def scripted_login(self, captcha_text, captcha_only=False):
+        """以單一注入腳本填寫帳號、密碼、驗證碼並送出（同一次呼叫中檢查欄位可見性）
+        
+        Args:
+            captcha_only (bool): 帳號密碼已在表單上，只填寫驗證碼
+        
+        Returns:
+            dict: {'found': {欄位: 是否找到}, 'missing': [未找到的欄位], 'submitted': 是否已送出}
+        """
+        values = {'NewCode': captcha_text}
+        if not captcha_only:
+            username = os.getenv('LOGIN_USERNAME')
+            password = os.getenv('LOGIN_PASSWORD')
+            if not username or not password:
+                print("[ERROR] 未設定LOGIN_USERNAME或LOGIN_PASSWORD環境變數")
+                return {'found': {}, 'missing': ['UID', 'PWD'], 'submitted': False}
+            values.update({'UID': username, 'PWD': password})
+        
+        try:
+            result = self.driver.execute_script(self.SCRIPTED_LOGIN_SCRIPT, values)
+        except Exception as e:
+            print(f"[WARN] 快速登入腳本執行失敗: {e}")
+            return {'found': {}, 'missing': [], 'submitted': False}
+        
+        if result['submitted']:
+            print(f"[PASS] 已以單一腳本填寫表單並送出（驗證碼: {captcha_text}）")
+        else:
+            print(f"[WARN] 快速登入未送出，找不到欄位: {result['missing'] or ['submit']}")
+        return result
+    
+    def submit_login_form(self, captcha_text, captcha_only=False):
+        """填寫登入表單並送出：優先使用單一腳本快速登入，失敗時逐欄輸入
+        
+        Args:
+            captcha_only (bool): 帳號密碼已在表單上，只填寫驗證碼
+        """
+        if self.config.get('login', {}).get('fast_path', True):
+            if self.scripted_login(captcha_text, captcha_only)['submitted']:
+                return True
+            print("[INFO] 改用逐欄輸入方式登入")
+        
+        print("正在查找登入表單元素...")
+        
+        if not captcha_only:
+            # 填寫帳號
+            if not self.fill_username():
+                print("無法填寫帳號")
+                return False
+            
+            # 填寫密碼
+            if not self.fill_password():
+                print("無法填寫密碼")
+                return False
+        
+        # 填寫驗證碼
+        if not self.fill_captcha(captcha_text):
+            print("無法填寫驗證碼")
+            return False
+        
+        # 點擊登入按鈕
+        if not self.click_login_button():
+            print("無法點擊登入按鈕")
+            return False
+        return True
+    
+    # 重新載入驗證碼圖片並清空驗證碼欄位；表單不完整時回傳null
+    REFRESH_CAPTCHA_SCRIPT = """
+        function first(name) {
+            return document.getElementById(name) || document.getElementsByName(name)[0] || null;
+        }
+        var img = document.querySelector("img[src*='NewCode.php']");
+        var captchaInput = first('NewCode');
+        var uid = first('UID');
+        var pwd = first('PWD');
+        if (!img || !captchaInput || !uid || !pwd || img.getClientRects().length === 0) { return null; }
+        var url = new URL(img.getAttribute('src'), window.location.href);
+        url.searchParams.set('_', Date.now());
+        img.src = url.toString();
+        captchaInput.value = '';
+        return {image: img, credentials_filled: uid.value !== '' && pwd.value !== ''};
+    """
+    
+    def refresh_captcha(self):
+        """只重新載入驗證碼圖片（不重新載入登入頁面）
+        
+        Returns:
+            dict: {'image': 驗證碼圖片元素, 'credentials_filled': 帳號密碼是否仍在表單上}；
+                  登入表單已不存在時回傳None
+        """
+        # 登入失敗時網站可能跳出提示框，先關閉才能繼續操作頁面
+        try:
+            self.driver.switch_to.alert.accept()
+        except Exception:
+            pass
+        
+        try:
+            result = self.driver.execute_script(self.REFRESH_CAPTCHA_SCRIPT)
+        except Exception as e:
+            print(f"[WARN] 更新驗證碼時發生錯誤: {e}")
+            return None
+        if not result:
+            print("[INFO] 登入表單已不存在，重新載入登入頁面")
+            return None
+        
+        loaded = self.waits.until(
+            'captcha_refresh',
+            lambda d: d.execute_script("return arguments[0].complete && arguments[0].naturalWidth > 0;", result['image']),
+            "captcha_loaded"
+        )
+        if not loaded:
+            return None
+        print("[INFO] 已更新驗證碼圖片（未重新載入頁面）")
+        return result
+    
     def wait_for_modal(self):
         """等待登入模態框出現"""
         try:
@@ -422,14 +3105,12 @@ class AutoGrader:
                 (By.CLASS_NAME, "modal")
             ]
             
-            for selector_type, selector_value in modal_selectors:
-                try:
-                    modal = self.wait.until(EC.presence_of_element_located((selector_type, selector_value)))
-                    print(f"[INFO] 找到登入模態框: {selector_type} = {selector_value}")
-                    time.sleep(1)  # 等待模態框完全載入
-                    return True
-                except:
-                    continue
+            modal = self.waits.element_present('login_modal', modal_selectors)
+            if modal:
+                print("[INFO] 找到登入模態框")
+                # 等待模態框內的帳號欄位可見（取代固定等待動畫結束）
+                self.waits.element_visible('login_modal', [(By.ID, "UID"), (By.NAME, "UID")])
+                return True
             
             print("[INFO] 未找到模態框，繼續嘗試...")
             return True
@@ -450,17 +3131,16 @@ class AutoGrader:
             (By.CSS_SELECTOR, "input[name='UID']")
         ]
         
-        for selector_type, selector_value in selectors:
-            try:
-                username_field = self.driver.find_element(selector_type, selector_value)
-                if username_field.is_displayed() and username_field.is_enabled():
-                    username_field.clear()
-                    username_field.send_keys(username)
-                    print(f"[PASS] 已填寫帳號: {username} (使用: {selector_value})")
-                    return True
-            except:
-                continue
-        return False
+        username_field = self.selectors.find_element(self.driver, 'username', selectors, is_interactable)
+        if not username_field:
+            return False
+        try:
+            username_field.clear()
+            username_field.send_keys(username)
+            print(f"[PASS] 已填寫帳號: {username}")
+            return True
+        except:
+            return False
     
     def fill_password(self):
         """填寫密碼"""
@@ -475,17 +3155,16 @@ class AutoGrader:
             (By.CSS_SELECTOR, "input[name='PWD']")
         ]
         
-        for selector_type, selector_value in password_selectors:
-            try:
-                password_field = self.driver.find_element(selector_type, selector_value)
-                if password_field.is_displayed() and password_field.is_enabled():
-                    password_field.clear()
-                    password_field.send_keys(password)
-                    print(f"[PASS] 已填寫密碼 (使用: {selector_value})")
-                    return True
-            except:
-                continue
-        return False
+        password_field = self.selectors.find_element(self.driver, 'password', password_selectors, is_interactable)
+        if not password_field:
+            return False
+        try:
+            password_field.clear()
+            password_field.send_keys(password)
+            print("[PASS] 已填寫密碼")
+            return True
+        except:
+            return False
     
     def fill_captcha(self, captcha_text):
         """填寫驗證碼"""
@@ -495,17 +3174,16 @@ class AutoGrader:
             (By.CSS_SELECTOR, "input[name='NewCode']")
         ]
         
-        for selector_type, selector_value in captcha_selectors:
-            try:
-                captcha_field = self.driver.find_element(selector_type, selector_value)
-                if captcha_field.is_displayed() and captcha_field.is_enabled():
-                    captcha_field.clear()
-                    captcha_field.send_keys(captcha_text)
-                    print(f"[PASS] 已填寫驗證碼: {captcha_text} (使用: {selector_value})")
-                    return True
-            except:
-                continue
-        return False
+        captcha_field = self.selectors.find_element(self.driver, 'captcha_input', captcha_selectors, is_interactable)
+        if not captcha_field:
+            return False
+        try:
+            captcha_field.clear()
+            captcha_field.send_keys(captcha_text)
+            print(f"[PASS] 已填寫驗證碼: {captcha_text}")
+            return True
+        except:
+            return False
     
     def click_login_button(self):
         """點擊登入按鈕"""
@@ -515,16 +3193,15 @@ class AutoGrader:
             (By.CSS_SELECTOR, "button[type='submit']")
         ]
         
-        for selector_type, selector_value in button_selectors:
-            try:
-                login_button = self.driver.find_element(selector_type, selector_value)
-                if login_button.is_displayed() and login_button.is_enabled():
-                    login_button.click()
-                    print(f"[PASS] 已點擊登入按鈕 (使用: {selector_value})")
-                    return True
-            except:
-                continue
-        return False
+        login_button = self.selectors.find_element(self.driver, 'login_button', button_selectors, is_interactable)
+        if not login_button:
+            return False
+        try:
+            login_button.click()
+            print("[PASS] 已點擊登入按鈕")
+            return True
+        except:
+            return False
     
     def check_login_success(self):
         """檢查是否登入成功"""
@@ -548,10 +3225,25 @@ class AutoGrader:
     
     def close(self):
         """關閉瀏覽器"""
+        if self.selectors:
+            self.selectors.save()
+        if self.ledger:
+            self.ledger.flush()
+        if self.prefetcher:
+            self.prefetcher.close()
+        if self.downloader:
+            self.downloader.close()
+        if self.image_sink:
+            self.image_sink.close()
+        if self.analysis_engine and self._owns_analysis_engine:
+            self.analysis_engine.close()
+        if self.captcha_resolver and self._owns_captcha_resolver:
+            self.captcha_resolver.close()
         if self.driver:
             self.driver.quit()
             print("瀏覽器已關閉")
     
+    @timed('navigate_to_question')
     def navigate_to_question(self, question_number=19, school_index=0):
         """導航到指定題目
         
@@ -562,28 +3254,26 @@ class AutoGrader:
         try:
             print(f"[INFO] 正在導航到第 {question_number} 題（學校索引：{school_index}）")
             
-            # 等待頁面載入
-            time.sleep(self.config['settings']['wait_time'])
+            # 等待題目按鈕出現
+            self.waits.element_present('question_page', [
+                (By.XPATH, f"//*[contains(text(), '第{question_number}題')]")
+            ])
             
-            # 查找第19題的按鈕
+            # 查找第19題的按鈕（{question_number}由選擇器快取代入）
             question_selectors = [
                 # 包含第19題文字的按鈕
-                (By.XPATH, f"//div[contains(text(), '第{question_number}題')]"),
-                (By.XPATH, f"//*[contains(text(), '第{question_number}題')]"),
+                (By.XPATH, "//div[contains(text(), '第{question_number}題')]"),
+                (By.XPATH, "//*[contains(text(), '第{question_number}題')]"),
                 # 更具體的選擇器
-                (By.XPATH, f"//div[@class='card-body']//div[contains(text(), '第{question_number}題')]"),
+                (By.XPATH, "//div[@class='card-body']//div[contains(text(), '第{question_number}題')]"),
             ]
             
             question_button = None
             
-            # 首先獲取所有匹配的元素
-            all_question_buttons = []
-            for selector_type, selector_value in question_selectors:
-                try:
-                    elements = self.driver.find_elements(selector_type, selector_value)
-                    all_question_buttons.extend(elements)
-                except:
-                    continue
+            # 使用第一個有結果的選擇器（避免多個重疊選擇器重複列出同一按鈕）
+            all_question_buttons = self.selectors.find_elements(
+                self.driver, 'question_card', question_selectors, multiple=True, question_number=question_number
+            )
             
             print(f"[DEBUG] 找到 {len(all_question_buttons)} 個第{question_number}題按鈕")
             
@@ -599,14 +3289,15 @@ class AutoGrader:
             if question_button:
                 # 滾動到元素可見
                 self.driver.execute_script("arguments[0].scrollIntoView(true);", question_button)
-                time.sleep(1)
+                self.waits.element_clickable('question_page', question_button)
                 
                 # 點擊題目
+                old_url = self.driver.current_url
                 question_button.click()
                 print(f"[SUCCESS] 已點擊第{question_number}題")
                 
                 # 等待頁面跳轉
-                time.sleep(self.config['settings']['wait_time'])
+                self.waits.navigation('student_list', old_url, question_button)
                 
                 return True
             else:
@@ -617,162 +3308,572 @@ class AutoGrader:
             print(f"[ERROR] 導航到題目時發生錯誤: {e}")
             return False
     
+    # 讀取教師首頁所有題目卡片：只保留最內層含「第N題」文字的元素，同一張卡片只列一次，
+    # 依文件順序回傳 [題號, 網址（無法取得時為空字串）, 卡片文字, 元素]
+    DASHBOARD_CARDS_SCRIPT = """
+        var pattern = /第\\s*(\\d+)\\s*題/;
+        var hrefPattern = /location(?:\\.href)?\\s*=\\s*['"]([^'"]+)['"]/;
+        function visible(el) { return el.getClientRects().length > 0; }
+        function cardUrl(el, card) {
+            for (var node = el; node; node = node.parentElement) {
+                var href = node.tagName === 'A' ? node.getAttribute('href') : node.getAttribute('data-href');
+                if (href && href !== '#' && href.indexOf('javascript:') !== 0) {
+                    return new URL(href, location.href).href;
+                }
+                var match = hrefPattern.exec(node.getAttribute('onclick') || '');
+                if (match) { return new URL(match[1], location.href).href; }
+                if (node === card) { break; }
+            }
+            return '';
+        }
+        var cards = [];
+        var seen = {};
+        var usedCards = [];
+        Array.prototype.slice.call(document.body.querySelectorAll('*')).forEach(function (el) {
+            var match = pattern.exec(el.textContent || '');
+            if (!match || !visible(el)) { return; }
+            for (var i = 0; i < el.children.length; i++) {
+                if (pattern.test(el.children[i].textContent || '')) { return; }
+            }
+            var card = el.closest('.card') || el;
+            var question = parseInt(match[1], 10);
+            var url = cardUrl(el, card);
+            if (url && seen[question + '|' + url]) { return; }
+            for (var j = 0; j < usedCards.length; j++) {
+                if (usedCards[j][0] === card && usedCards[j][1] === question) { return; }
+            }
+            if (url) { seen[question + '|' + url] = true; }
+            usedCards.push([card, question]);
+            cards.push([question, url, (card.innerText || '').trim().slice(0, 60), el]);
+        });
+        return cards;
+    """
+    
+    @timed('index_dashboard')
+    def index_dashboard(self, refresh=False):
+        """掃描教師首頁一次，建立去除重複的 {(題號, 學校索引): {'url', 'label'}} 對照表
+        
+        同一題的卡片依頁面順序編為學校索引0, 1, 2...；之後的工作直接以網址進入題目，不需重複掃描首頁。
+        """
+        if self.dashboard_index is not None and not refresh:
+            return self.dashboard_index
+        if self.dashboard_url and self.driver.current_url != self.dashboard_url:
+            self.driver.get(self.dashboard_url)
+        self.waits.page_settled('question_page')
+        
+        index = {}
+        schools = Counter()
+        try:
+            cards = self.driver.execute_script(self.DASHBOARD_CARDS_SCRIPT) or []
+        except Exception as e:
+            print(f"[WARN] 掃描教師首頁題目卡片失敗: {e}")
+            cards = []
+        for question_number, url, label, _ in cards:
+            index[(question_number, schools[question_number])] = {'url': url, 'label': label}
+            schools[question_number] += 1
+        
+        self.dashboard_index = index
+        with_url = sum(1 for card in index.values() if card['url'])
+        summary = "、".join(f"第{question}題×{count}" for question, count in sorted(schools.items()))
+        print(f"[INFO] 教師首頁共 {len(index)} 張題目卡片（{summary or '無'}），其中 {with_url} 張可直接以網址進入")
+        return index
+    
+    def plan_grading_jobs(self):
+        """依 grading 設定與首頁對照表產生工作清單，略過首頁上不存在的(題號, 學校)"""
+        index = self.index_dashboard()
+        jobs = build_grading_jobs(self.config, index)
+        if not index:
+            return jobs
+        missing = sorted({(job[0], job[1]) for job in jobs} - set(index))
+        for question_number, school_index in missing:
+            print(f"[WARN] 教師首頁沒有第{question_number}題／學校{school_index}的卡片，略過")
+        return [job for job in jobs if (job[0], job[1]) in index]
+    
+    @timed('open_question')
+    def open_question(self, question_number, school_index):
+        """進入指定題目的學生列表：有網址時直接前往，否則回到首頁點擊對照表中的卡片
+        
+        首頁掃描不到任何題目卡片時，改用navigate_to_question逐一以選擇器尋找。
+        """
+        index = self.index_dashboard()
+        if not index:
+            if self.dashboard_url and self.driver.current_url != self.dashboard_url:
+                self.driver.get(self.dashboard_url)
+            return self.navigate_to_question(question_number=question_number, school_index=school_index)
+        
+        card = index.get((question_number, school_index))
+        if card is None:
+            print(f"[ERROR] 教師首頁沒有第{question_number}題／學校{school_index}的卡片")
+            return False
+        if card['url']:
+            print(f"[INFO] 直接進入第{question_number}題（學校索引：{school_index}）: {card['url']}")
+            self.driver.get(card['url'])
+            self.waits.page_settled('student_list')
+            return True
+        
+        # 卡片沒有網址（JavaScript導向），回到首頁點擊同一順序的卡片
+        if self.dashboard_url and self.driver.current_url != self.dashboard_url:
+            self.driver.get(self.dashboard_url)
+        self.waits.page_settled('question_page')
+        elements = [
+            element for question, _, _, element in self.driver.execute_script(self.DASHBOARD_CARDS_SCRIPT) or []
+            if question == question_number
+        ]
+        if school_index >= len(elements):
+            print(f"[ERROR] 找不到第{question_number}題／學校{school_index}的卡片（首頁可能已變更）")
+            self.dashboard_index = None
+            return False
+        element = elements[school_index]
+        self.driver.execute_script("arguments[0].scrollIntoView({behavior: 'instant', block: 'center'});", element)
+        old_url = self.driver.current_url
+        self.click_element(element)
+        print(f"[SUCCESS] 已點擊第{question_number}題（學校索引：{school_index}）")
+        self.waits.navigation('student_list', old_url, element)
+        return True
+    
+    def find_student_links(self):
+        """找出學生列表中所有可交互的學生連結（使用第一個有結果的選擇器）"""
+        # 更全面的學生選擇器
+        student_selectors = [
+            # 表格相關
+            (By.XPATH, "//table//tr[position()>1]//td//a"),  # 表格中的連結
+            (By.XPATH, "//tbody//tr[1]//a"),  # tbody第一行的連結
+            (By.XPATH, "//tr[contains(@class, 'student') or contains(@onclick, 'student')]//a"),
+            
+            # 按鈕相關
+            (By.XPATH, "//button[contains(text(), '批改')]"),
+            (By.XPATH, "//button[contains(text(), '檢視')]"),
+            (By.XPATH, "//button[contains(text(), '開始')]"),
+            (By.XPATH, "//a[contains(text(), '批改')]"),
+            (By.XPATH, "//a[contains(text(), '檢視')]"),
+            
+            # 連結相關
+            (By.XPATH, "//a[contains(@href, 'student')]"),
+            (By.XPATH, "//a[contains(@href, 'exam')]"),
+            (By.XPATH, "//a[contains(@href, 'grade')]"),
+            
+            # 通用選擇器
+            (By.XPATH, "//div[contains(@class, 'card')]//a"),
+            (By.XPATH, "//div[contains(@class, 'list')]//a"),
+        ]
+        
+        # 檢查元素是否可見且可交互
+        links = self.selectors.find_elements(
+            self.driver, 'student_link', student_selectors, is_interactable, multiple=True
+        )
+        if links:
+            print(f"[INFO] 找到 {len(links)} 個可交互的學生連結")
+        return links
+    
+    def click_element(self, element):
+        """點擊元素（依序嘗試直接點擊、JavaScript點擊、ActionChains點擊）"""
+        try:
+            # 方式1: 直接點擊
+            element.click()
+        except:
+            try:
+                # 方式2: JavaScript點擊
+                self.driver.execute_script("arguments[0].click();", element)
+            except:
+                # 方式3: 通過ActionChains點擊
+                from selenium.webdriver.common.action_chains import ActionChains
+                actions = ActionChains(self.driver)
+                actions.move_to_element(element).click().perform()
+    
+    # 讀取學生連結的網址與所在列文字（一次呼叫取得整頁資料）
+    STUDENT_ENTRIES_SCRIPT = """
+        return arguments[0].map(function (link) {
+            var row = link.closest('tr') || link;
+            return [link.href || link.getAttribute('data-href') || '', (row.innerText || '').trim()];
+        });
+    """
+    
+    # 尋找下一頁連結
+    NEXT_PAGE_SCRIPT = """
+        var candidates = Array.prototype.slice.call(document.querySelectorAll(
+            "a[rel='next'], .pagination .next a, .pagination li.next a, a.next, a.page-next"));
+        Array.prototype.slice.call(document.querySelectorAll('a')).forEach(function (link) {
+            var text = (link.innerText || '').trim();
+            if (text === '下一頁' || text === '›' || text === '»' || text === '>') { candidates.push(link); }
+        });
+        for (var i = 0; i < candidates.length; i++) {
+            var link = candidates[i];
+            var item = link.closest('li');
+            if (item && item.classList.contains('disabled')) { continue; }
+            if (link.offsetParent !== null) { return link; }
+        }
+        return null;
+    """
+    
+    STUDENT_ID_PARAMS = ('student_id', 'studentId', 'sid', 'stu_id', 'stuid', 'uid', 'id')
+    
+    def _student_id_from(self, url, row_text, fallback):
+        """從網址參數或所在列文字推斷學生ID"""
+        if url:
+            params = parse_qs(urlparse(url).query)
+            for name in self.STUDENT_ID_PARAMS:
+                if params.get(name):
+                    return params[name][0]
+        if row_text:
+            return row_text.split()[0]
+        return fallback
+    
+    def _resolve_student_entries(self, page):
+        """解析目前學生列表頁面上的所有學生（每頁只執行一次選擇器）"""
+        links = self.find_student_links()
+        if not links:
+            return []
+        raw_entries = self.driver.execute_script(self.STUDENT_ENTRIES_SCRIPT, links)
+        
+        entries = []
+        seen_urls = set()
+        for position, (url, row_text) in enumerate(raw_entries):
+            if not url.startswith('http'):
+                url = ''
+            # 同一位學生可能有多個連結（批改／檢視），以網址去除重複
+            if url and url in seen_urls:
+                continue
+            if url:
+                seen_urls.add(url)
+            entries.append({
+                'student_id': self._student_id_from(url, row_text, f"{page}-{position}"),
+                'url': url,
+                'page': page,
+                'link_position': position
+            })
+        return self._assign_student_ids(entries)
+    
+    def _assign_student_ids(self, entries):
+        """確保學生ID不重複：推斷出的ID（通用參數、列文字）重複時改以考卷網址識別，避免帳本中不同學生互相覆蓋"""
+        counts = Counter(entry['student_id'] for entry in entries)
+        for entry in entries:
+            student_id = entry['student_id']
+            if counts[student_id] > 1 or student_id in self._seen_student_ids:
+                entry['student_id'] = entry['url'] or f"{entry['page']}-{entry['link_position']}"
+                print(f"[WARN] 學生ID {student_id} 重複，改以 {entry['student_id']} 識別")
+            self._seen_student_ids.add(entry['student_id'])
+        return entries
+    
+    def iter_student_exams(self, max_pages=None, skip=None, prefetch=False):
+        """依序開啟目前題目頁面上每位學生的考卷（generator，支援分頁）
+        
+        每次yield時瀏覽器已停在該學生的考卷頁面，呼叫端可直接抓取圖片。
+        prefetch為真且prefetch.enabled時，處理目前學生期間在背景以HTTP預取接下來的學生，
+        預取成功的學生不開啟考卷頁面，圖片直接放在yield結果的images中。
+        
+        Args:
+            skip (callable): skip(student_id) 為真時不開啟該學生的考卷（例如已完成的工作）
+            prefetch (bool): 是否預取接下來學生的考卷圖片
+        
+        Yields:
+            dict: 學生考卷資訊，包含 index、student_id、url、page、list_url、images（未預取時為None）
+        """
+        self.student_entries = []
+        self._seen_student_ids = set()
+        list_url = self.driver.current_url
+        visited_pages = set()
+        page = 0
+        index = 0
+        
+        while list_url not in visited_pages and (max_pages is None or page < max_pages):
+            visited_pages.add(list_url)
+            self.waits.page_settled('student_list')
+            entries = self._resolve_student_entries(page)
+            
+            next_link = self.driver.execute_script(self.NEXT_PAGE_SCRIPT)
+            next_href = next_link.get_attribute('href') if next_link else None
+            next_url = next_href if next_href and next_href.startswith('http') else None
+            has_click_next = next_link is not None and next_url is None
+            
+            print(f"[INFO] 學生列表第 {page + 1} 頁: {len(entries)} 位學生")
+            for entry in entries:
+                self.student_entries.append({key: entry[key] for key in ('student_id', 'url', 'page')})
+                entry['skip'] = bool(skip and skip(entry['student_id']))
+            
+            use_prefetch = prefetch and self.prefetcher.enabled
+            if use_prefetch:
+                self.downloader.sync_cookies(self.driver)
+            
+            for position, entry in enumerate(entries):
+                if entry['skip']:
+                    index += 1
+                    continue
+                images = None
+                if use_prefetch:
+                    images = self.prefetcher.take(entry['url'], entry['student_id'])
+                    # 目前學生抓取、分析期間，在背景預取接下來的學生
+                    self.prefetcher.schedule(later for later in entries[position + 1:] if not later['skip'])
+                if images:
+                    # 已預取圖片，不需開啟考卷頁面
+                    pass
+                elif entry['url']:
+                    self.driver.get(entry['url'])
+                    self.waits.page_settled('exam_page')
+                else:
+                    # 沒有可直接開啟的網址（JavaScript連結），回到列表頁點擊
+                    if self.driver.current_url != list_url:
+                        self.driver.get(list_url)
+                        self.waits.page_settled('student_list')
+                    links = self.find_student_links()
+                    if entry['link_position'] >= len(links):
+                        print(f"[WARN] 找不到學生 {entry['student_id']} 的連結，略過")
+                        continue
+                    link = links[entry['link_position']]
+                    old_url = self.driver.current_url
+                    self.click_element(link)
+                    self.waits.navigation('exam_page', old_url, link)
+                
+                yield {
+                    'index': index,
+                    'student_id': entry['student_id'],
+                    'url': entry['url'] or self.driver.current_url,
+                    'page': entry['page'],
+                    'list_url': list_url,
+                    'images': images
+                }
+                index += 1
+            if use_prefetch:
+                self.prefetcher.clear()
+            
+            # 前往下一頁
+            if next_url:
+                self.driver.get(next_url)
+            elif has_click_next:
+                self.driver.get(list_url)
+                self.waits.page_settled('student_list')
+                next_link = self.driver.execute_script(self.NEXT_PAGE_SCRIPT)
+                if not next_link:
+                    break
+                self.click_element(next_link)
+                self.waits.navigation('student_list', list_url, next_link)
+            else:
+                break
+            list_url = self.driver.current_url
+            page += 1
+    
+    def grade_question(self, question_number, school_index, analyze=True):
+        """串流批改一個題目的所有學生，逐一yield每位學生的批改結果
+        
+        Args:
+            analyze (bool): 為False時只抓取圖片，分析結果由呼叫端以complete_job寫入
+        """
+        print(f"\n=== 開始批改第{question_number}題全部學生（學校{school_index}）===")
+        if not self.open_question(question_number, school_index):
+            print(f"[ERROR] 無法進入第{question_number}題頁面")
+            return
+        
+        # 已完成（或已達重試上限）的學生不開啟考卷
+        skipped = []
+        def skip(student_id):
+            if self.ledger.should_run(question_number, school_index, JobLedger.student_key(student_id)):
+                return False
+            skipped.append(student_id)
+            return True
+        
+        for exam in self.iter_student_exams(skip=skip, prefetch=True):
+            print(f"\n--- 學生 {exam['student_id']}（第 {exam['index'] + 1} 位）---")
+            student = JobLedger.student_key(exam['student_id'])
+            self.ledger.start(question_number, school_index, student, exam['index'])
+            try:
+                exam_images = exam['images'] or self.capture_exam_images()
+                results = self.analyze_exam_images(exam_images) if exam_images and analyze else []
+                job_result = {
+                    'question_number': question_number,
+                    'school_index': school_index,
+                    'student_index': exam['index'],
+                    'student_id': exam['student_id'],
+                    'images': exam_images,
+                    'results': results,
+                    'ok': analyze and self.job_succeeded(exam_images, results)
+                }
+            except BaseException as e:
+                self.ledger.finish(question_number, school_index, student, {'ok': False}, error=repr(e))
+                raise
+            if analyze or not exam_images:
+                self.ledger.finish(question_number, school_index, student, job_result)
+            yield job_result
+        
+        if skipped:
+            print(f"[INFO] 依工作帳本略過 {len(skipped)} 位已完成（或已達重試上限）的學生")
+    
+    def run_job(self, question_number, school_index, student_index, analyze=True):
+        """執行工作：student_index為None時串流批改該題所有學生，回傳結果清單"""
+        if student_index is None:
+            return list(self.grade_question(question_number, school_index, analyze))
+        return [self.grade_job(question_number, school_index, student_index, analyze)]
+    
+    def iter_job(self, question_number, school_index, student_index, analyze=True):
+        """與run_job相同，但逐一yield結果（串流批改時不需等整題完成）"""
+        if student_index is None:
+            yield from self.grade_question(question_number, school_index, analyze)
+        else:
+            yield self.grade_job(question_number, school_index, student_index, analyze)
+    
+    @staticmethod
+    def job_succeeded(images, results, error=None):
+        """工作是否成功：有圖片、沒有錯誤且每張圖片都有識別結果（否則帳本記為失敗，下次重試）"""
+        return bool(images) and error is None and all(result is not None for result in results)
+    
+    def complete_job(self, job_result, results, error=None):
+        """寫入分析結果並記錄到工作帳本（grade_job／grade_question以analyze=False執行時由呼叫端完成）"""
+        job_result['results'] = results
+        job_result['ok'] = self.job_succeeded(job_result['images'], results, error)
+        student = JobLedger.student_key(job_result['student_id'])
+        self.ledger.finish(job_result['question_number'], job_result['school_index'], student, job_result, error=error)
+        return job_result
+    
     def get_first_student_exam(self):
         """獲取第一位學生的考卷"""
+        return self.open_student_exam(0)
+    
+    @timed('open_student_exam')
+    def open_student_exam(self, student_index=0):
+        """開啟學生列表中指定順序學生的考卷
+        
+        Args:
+            student_index (int): 學生在列表中的順序（從0開始）
+        """
         try:
-            print("[INFO] 正在獲取第一位學生的考卷...")
+            print(f"[INFO] 正在獲取第 {student_index + 1} 位學生的考卷...")
             
             # 等待頁面載入
-            time.sleep(self.config['settings']['wait_time'] + 2)  # 多等待一點時間
+            self.waits.page_settled('student_list')
             
-            # 先嘗試截圖看看當前頁面狀態
+            # 先嘗試截圖看看當前頁面狀態（只截第一個圖塊，背景寫檔）
             try:
-                timestamp = int(time.time())
-                debug_screenshot = os.path.join(self.config['captcha']['save_path'], f"debug_page_{timestamp}.png")
-                os.makedirs(os.path.dirname(debug_screenshot), exist_ok=True)
-                self.driver.save_screenshot(debug_screenshot)
+                timestamp = self.file_stamp()
+                image_data, media_type = self.screenshots.capture_page(max_tiles=1)[0]
+                extension = ImageDownloader.extension_for(media_type)
+                debug_screenshot = self.image_sink.submit(
+                    ImagePayload(image_data, media_type, f"debug_page_{timestamp}{extension}")
+                )
                 print(f"[DEBUG] 已保存頁面截圖用於調試: {debug_screenshot}")
             except:
                 pass
             
-            # 更全面的學生選擇器
-            student_selectors = [
-                # 表格相關
-                (By.XPATH, "//table//tr[position()>1]//td//a"),  # 表格中的連結
-                (By.XPATH, "//tbody//tr[1]//a"),  # tbody第一行的連結
-                (By.XPATH, "//tr[contains(@class, 'student') or contains(@onclick, 'student')]//a"),
-                
-                # 按鈕相關
-                (By.XPATH, "//button[contains(text(), '批改')]"),
-                (By.XPATH, "//button[contains(text(), '檢視')]"),
-                (By.XPATH, "//button[contains(text(), '開始')]"),
-                (By.XPATH, "//a[contains(text(), '批改')]"),
-                (By.XPATH, "//a[contains(text(), '檢視')]"),
-                
-                # 連結相關
-                (By.XPATH, "//a[contains(@href, 'student')]"),
-                (By.XPATH, "//a[contains(@href, 'exam')]"),
-                (By.XPATH, "//a[contains(@href, 'grade')]"),
-                
-                # 通用選擇器
-                (By.XPATH, "//div[contains(@class, 'card')]//a"),
-                (By.XPATH, "//div[contains(@class, 'list')]//a"),
-            ]
-            
-            first_student_link = None
-            
-            for selector_type, selector_value in student_selectors:
-                try:
-                    elements = self.driver.find_elements(selector_type, selector_value)
-                    if elements:
-                        # 檢查元素是否可見且可交互
-                        for element in elements:
-                            if element.is_displayed() and element.is_enabled():
-                                first_student_link = element
-                                print(f"[INFO] 找到可交互的學生連結: {selector_value}")
-                                break
-                        if first_student_link:
-                            break
-                except:
-                    continue
+            student_links = self.find_student_links()
             
-            if first_student_link:
+            if student_index < len(student_links):
+                student_link = student_links[student_index]
                 try:
                     # 滾動到元素可見
-                    self.driver.execute_script("arguments[0].scrollIntoView({behavior: 'smooth', block: 'center'});", first_student_link)
-                    time.sleep(2)
-                    
-                    # 嘗試多種點擊方式
-                    try:
-                        # 方式1: 直接點擊
-                        first_student_link.click()
-                    except:
-                        try:
-                            # 方式2: JavaScript點擊
-                            self.driver.execute_script("arguments[0].click();", first_student_link)
-                        except:
-                            # 方式3: 通過ActionChains點擊
-                            from selenium.webdriver.common.action_chains import ActionChains
-                            actions = ActionChains(self.driver)
-                            actions.move_to_element(first_student_link).click().perform()
+                    self.driver.execute_script("arguments[0].scrollIntoView({behavior: 'instant', block: 'center'});", student_link)
+                    self.waits.element_clickable('student_list', student_link)
                     
-                    print("[SUCCESS] 已點擊第一位學生")
+                    old_url = self.driver.current_url
+                    self.click_element(student_link)
+                    print(f"[SUCCESS] 已點擊第 {student_index + 1} 位學生")
                     
                     # 等待考卷頁面載入
-                    time.sleep(self.config['settings']['wait_time'] + 2)
+                    self.waits.navigation('exam_page', old_url, student_link)
                     
                     return True
                     
                 except Exception as click_error:
                     print(f"[ERROR] 點擊學生連結失敗: {click_error}")
                     return False
+            elif student_links:
+                print(f"[ERROR] 學生索引超出範圍（共 {len(student_links)} 位學生）")
+                return False
             else:
                 print("[ERROR] 找不到可交互的學生連結")
                 
                 # 如果找不到連結，直接截取當前頁面作為考卷
                 print("[INFO] 嘗試截取當前頁面作為考卷內容")
-                return True
+                return student_index == 0
                 
         except Exception as e:
             print(f"[ERROR] 獲取學生考卷時發生錯誤: {e}")
             return False
     
+    def file_stamp(self):
+        """圖片檔名用的唯一標記（毫秒時間、worker編號與隨機碼），並行worker共用存檔目錄時不會互相覆蓋"""
+        return f"{int(time.time() * 1000)}_w{self.worker_id or 0}_{uuid.uuid4().hex[:6]}"
+    
+    # 一次取得頁面上所有圖片的網址、原始尺寸、顯示位置、可見性與載入狀態（篩選與排序在Python進行）
+    EXAM_IMAGES_SCRIPT = """
+        return Array.prototype.slice.call(document.images).map(function (img, index) {
+            var rect = img.getBoundingClientRect();
+            var style = window.getComputedStyle(img);
+            return {
+                index: index,
+                src: img.currentSrc || img.src || '',
+                src_attribute: img.getAttribute('src') || '',
+                alt: img.alt || '',
+                natural_width: img.naturalWidth,
+                natural_height: img.naturalHeight,
+                width: rect.width,
+                height: rect.height,
+                top: rect.top + window.scrollY,
+                left: rect.left + window.scrollX,
+                visible: img.getClientRects().length > 0 && style.visibility !== 'hidden' && style.display !== 'none'
+                    && parseFloat(style.opacity || '1') > 0,
+                complete: img.complete && img.naturalWidth > 0,
+                in_content: !!img.closest(".exam-content, [class*='answer']"),
+                element: img
+            };
+        });
+    """
+    
+    @timed('capture_exam_images')
     def capture_exam_images(self):
-        """抓取考卷圖片"""
+        """抓取考卷圖片，回傳ImagePayload清單（寫檔在背景進行）"""
         try:
             print("[INFO] 正在抓取考卷圖片...")
             
-            # 等待頁面載入
-            time.sleep(self.config['settings']['wait_time'])
-            
-            # 查找考卷圖片
-            image_selectors = [
-                (By.XPATH, "//img[contains(@src, 'exam') or contains(@src, 'student')]"),
-                (By.XPATH, "//img[contains(@alt, '考卷') or contains(@alt, 'exam')]"),
-                (By.XPATH, "//div[@class='exam-content']//img"),
-                (By.XPATH, "//div[contains(@class, 'answer')]//img"),
-                (By.TAG_NAME, "img"),  # 所有圖片，作為最後嘗試
-            ]
-            
-            exam_images = []
+            # 等待頁面及圖片載入
+            self.waits.page_settled('exam_page')
+            self.waits.images_complete('exam_images')
             
-            for selector_type, selector_value in image_selectors:
-                try:
-                    images = self.driver.find_elements(selector_type, selector_value)
-                    if images:
-                        print(f"[INFO] 找到 {len(images)} 個圖片元素")
-                        exam_images = images
-                        break
-                except:
-                    continue
+            # 以單一腳本取得所有圖片資訊，在Python篩選可見且不是很小的考卷圖片（最多保存5張）
+            page_images = self.driver.execute_script(self.EXAM_IMAGES_SCRIPT) or []
+            candidates = rank_exam_images(page_images)
+            print(f"[INFO] 頁面共 {len(page_images)} 張圖片，選出 {len(candidates)} 張考卷圖片")
             
-            if not exam_images:
+            if not candidates:
                 print("[WARN] 未找到考卷圖片，嘗試截取整個頁面")
-                # 如果找不到特定圖片，截取整個頁面
-                timestamp = int(time.time())
-                screenshot_path = os.path.join(self.config['captcha']['save_path'], f"exam_page_{timestamp}.png")
-                os.makedirs(os.path.dirname(screenshot_path), exist_ok=True)
-                self.driver.save_screenshot(screenshot_path)
-                print(f"[INFO] 已保存頁面截圖: {screenshot_path}")
-                return [screenshot_path]
-            
-            # 保存考卷圖片
+                # 如果找不到特定圖片，截取整個頁面（過長的作答頁面分成多張圖塊）
+                timestamp = self.file_stamp()
+                screenshots = []
+                for tile, (image_data, media_type) in enumerate(self.screenshots.capture_page()):
+                    extension = ImageDownloader.extension_for(media_type)
+                    payload = ImagePayload(image_data, media_type, f"exam_page_{timestamp}_{tile}{extension}")
+                    payload.group = "exam_page"
+                    screenshots.append(self.image_sink.submit(payload))
+                print(f"[INFO] 已截取頁面畫面: {', '.join(str(screenshot) for screenshot in screenshots)}")
+                return screenshots
+            
+            # 優先透過HTTP並行下載原始圖片（完整解析度），失敗時才截取元素畫面
+            downloads = [(None, None)] * len(candidates)
+            if self.downloader.enabled:
+                self.downloader.sync_cookies(self.driver)
+                downloads = self.downloader.fetch_many(
+                    [candidate['src'] for candidate in candidates], referer=self.driver.current_url
+                )
+            
+            timestamp = self.file_stamp()
             saved_images = []
-            for i, img in enumerate(exam_images):
+            for candidate, (image_data, media_type) in zip(candidates, downloads):
+                i = candidate['index']
                 try:
-                    # 檢查圖片是否可見且不是很小的圖片
-                    if img.is_displayed() and img.size['width'] > 50 and img.size['height'] > 50:
-                        timestamp = int(time.time())
-                        image_path = os.path.join(self.config['captcha']['save_path'], f"exam_image_{timestamp}_{i}.png")
-                        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-                        
-                        img.screenshot(image_path)
-                        saved_images.append(image_path)
-                        print(f"[SUCCESS] 已保存考卷圖片: {image_path}")
-                        
-                        # 限制最多保存5張圖片
-                        if len(saved_images) >= 5:
-                            break
+                    if image_data:
+                        extension = ImageDownloader.extension_for(media_type)
+                        payload = ImagePayload(image_data, media_type, f"exam_image_{timestamp}_{i}{extension}")
+                        print(f"[SUCCESS] 已下載考卷原始圖片: {payload.name}")
+                        saved_images.append(self.image_sink.submit(payload))
+                        continue
+                    if not candidate['complete']:
+                        print(f"[WARN] 第 {i} 張圖片尚未載入完成，截圖可能不完整")
+                    # 以腳本取得的頁面座標直接截取元素範圍（過高的答案卷分成多張圖塊）
+                    rect = (candidate['left'], candidate['top'], candidate['width'], candidate['height'])
+                    tiles = self.screenshots.capture_element(candidate['element'], rect)
+                    for tile, (tile_data, media_type) in enumerate(tiles):
+                        extension = ImageDownloader.extension_for(media_type)
+                        suffix = f"_{tile}" if len(tiles) > 1 else ""
+                        payload = ImagePayload(tile_data, media_type, f"exam_image_{timestamp}_{i}{suffix}{extension}")
+                        payload.group = f"exam_image_{i}"
+                        print(f"[SUCCESS] 已截取考卷圖片: {payload.name}")
+                        saved_images.append(self.image_sink.submit(payload))
                 except Exception as e:
                     print(f"[WARN] 保存第 {i} 張圖片失敗: {e}")
                     continue
@@ -782,57 +3883,507 @@ class AutoGrader:
         except Exception as e:
             print(f"[ERROR] 抓取考卷圖片時發生錯誤: {e}")
             return []
+    
+    @staticmethod
+    def limit_exam_images(exam_images, max_images):
+        """取前max_images張來源圖片；同一張截圖切出的圖塊（相同group）算一張，全部保留"""
+        groups = []
+        limited = []
+        for position, image in enumerate(exam_images):
+            group = getattr(image, 'group', None) or position
+            if group not in groups:
+                if len(groups) >= max_images:
+                    break
+                groups.append(group)
+            limited.append(image)
+        return limited
+    
+    def analyze_exam_images(self, exam_images, max_images=None):
+        """使用圖片識別分析考卷內容，回傳各圖片的識別結果"""
+        print("\n=== 分析考卷內容 ===")
+        if max_images is None:
+            max_images = self.config.get('analysis', {}).get('max_images_per_student', 2)
+        
+        exam_images = self.limit_exam_images(exam_images, max_images)
+        
+        # 有API密鑰時使用非同步引擎同時分析所有圖片
+        if self.analysis_engine.is_available():
+            results = self.analysis_engine.analyze_sync(exam_images)
+            for i, result in enumerate(results):
+                if result:
+                    print(f"[INFO] 第 {i+1} 張圖片識別結果: {result}")
+            return results
+        
+        results = []
+        for i, image in enumerate(exam_images):
+            print(f"[INFO] 正在分析第 {i+1} 張考卷圖片...")
+            
+            # 使用現有的驗證碼識別器來識別考卷內容
+            # 這裡可以根據需要調整prompt
+            result = self.captcha_resolver.recognize_captcha(image)
+            if result:
+                print(f"[INFO] 第 {i+1} 張圖片識別結果: {result}")
+            else:
+                print(f"[WARN] 第 {i+1} 張圖片識別失敗")
+            results.append(result)
+        return results
+    
+    def grade_job(self, question_number, school_index, student_index=0, analyze=True):
+        """批改單一工作：進入題目 → 開啟學生考卷 → 抓取圖片 → 分析
+        
+        進入題目後先解析學生ID，帳本鍵與grade_question相同；
+        工作帳本中已完成（或已達重試上限）的工作直接回傳帳本紀錄，不開啟考卷。
+        analyze為False時只抓取圖片，分析結果由呼叫端以complete_job寫入。
+        
+        Returns:
+            dict: 工作結果，包含抓取的圖片與分析結果
+        """
+        job_result = {
+            'question_number': question_number,
+            'school_index': school_index,
+            'student_index': student_index,
+            'student_id': None,
+            'images': [],
+            'results': [],
+            'ok': False
+        }
+        print(f"\n=== 開始批改考卷流程（第{question_number}題／學校{school_index}／學生{student_index}）===")
+        
+        # 以首頁對照表直接進入題目，確保每個工作都從相同狀態出發
+        if not self.open_question(question_number, school_index):
+            print(f"[ERROR] 無法進入第{question_number}題頁面")
+            return job_result
+        print(f"[SUCCESS] 已進入第{question_number}題頁面")
+        
+        self.waits.page_settled('student_list')
+        self._seen_student_ids = set()
+        entries = self._resolve_student_entries(0)
+        if student_index < len(entries):
+            entry = entries[student_index]
+        elif entries:
+            print(f"[ERROR] 學生索引超出範圍（共 {len(entries)} 位學生）")
+            return job_result
+        else:
+            # 找不到學生連結時open_student_exam會以目前頁面作為考卷，以頁面網址識別
+            entry = {'student_id': self.driver.current_url, 'url': '', 'link_position': student_index}
+        job_result['student_id'] = entry['student_id']
+        
+        student = JobLedger.student_key(entry['student_id'])
+        if not self.ledger.should_run(question_number, school_index, student):
+            job = self.ledger.get(question_number, school_index, student)
+            print(f"[INFO] 依工作帳本略過第{question_number}題／學校{school_index}／學生{entry['student_id']}（{job['status']}）")
+            job_result.update({
+                'images': [image.get('path') for image in job['images']],
+                'results': job['results'],
+                'ok': job['status'] == 'done',
+                'skipped': True
+            })
+            return job_result
+        
+        self.ledger.start(question_number, school_index, student, student_index)
+        try:
+            self._grade_job(job_result, entry, analyze)
+        except BaseException as e:
+            self.ledger.finish(question_number, school_index, student, job_result, error=repr(e))
+            raise
+        if analyze or not job_result['images']:
+            self.ledger.finish(question_number, school_index, student, job_result)
+        return job_result
+    
+    def _grade_job(self, job_result, entry, analyze=True):
+        """執行grade_job開啟考卷之後的步驟，結果寫入job_result"""
+        student_index = job_result['student_index']
+        
+        if entry['url']:
+            self.driver.get(entry['url'])
+            self.waits.page_settled('exam_page')
+        elif not self.open_student_exam(entry['link_position']):
+            print("[ERROR] 無法進入學生考卷頁面")
+            return job_result
+        print(f"[SUCCESS] 已進入第 {student_index + 1} 位學生的考卷頁面")
+        
+        exam_images = self.capture_exam_images()
+        if not exam_images:
+            print("[ERROR] 無法抓取考卷圖片")
+            return job_result
+        print(f"[SUCCESS] 成功抓取 {len(exam_images)} 張考卷圖片")
+        for i, image in enumerate(exam_images):
+            print(f"  考卷圖片 {i+1}: {image}")
+        
+        job_result['images'] = exam_images
+        if analyze:
+            job_result['results'] = self.analyze_exam_images(exam_images)
+            job_result['ok'] = self.job_succeeded(exam_images, job_result['results'])
+        return job_result
+
+class GradingPipeline:
+    """批改管線 - 瀏覽器端（生產者）抓取考卷圖片後送入有界佇列，分析執行緒（消費者）取出分析
+    
+    瀏覽器在API分析時繼續開啟下一位學生，每位學生的耗時趨近max(瀏覽, 分析)而非兩者相加。
+    佇列已滿時submit阻塞（背壓），避免瀏覽器遠遠領先而在記憶體中累積大量圖片；
+    結果依送入順序回傳。中斷時等待已送入的工作分析完成，再次中斷則放棄尚未開始的工作。
+    """
+    
+    _SENTINEL = object()
+    
+    def __init__(self, config, analyze, complete, metrics=None):
+        """
+        Args:
+            analyze (callable): analyze(images) -> 識別結果清單
+            complete (callable): complete(job_result, results, error=None)，寫入結果與工作帳本
+        """
+        pipeline_config = config.get('pipeline', {})
+        self.queue_size = max(1, pipeline_config.get('queue_size', 8))
+        self.worker_count = max(1, pipeline_config.get('analysis_workers', 2))
+        self.analyze = analyze
+        self.complete = complete
+        self.metrics = metrics or RunMetrics(config)
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self._results = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads = []
+    
+    @staticmethod
+    def is_enabled(config):
+        return config.get('pipeline', {}).get('enabled', False)
+    
+    def start(self):
+        """啟動分析執行緒"""
+        self._threads = [
+            threading.Thread(target=self._consume, name=f"analysis-{i}", daemon=True)
+            for i in range(self.worker_count)
+        ]
+        for thread in self._threads:
+            thread.start()
+        print(f"[INFO] 批改管線已啟動（{self.worker_count} 個分析執行緒，佇列上限 {self.queue_size}）")
+        return self
+    
+    def submit(self, job_result):
+        """送入一個已抓取圖片的工作；佇列已滿時阻塞直到有空位"""
+        with self._lock:
+            seq = self._seq
+            self._seq += 1
+        # 略過的、沒有圖片的工作不需分析，直接收集結果
+        if job_result.get('skipped') or not job_result['images']:
+            self._collect(seq, job_result)
+            return
+        
+        start = time.perf_counter()
+        while True:
+            if self._stop_event.is_set():
+                self.complete(job_result, [], error="pipeline stopped")
+                self._collect(seq, job_result)
+                return
+            try:
+                # 以逾時輪詢，讓主執行緒在阻塞時仍能收到KeyboardInterrupt
+                self.queue.put((seq, job_result), timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        waited = time.perf_counter() - start
+        if waited >= 0.01:
+            self.metrics.record_span("pipeline_backpressure", waited)
+        self.metrics.incr("pipeline_jobs")
+    
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._SENTINEL:
+                    return
+                seq, job_result = item
+                if self._stop_event.is_set():
+                    self.complete(job_result, [], error="pipeline stopped")
+                else:
+                    try:
+                        with self.metrics.span("pipeline_analysis"):
+                            results = self.analyze(job_result['images'])
+                        self.complete(job_result, results)
+                    except Exception as e:
+                        print(f"[ERROR] 分析第{job_result['question_number']}題／學生{job_result['student_index']}時發生錯誤: {e}")
+                        self.complete(job_result, [], error=repr(e))
+                self._collect(seq, job_result)
+            finally:
+                self.queue.task_done()
+    
+    def _collect(self, seq, job_result):
+        # 只保留圖片路徑，釋放記憶體中的圖片資料
+        job_result['images'] = [str(image) for image in job_result['images']]
+        with self._lock:
+            self._results.append((seq, job_result))
+    
+    def close(self):
+        """等待佇列中的工作分析完成並停止分析執行緒；等待時再次中斷則放棄尚未開始的工作"""
+        pending = self.queue.qsize()
+        if pending:
+            print(f"[INFO] 等待批改管線完成 {pending} 個待分析工作...")
+        try:
+            for _ in self._threads:
+                self.queue.put(self._SENTINEL)
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            print("\n[WARN] 收到中斷，放棄尚未開始分析的工作（進行中的分析會完成）")
+            self._stop_event.set()
+            for _ in self._threads:
+                self.queue.put(self._SENTINEL)
+            for thread in self._threads:
+                thread.join()
+    
+    def results(self):
+        """依送入順序排列的結果"""
+        with self._lock:
+            return [job_result for _, job_result in sorted(self._results, key=lambda item: item[0])]
+
+class GraderWorkerPool:
+    """多瀏覽器並行批改 - 每個worker擁有獨立的Chrome（除錯埠與設定檔），從共用佇列取得批改工作"""
+    
+    # 各worker使用的批改器類別（效能測試以替身類別取代）
+    grader_class = AutoGrader
+    
+    def __init__(self, config_file="config.json", worker_count=None):
+        self.config_file = config_file
+        self.config = AutoGrader.load_config(config_file)
+        self.worker_count = worker_count or self.config.get('grading', {}).get('workers', 1)
+        self.metrics = RunMetrics(self.config)
+        self.captcha_resolver = CaptchaResolver(self.config, self.metrics)
+        self.selectors = SelectorRegistry(self.config, self.metrics)
+        self.ledger = JobLedger(self.config)
+        # 所有worker共用一個分析引擎，限流與API連線對整個批次一體適用
+        self.analysis_engine = AsyncAnalysisEngine(self.config, self.metrics)
+        self.pipeline = None
+        # plan為真時由第一個登入的worker掃描教師首頁後規劃工作，對照表再分享給其他worker
+        self.plan = False
+        self.dashboard_index = None
+        self.jobs = queue.Queue()
+        self.results = []
+        self._results_lock = threading.Lock()
+        # 登入依序進行：第一個worker登入並儲存session後，其他worker可直接沿用
+        self._login_lock = threading.Lock()
+        self._stop_event = threading.Event()
+    
+    def add_job(self, question_number, school_index, student_index=0):
+        """加入一個批改工作"""
+        self.jobs.put((question_number, school_index, student_index))
+    
+    def _worker(self, worker_id, finished):
+        try:
+            self._run_worker(worker_id)
+        finally:
+            finished.set()
+    
+    def _run_worker(self, worker_id):
+        grader = self.grader_class(
+            self.config_file, worker_id=worker_id,
+            captcha_resolver=self.captcha_resolver, selectors=self.selectors, metrics=self.metrics,
+            ledger=self.ledger, analysis_engine=self.analysis_engine
+        )
+        try:
+            if not grader.setup_driver():
+                print(f"[ERROR] worker {worker_id} 無法設置瀏覽器驅動")
+                return
+            
+            with self._login_lock:
+                logged_in = grader.ensure_login()
+                if logged_in and self.plan and self.dashboard_index is None:
+                    for job in grader.plan_grading_jobs():
+                        self.add_job(*job)
+                    self.dashboard_index = grader.dashboard_index
+            if not logged_in:
+                print(f"[ERROR] worker {worker_id} 登入失敗")
+                return
+            if grader.dashboard_index is None:
+                grader.dashboard_index = self.dashboard_index
+            
+            while not self._stop_event.is_set():
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                job_results = []
+                try:
+                    for result in grader.iter_job(*job, analyze=self.pipeline is None):
+                        result['worker_id'] = worker_id
+                        if self.pipeline:
+                            # 只抓取圖片，分析交給共用的批改管線，瀏覽器立即處理下一位學生
+                            self.pipeline.submit(result)
+                        else:
+                            job_results.append(result)
+                        # 每位學生之後檢查中斷，整題批改時不必等所有學生完成
+                        if self._stop_event.is_set():
+                            break
+                except Exception as e:
+                    print(f"[ERROR] worker {worker_id} 處理工作 {job} 時發生錯誤: {e}")
+                    job_results.append({
+                        'question_number': job[0], 'school_index': job[1], 'student_index': job[2],
+                        'images': [], 'results': [], 'ok': False, 'worker_id': worker_id
+                    })
+                with self._results_lock:
+                    self.results.extend(job_results)
+        finally:
+            grader.close()
+    
+    @staticmethod
+    def _join(finished):
+        # 以逾時輪詢，讓主執行緒在等待時仍能收到KeyboardInterrupt；
+        # 等待worker自行設定的Event而非Thread.join，join被中斷後is_alive可能誤報已結束
+        for event in finished:
+            while not event.wait(timeout=0.5):
+                pass
+    
+    def run(self):
+        """啟動所有worker並等待工作完成，回傳依工作順序排列的結果
+        
+        中斷時每位學生之後停止並等待各worker結束，再按一次 Ctrl+C 則不再等待；兩種情況都會關閉管線並寫入帳本。
+        """
+        if self.plan:
+            print(f"[INFO] 啟動 {self.worker_count} 個瀏覽器worker，工作清單於第一個worker登入後依教師首頁規劃")
+        else:
+            print(f"[INFO] 啟動 {self.worker_count} 個瀏覽器worker，共 {self.jobs.qsize()} 個工作")
+        analyzer = None
+        if GradingPipeline.is_enabled(self.config):
+            # 分析用的批改器不啟動瀏覽器，只提供分析引擎與帳本寫入
+            analyzer = self.grader_class(
+                self.config_file, captcha_resolver=self.captcha_resolver, selectors=self.selectors,
+                metrics=self.metrics, ledger=self.ledger, analysis_engine=self.analysis_engine
+            )
+            self.pipeline = GradingPipeline(
+                self.config, analyzer.analyze_exam_images, analyzer.complete_job, self.metrics
+            ).start()
+        finished = [threading.Event() for _ in range(self.worker_count)]
+        workers = [
+            threading.Thread(target=self._worker, args=(worker_id, finished[worker_id]), daemon=True)
+            for worker_id in range(self.worker_count)
+        ]
+        for worker in workers:
+            worker.start()
+        
+        try:
+            try:
+                self._join(finished)
+            except KeyboardInterrupt:
+                print("\n[WARN] 收到中斷，等待各worker完成目前學生（再按一次 Ctrl+C 不再等待）...")
+                self._stop_event.set()
+                try:
+                    self._join(finished)
+                except KeyboardInterrupt:
+                    print("\n[WARN] 不再等待worker，未完成的工作下次執行時重試")
+        finally:
+            # 再次中斷或發生錯誤時也要停止管線並寫入帳本
+            try:
+                if self.pipeline:
+                    self.pipeline.close()
+                    self.results.extend(self.pipeline.results())
+                    analyzer.close()
+                if not self.jobs.empty():
+                    print(f"[WARN] 尚有 {self.jobs.qsize()} 個工作未完成")
+                self.selectors.print_report()
+                self.captcha_resolver.router.print_report()
+                self.captcha_resolver.close()
+                self.analysis_engine.router.print_report()
+                self.analysis_engine.close()
+                self.metrics.finish()
+            finally:
+                self.ledger.print_summary()
+                self.ledger.close()
+        return sorted(self.results, key=lambda r: (r['question_number'], r['school_index'], r['student_index'] or 0))
+
+def build_grading_jobs(config, dashboard_index=None):
+    """依 grading 設定產生 (題號, 學校索引, 學生索引) 工作清單
+    
+    Args:
+        dashboard_index (dict): AutoGrader.index_dashboard 的對照表，school_indexes 為 "all" 時用來列出各題所有學校
+    """
+    grading_config = config.get('grading', {})
+    students = grading_config.get('students', [0])
+    # "all" 表示批改該題所有學生（以None表示，交由 iter_student_exams 串流處理）
+    if students == "all":
+        students = [None]
+    school_indexes = grading_config.get('school_indexes', [0])
+    
+    def schools_for(question_number):
+        if school_indexes != "all":
+            return school_indexes
+        if not dashboard_index:
+            print("[WARN] school_indexes 為 \"all\" 但尚未掃描教師首頁，只批改學校0")
+            return [0]
+        return sorted(school for question, school in dashboard_index if question == question_number)
+    
+    return [
+        (question_number, school_index, student_index)
+        for question_number in grading_config.get('questions', [19])
+        for school_index in schools_for(question_number)
+        for student_index in students
+    ]
+
+def run_grading_jobs(grader, jobs):
+    """以已登入的批改器依序執行工作，回傳結果清單
+    
+    pipeline.enabled 時瀏覽器只負責抓取圖片，分析交給GradingPipeline的分析執行緒並行進行。
+    """
+    if not GradingPipeline.is_enabled(grader.config):
+        results = []
+        for job in jobs:
+            for job_result in grader.iter_job(*job):
+                # 只保留圖片路徑，串流批改整題時不在記憶體中累積圖片
+                job_result['images'] = [str(image) for image in job_result['images']]
+                results.append(job_result)
+        return results
+    
+    pipeline = GradingPipeline(
+        grader.config, grader.analyze_exam_images, grader.complete_job, grader.metrics
+    ).start()
+    try:
+        for job in jobs:
+            for job_result in grader.iter_job(*job, analyze=False):
+                pipeline.submit(job_result)
+    finally:
+        # 中斷時也等待已抓取的考卷分析完成（再次中斷則放棄）
+        pipeline.close()
+    return pipeline.results()
+
+def run_worker_pool(config_file="config.json"):
+    """以多個瀏覽器worker並行批改"""
+    pool = GraderWorkerPool(config_file)
+    pool.plan = True
+    
+    results = pool.run()
+    print("\n=== 批改結果 ===")
+    for result in results:
+        status = "[SUCCESS]" if result['ok'] else "[ERROR]"
+        print(f"{status} 第{result['question_number']}題／學校{result['school_index']}／學生{result['student_index']}: "
+              f"{len(result['images'])} 張圖片, 結果 {result['results']}")
+    return results
 
 def main():
     """主程序"""
     print("=== 自動化改考卷程式 v2.0 ===")
     print("支援自動驗證碼識別和考卷批改功能")
     
+    config = AutoGrader.load_config("config.json")
+    if config and config.get('grading', {}).get('workers', 1) > 1:
+        run_worker_pool("config.json")
+        return
+    
     grader = AutoGrader()
     
     if not grader.setup_driver():
         print("無法設置瀏覽器驅動")
+        grader.close()
+        if grader.ledger:
+            grader.ledger.close()
         return
     
     try:
         # 步驟1: 自動登入
-        if grader.auto_login():
+        if grader.ensure_login():
             print("[SUCCESS] 系統登入成功！")
             
-            # 步驟2: 導航到第19題
-            print("\n=== 開始批改考卷流程 ===")
-            if grader.navigate_to_question(question_number=19, school_index=0):
-                print("[SUCCESS] 已進入第19題頁面")
-                
-                # 步驟3: 獲取第一位學生的考卷
-                if grader.get_first_student_exam():
-                    print("[SUCCESS] 已進入第一位學生的考卷頁面")
-                    
-                    # 步驟4: 抓取考卷圖片
-                    exam_images = grader.capture_exam_images()
-                    if exam_images:
-                        print(f"[SUCCESS] 成功抓取 {len(exam_images)} 張考卷圖片")
-                        for i, image_path in enumerate(exam_images):
-                            print(f"  考卷圖片 {i+1}: {image_path}")
-                        
-                        # 步驟5: 使用圖片識別分析考卷內容（示例）
-                        print("\n=== 分析考卷內容 ===")
-                        for i, image_path in enumerate(exam_images[:2]):  # 只處理前兩張圖片
-                            print(f"[INFO] 正在分析第 {i+1} 張考卷圖片...")
-                            
-                            # 使用現有的驗證碼識別器來識別考卷內容
-                            # 這裡可以根據需要調整prompt
-                            result = grader.captcha_resolver.recognize_captcha(image_path)
-                            if result:
-                                print(f"[INFO] 第 {i+1} 張圖片識別結果: {result}")
-                            else:
-                                print(f"[WARN] 第 {i+1} 張圖片識別失敗")
-                    else:
-                        print("[ERROR] 無法抓取考卷圖片")
-                else:
-                    print("[ERROR] 無法進入學生考卷頁面")
-            else:
-                print("[ERROR] 無法進入第19題頁面")
+            # 步驟2~5: 依序處理每個批改工作（進入題目、開啟學生考卷、抓取圖片、分析）
+            run_grading_jobs(grader, grader.plan_grading_jobs())
             
             print("\n=== 批改流程完成 ===")
             input("按Enter鍵關閉程序...")
@@ -843,7 +4394,20 @@ def main():
         print("\n程序被用戶中斷")
     
     finally:
+        if grader.waits:
+            grader.waits.print_summary()
+        if grader.selectors:
+            grader.selectors.print_report()
+        if grader.captcha_resolver:
+            grader.captcha_resolver.router.print_report()
+        if grader.analysis_engine:
+            grader.analysis_engine.router.print_report()
+        if grader.metrics:
+            grader.metrics.finish()
         grader.close()
+        if grader.ledger:
+            grader.ledger.print_summary()
+            grader.ledger.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1 @@
+"""離線效能測試：替身批改網站、替身識別服務與端到端情境"""
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+效能測試用的替身識別服務
+以可設定的延遲、抖動、錯誤率與正確率模擬Claude CLI、OpenAI與Anthropic，
+不呼叫任何付費API。
+"""
+
+import time
+import random
+import asyncio
+import threading
+
+from auto_grader import CaptchaResolver, AsyncAnalysisEngine
+
+# 預設的服務特性（毫秒）
+DEFAULT_PROVIDER_PROFILES = {
+    'cli': {'latency_ms': 6000, 'jitter_ms': 1500, 'error_rate': 0.05, 'accuracy': 0.9},
+    'openai': {'latency_ms': 1200, 'jitter_ms': 400, 'error_rate': 0.02, 'accuracy': 0.95},
+    'anthropic': {'latency_ms': 2000, 'jitter_ms': 600, 'error_rate': 0.02, 'accuracy': 0.97},
+}
+
+
+class FakeProviderError(Exception):
+    """替身服務的暫時性錯誤（模擬HTTP 503）"""
+
+    status_code = 503
+
+
+class FakeProvider:
+    """單一替身服務：依設定延遲後回傳結果，或依錯誤率失敗"""
+
+    def __init__(self, name, latency_ms=1000, jitter_ms=0, error_rate=0.0, accuracy=1.0, seed=None):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.accuracy = accuracy
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_profile(cls, name, profile, seed=None):
+        return cls(name, seed=seed, **dict(DEFAULT_PROVIDER_PROFILES.get(name, {}), **(profile or {})))
+
+    def _draw(self):
+        """抽出本次呼叫的延遲（秒）與是否失敗、是否答錯"""
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+            failed = self._random.random() < self.error_rate
+            wrong = self._random.random() >= self.accuracy
+            if failed:
+                self.errors += 1
+        return delay, failed, wrong
+
+    def call(self, answer, cancel_event=None):
+        """同步呼叫：失敗時回傳None"""
+        delay, failed, wrong = self._draw()
+        if cancel_event is not None:
+            if cancel_event.wait(delay):
+                return None
+        else:
+            time.sleep(delay)
+        if failed or not answer:
+            return None
+        return self.corrupt(answer) if wrong else answer
+
+    async def call_async(self, answer):
+        """非同步呼叫：失敗時拋出FakeProviderError"""
+        delay, failed, wrong = self._draw()
+        await asyncio.sleep(delay)
+        if failed:
+            raise FakeProviderError(f"{self.name} 替身服務暫時無法使用")
+        return self.corrupt(answer) if wrong else answer
+
+    def corrupt(self, answer):
+        """產生錯誤答案（驗證碼答錯一碼）"""
+        position = self._random.randrange(len(answer))
+        replacement = str((int(answer[position]) + 1) % 10) if answer[position].isdigit() else 'X'
+        return answer[:position] + replacement + answer[position + 1:]
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors}
+
+
+class FakeCaptchaResolver(CaptchaResolver):
+    """以替身服務取代CLI與API的驗證碼解析器（答案來自替身網站）"""
+
+    def __init__(self, config, site, profiles=None, metrics=None, seed=None):
+        super().__init__(config, metrics)
+        profiles = profiles if profiles is not None else DEFAULT_PROVIDER_PROFILES
+        self.site = site
+        self.fakes = {
+            name: FakeProvider.from_profile(name, profiles[name], seed)
+            for name in ('cli', 'openai', 'anthropic') if name in profiles
+        }
+        # 本地識別器與真實客戶端不參與效能測試
+        self.local_recognizer = None
+        self.use_claude_cli = 'cli' in self.fakes
+        self.openai_client = self.fakes.get('openai')
+        self.anthropic_client = self.fakes.get('anthropic')
+
+    def recognize_captcha_with_cli(self, image, cancel_event=None):
+        return self.validate_captcha_text(self.fakes['cli'].call(self.site.peek_captcha(), cancel_event))
+
+    def recognize_captcha_with_openai(self, image):
+        return self.validate_captcha_text(self.fakes['openai'].call(self.site.peek_captcha()))
+
+    def recognize_captcha_with_anthropic(self, image):
+        return self.validate_captcha_text(self.fakes['anthropic'].call(self.site.peek_captcha()))
+
+    def confirm_captcha(self, image, text):
+        pass
+
+
+class FakeClient:
+    """替身非同步客戶端（只需支援close）"""
+
+    async def close(self):
+        pass
+
+
+class FakeAnalysisEngine(AsyncAnalysisEngine):
+    """以替身服務取代OpenAI/Anthropic的非同步分析引擎"""
+
+    TRANSCRIPT = "學生作答：x = 3，答案正確"
+
+    def __init__(self, config, profiles=None, metrics=None, seed=None):
+        super().__init__(config, metrics)
+        profiles = profiles if profiles is not None else DEFAULT_PROVIDER_PROFILES
+        self.fakes = {
+            name: FakeProvider.from_profile(name, profiles[name], seed)
+            for name in ('openai', 'anthropic') if name in profiles
+        }
+        preferred = config.get('api', {}).get('preferred_provider', 'openai')
+        order = [preferred] + [name for name in ('openai', 'anthropic') if name != preferred]
+        self.providers = [name for name in order if name in self.fakes]
+
+    def create_clients(self):
+        return {name: FakeClient() for name in self.providers}
+
+    async def _call_openai(self, client, payload):
+        return await self.fakes['openai'].call_async(self.TRANSCRIPT)
+
+    async def _call_anthropic(self, client, payload):
+        return await self.fakes['anthropic'].call_async(self.TRANSCRIPT)
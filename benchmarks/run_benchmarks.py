@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+離線效能測試 - 以替身網站與替身識別服務量測端到端的每分鐘批改學生數
+
+用法（在專案根目錄執行）:
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --scenario streaming --students 50 --latency-ms 150
+    python -m benchmarks.run_benchmarks --list
+
+每個情境會啟動新的替身網站與乾淨的暫存目錄（登入狀態、選擇器快取、驗證碼圖片），
+結果輸出為表格並寫入 benchmarks/results/<時間>.json，方便比較效能改動前後的差異。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auto_grader import AutoGrader, GraderWorkerPool, RunMetrics, run_grading_jobs
+from benchmarks.standin_site import StandInSite
+from benchmarks.fake_providers import FakeCaptchaResolver, FakeAnalysisEngine, DEFAULT_PROVIDER_PROFILES
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# 效能測試情境：mode 為 per_job（每位學生從首頁重新進入）、streaming（串流整題）或 pool（多瀏覽器）；
+# pipeline 表示是否以批改管線讓瀏覽與分析重疊
+SCENARIOS = {
+    'per_job': {
+        'description': "單一瀏覽器，每位學生一個工作（從首頁重新進入題目）",
+        'mode': 'per_job',
+        'workers': 1,
+        'pipeline': False,
+    },
+    'streaming': {
+        'description': "單一瀏覽器，串流批改整題所有學生",
+        'mode': 'streaming',
+        'workers': 1,
+        'pipeline': False,
+    },
+    'pipeline': {
+        'description': "單一瀏覽器串流批改，瀏覽與分析以批改管線重疊",
+        'mode': 'streaming',
+        'workers': 1,
+        'pipeline': True,
+    },
+    'pool': {
+        'description': "多瀏覽器worker並行，每位學生一個工作",
+        'mode': 'pool',
+        'workers': 3,
+    },
+    'flaky_providers': {
+        'description': "串流批改，識別服務高錯誤率與高延遲",
+        'mode': 'streaming',
+        'workers': 1,
+        'providers': {
+            'cli': {'latency_ms': 8000, 'error_rate': 0.3, 'accuracy': 0.7},
+            'openai': {'latency_ms': 2500, 'error_rate': 0.2},
+            'anthropic': {'latency_ms': 3500, 'error_rate': 0.2},
+        },
+    },
+}
+
+
+def build_config(base_config, site, workspace, scenario, args):
+    """以專案設定為基礎，將網址、暫存路徑與批改範圍指向替身網站"""
+    config = json.loads(json.dumps(base_config))
+    config['login']['url'] = site.login_url
+    config['browser'] = dict(config.get('browser', {}), profile='performance',
+                             user_data_dir=os.path.join(workspace, "chrome_user_data"),
+                             debug_port=args.debug_port)
+    config['browser'].setdefault('performance', {})['headless'] = not args.headed
+    config['session'] = dict(config.get('session', {}), enabled=not args.no_session,
+                             path=os.path.join(workspace, "session", "session.json"))
+    config['selectors'] = dict(config.get('selectors', {}), cache_path=os.path.join(workspace, "selectors.json"))
+    config['recognition_cache'] = dict(config.get('recognition_cache', {}),
+                                       path=os.path.join(workspace, "recognitions.sqlite3"))
+    config['ledger'] = dict(config.get('ledger', {}), path=os.path.join(workspace, "ledger.sqlite3"))
+    config['metrics'] = dict(config.get('metrics', {}), enabled=True, output_dir=os.path.join(workspace, "metrics"))
+    config['images'] = dict(config.get('images', {}), save_to_disk=False)
+    config['captcha'] = dict(config.get('captcha', {}), save_path=os.path.join(workspace, "captcha_images"))
+    config['captcha']['local'] = dict(config['captcha'].get('local', {}), enabled=False)
+    # 替身解析器自行模擬CLI，不啟動真正的Claude CLI程序
+    config['captcha']['use_claude_cli'] = False
+    config['pipeline'] = dict(config.get('pipeline', {}), enabled=scenario.get('pipeline', True))
+    config['grading'] = {
+        'workers': scenario['workers'],
+        'questions': [site.questions[0]],
+        'school_indexes': [0],
+        'students': "all" if scenario['mode'] == 'streaming' else list(range(site.students)),
+    }
+    return config
+
+
+class BenchGrader(AutoGrader):
+    """使用替身識別服務的批改器"""
+
+    site = None
+    providers = None
+    seed = None
+
+    def __init__(self, config_file="config.json", worker_id=None, captcha_resolver=None, selectors=None, metrics=None,
+                 ledger=None, analysis_engine=None):
+        super().__init__(config_file, worker_id, captcha_resolver, selectors, metrics, ledger, analysis_engine)
+        if captcha_resolver is None:
+            self.captcha_resolver.close()
+            self.captcha_resolver = FakeCaptchaResolver(self.config, self.site, self.providers, self.metrics, self.seed)
+        if analysis_engine is None:
+            self.analysis_engine.close()
+            self.analysis_engine = FakeAnalysisEngine(self.config, self.providers, self.metrics, self.seed)
+
+
+def run_single(config_file, scenario):
+    """單一瀏覽器：登入後依工作清單批改，回傳 (結果清單, 指標)"""
+    grader = BenchGrader(config_file)
+    results = []
+    try:
+        if not grader.setup_driver():
+            raise RuntimeError("無法設置瀏覽器驅動")
+        if not grader.ensure_login():
+            raise RuntimeError("登入替身網站失敗")
+        grading_config = grader.config['grading']
+        question_number = grading_config['questions'][0]
+        school_index = grading_config['school_indexes'][0]
+        students = [None] if scenario['mode'] == 'streaming' else grading_config['students']
+        results = run_grading_jobs(grader, [(question_number, school_index, student) for student in students])
+    finally:
+        grader.close()
+        grader.ledger.close()
+    grader.metrics.print_summary()
+    return results, grader.metrics
+
+
+def run_pool(config_file, scenario):
+    """多瀏覽器worker並行批改，回傳 (結果清單, 指標)"""
+    pool = GraderWorkerPool(config_file, scenario['workers'])
+    pool.grader_class = BenchGrader
+    pool.captcha_resolver.close()
+    pool.captcha_resolver = FakeCaptchaResolver(pool.config, BenchGrader.site, BenchGrader.providers,
+                                                pool.metrics, BenchGrader.seed)
+    pool.analysis_engine.close()
+    pool.analysis_engine = FakeAnalysisEngine(pool.config, BenchGrader.providers, pool.metrics, BenchGrader.seed)
+    config = pool.config
+    for student_index in config['grading']['students']:
+        pool.add_job(config['grading']['questions'][0], config['grading']['school_indexes'][0], student_index)
+    return pool.run(), pool.metrics
+
+
+def run_scenario(name, scenario, base_config, args):
+    """執行單一情境，回傳量測結果"""
+    print(f"\n##### 情境 {name}: {scenario['description']} #####")
+    random.seed(args.seed)
+    providers = json.loads(json.dumps(DEFAULT_PROVIDER_PROFILES))
+    for provider, overrides in scenario.get('providers', {}).items():
+        providers.setdefault(provider, {}).update(overrides)
+    if args.provider_latency_scale != 1.0:
+        for profile in providers.values():
+            profile['latency_ms'] = profile['latency_ms'] * args.provider_latency_scale
+            profile['jitter_ms'] = profile.get('jitter_ms', 0) * args.provider_latency_scale
+
+    # per_job／pool 以列表順序指定學生，因此將所有學生放在同一頁
+    per_page = args.per_page if scenario['mode'] == 'streaming' else args.students
+    site = StandInSite(students=args.students, per_page=per_page, images_per_student=args.images,
+                       latency_ms=args.latency_ms, image_latency_ms=args.image_latency_ms)
+    with site, tempfile.TemporaryDirectory(prefix="grader_bench_") as workspace:
+        config = build_config(base_config, site, workspace, scenario, args)
+        config_file = os.path.join(workspace, "config.json")
+        with open(config_file, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+
+        BenchGrader.site = site
+        BenchGrader.providers = providers
+        BenchGrader.seed = args.seed
+        start = time.perf_counter()
+        error = None
+        try:
+            if scenario['mode'] == 'pool':
+                results, metrics = run_pool(config_file, scenario)
+            else:
+                results, metrics = run_single(config_file, scenario)
+        except Exception as e:
+            error = str(e)
+            results, metrics = [], RunMetrics(config)
+        elapsed = time.perf_counter() - start
+
+    graded = sum(1 for result in results if result.get('ok'))
+    return {
+        'scenario': name,
+        'description': scenario['description'],
+        'mode': scenario['mode'],
+        'workers': scenario['workers'],
+        'students': args.students,
+        'graded': graded,
+        'elapsed_seconds': round(elapsed, 3),
+        'students_per_minute': round(graded / elapsed * 60, 2) if elapsed and graded else 0.0,
+        'site': dict(site.stats),
+        'stages': metrics.summary(),
+        'counters': dict(metrics.counters),
+        'error': error,
+    }
+
+
+def print_report(reports):
+    print("\n=== 效能測試結果 ===")
+    print(f"  {'情境':<18}{'worker':>7}{'完成/總數':>11}{'秒數':>10}{'學生/分鐘':>12}  備註")
+    for report in reports:
+        note = report['error'] or f"登入失敗 {report['site']['failed_logins']} 次"
+        print(f"  {report['scenario']:<18}{report['workers']:>7}{report['graded']:>6}/{report['students']:<4}"
+              f"{report['elapsed_seconds']:>10.1f}{report['students_per_minute']:>12.2f}  {note}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以替身網站與替身識別服務進行離線效能測試")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="要執行的情境（可重複，預設全部）")
+    parser.add_argument('--list', action='store_true', help="列出所有情境")
+    parser.add_argument('--config', default="config.json", help="作為基礎的專案設定檔")
+    parser.add_argument('--students', type=int, default=20, help="每題學生數")
+    parser.add_argument('--per-page', type=int, default=10, help="學生列表每頁人數")
+    parser.add_argument('--images', type=int, default=2, help="每位學生的考卷圖片數")
+    parser.add_argument('--latency-ms', type=int, default=50, help="替身網站頁面延遲")
+    parser.add_argument('--image-latency-ms', type=int, default=100, help="替身網站圖片延遲")
+    parser.add_argument('--provider-latency-scale', type=float, default=1.0, help="替身識別服務延遲倍率")
+    parser.add_argument('--seed', type=int, default=1234, help="亂數種子")
+    parser.add_argument('--debug-port', type=int, default=9333, help="Chrome除錯埠（pool模式每個worker遞增）")
+    parser.add_argument('--no-session', action='store_true', help="不沿用登入狀態（每個worker都重新登入）")
+    parser.add_argument('--headed', action='store_true', help="顯示瀏覽器視窗")
+    parser.add_argument('--output', help="結果JSON路徑（預設 benchmarks/results/<時間>.json）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:<18}{scenario['description']}")
+        return
+
+    base_config = AutoGrader.load_config(args.config)
+    if not base_config:
+        return
+    # 替身網站接受任何帳號密碼
+    os.environ.setdefault('LOGIN_USERNAME', 'bench')
+    os.environ.setdefault('LOGIN_PASSWORD', 'bench')
+
+    reports = [run_scenario(name, SCENARIOS[name], base_config, args) for name in (args.scenario or SCENARIOS)]
+    print_report(reports)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(reports, f, ensure_ascii=False, indent=2)
+    print(f"\n[INFO] 結果已寫入: {output}")
+
+
+if __name__ == "__main__":
+    main()
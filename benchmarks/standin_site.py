@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+效能測試用的替身批改網站（本機HTTP伺服器）
+模擬登入模態框（UID/PWD/NewCode欄位與NewCode.php驗證碼）、教師首頁的題目卡片、
+分頁的學生列表與考卷圖片頁面，並可設定每個請求的延遲，讓效能測試不需連線到正式網站。
+"""
+
+import io
+import time
+import random
+import string
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from PIL import Image, ImageDraw
+
+SESSION_COOKIE = "BENCHSESSID"
+
+
+class StandInSite:
+    """替身網站 - 在背景執行緒中提供HTTP服務
+
+    驗證碼：每次請求NewCode.php產生新的4碼驗證碼，登入時只要送出任一尚未使用的驗證碼即可，
+    替身識別器可透過 peek_captcha() 取得最新的答案（依設定的正確率決定是否答對）。
+    """
+
+    def __init__(self, questions=(19, 20), schools=3, students=30, per_page=10, images_per_student=2,
+                 latency_ms=0, image_latency_ms=0, host="127.0.0.1", port=0):
+        self.questions = list(questions)
+        self.schools = schools
+        self.students = students
+        self.per_page = per_page
+        self.images_per_student = images_per_student
+        self.latency_ms = latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.sessions = set()
+        self.captchas = []
+        self.stats = {'requests': 0, 'logins': 0, 'failed_logins': 0, 'captchas': 0, 'images': 0}
+        self._image_cache = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def login_url(self):
+        return self.base_url + "?c=signOut"
+
+    def start(self):
+        """在背景執行緒啟動伺服器"""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        print(f"[INFO] 替身網站已啟動: {self.base_url}")
+        return self
+
+    def stop(self):
+        """停止伺服器"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # ---- 驗證碼 ----
+
+    def issue_captcha(self):
+        """產生新的驗證碼，回傳 (答案, PNG位元組)"""
+        text = ''.join(random.choice(string.digits) for _ in range(4))
+        with self._lock:
+            self.captchas.append(text)
+            del self.captchas[:-50]
+            self.stats['captchas'] += 1
+        image = Image.new("RGB", (100, 40), "white")
+        draw = ImageDraw.Draw(image)
+        for _ in range(8):
+            draw.line([(random.randint(0, 100), random.randint(0, 40)),
+                       (random.randint(0, 100), random.randint(0, 40))], fill=(200, 200, 200))
+        for i, char in enumerate(text):
+            draw.text((12 + i * 20, 12 + random.randint(-3, 3)), char, fill="black")
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return text, buffer.getvalue()
+
+    def peek_captcha(self):
+        """最新一張驗證碼的答案（供替身識別器使用）"""
+        with self._lock:
+            return self.captchas[-1] if self.captchas else None
+
+    def consume_captcha(self, text):
+        with self._lock:
+            if text in self.captchas:
+                self.captchas.remove(text)
+                return True
+            return False
+
+    # ---- 頁面 ----
+
+    def exam_image(self, question, school, student_id, number):
+        """產生（並快取）考卷圖片"""
+        key = (question, school, student_id, number)
+        with self._lock:
+            cached = self._image_cache.get(key)
+        if cached:
+            return cached
+        image = Image.new("RGB", (800, 500), "white")
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([10, 10, 790, 490], outline="black")
+        draw.text((30, 30), f"Q{question} school {school} student {student_id} page {number + 1}", fill="black")
+        for row in range(8):
+            draw.line([(30, 90 + row * 45), (770, 90 + row * 45)], fill=(180, 180, 180))
+        draw.text((40, 110), f"x = {(question * 7 + int(student_id[1:])) % 17}", fill="blue")
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        data = buffer.getvalue()
+        with self._lock:
+            self._image_cache[key] = data
+        return data
+
+    def student_ids(self):
+        return [f"S{number:03d}" for number in range(1, self.students + 1)]
+
+    @staticmethod
+    def page(title, body):
+        return (
+            "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+            f"<title>{title}</title></head><body>{body}</body></html>"
+        )
+
+    def login_page(self, error=False):
+        alert = "<div class='alert'>驗證碼錯誤</div>" if error else ""
+        return self.page("登入", f"""
+            <div id="sys_signin" class="modal" style="display:block">
+              <form method="post" action="/?c=login">
+                {alert}
+                <input id="UID" name="UID" type="text">
+                <input id="PWD" name="PWD" type="password">
+                <img src="/NewCode.php" width="100" height="40">
+                <input id="NewCode" name="NewCode" type="text">
+                <button type="submit" class="btn btn-primary">登入</button>
+              </form>
+            </div>
+        """)
+
+    def dashboard_page(self):
+        cards = []
+        for school in range(self.schools):
+            for question in self.questions:
+                href = "/?" + urlencode({'c': 'students', 'q': question, 'school': school, 'page': 0})
+                cards.append(
+                    f"<div class='card'><div class='card-body'>"
+                    f"<div style='cursor:pointer' onclick=\"location.href='{href}'\">第{question}題</div>"
+                    f"<small>學校 {school}</small></div></div>"
+                )
+        return self.page("teacher", "<div class='list'>" + "".join(cards) + "</div>")
+
+    def student_list_page(self, question, school, page):
+        ids = self.student_ids()
+        start = page * self.per_page
+        rows = ["<tr><th>學號</th><th>姓名</th><th>操作</th></tr>"]
+        for student_id in ids[start:start + self.per_page]:
+            href = "/?" + urlencode({'c': 'exam', 'q': question, 'school': school, 'student_id': student_id})
+            rows.append(f"<tr><td>{student_id}</td><td>學生{student_id}</td><td><a href='{href}'>批改</a></td></tr>")
+        has_next = start + self.per_page < len(ids)
+        next_href = "/?" + urlencode({'c': 'students', 'q': question, 'school': school, 'page': page + 1})
+        pagination = (
+            f"<ul class='pagination'><li class='next{'' if has_next else ' disabled'}'>"
+            f"<a href='{next_href if has_next else '#'}'>下一頁</a></li></ul>"
+        )
+        return self.page(f"第{question}題", "<table>" + "".join(rows) + "</table>" + pagination)
+
+    def exam_page(self, question, school, student_id):
+        images = "".join(
+            "<img src='/exam_image.php?" + urlencode({'q': question, 'school': school, 'student_id': student_id, 'n': n})
+            + "' alt='考卷' width='800' height='500'>"
+            for n in range(self.images_per_student)
+        )
+        return self.page(f"考卷 {student_id}", f"<div class='exam-content'>{images}</div>")
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _session(self):
+                for part in (self.headers.get('Cookie') or '').split(';'):
+                    name, _, value = part.strip().partition('=')
+                    if name == SESSION_COOKIE:
+                        return value
+                return None
+
+            def _logged_in(self):
+                with site._lock:
+                    return self._session() in site.sessions
+
+            def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-store")
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _redirect(self, location, headers=None):
+                self._send(302, headers=dict(headers or {}, Location=location))
+
+            def _delay(self, milliseconds):
+                with site._lock:
+                    site.stats['requests'] += 1
+                if milliseconds:
+                    time.sleep(milliseconds / 1000.0)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+
+                if parsed.path == "/NewCode.php":
+                    self._delay(site.image_latency_ms)
+                    _, data = site.issue_captcha()
+                    return self._send(200, data, "image/png")
+
+                if parsed.path == "/exam_image.php":
+                    self._delay(site.image_latency_ms)
+                    if not self._logged_in():
+                        return self._send(403, "forbidden")
+                    with site._lock:
+                        site.stats['images'] += 1
+                    data = site.exam_image(int(params['q']), int(params['school']), params['student_id'], int(params['n']))
+                    return self._send(200, data, "image/png")
+
+                self._delay(site.latency_ms)
+                if parsed.path != "/":
+                    return self._send(404, "not found")
+
+                page = params.get('c')
+                if page == 'signOut':
+                    return self._send(200, site.login_page(error='error' in params))
+                if not self._logged_in():
+                    return self._redirect("/?c=signOut")
+                if page in (None, 'teacher'):
+                    if page is None:
+                        return self._redirect("/?c=teacher")
+                    return self._send(200, site.dashboard_page())
+                if page == 'students':
+                    return self._send(200, site.student_list_page(int(params['q']), int(params['school']), int(params.get('page', 0))))
+                if page == 'exam':
+                    return self._send(200, site.exam_page(int(params['q']), int(params['school']), params['student_id']))
+                return self._send(404, "not found")
+
+            def do_POST(self):
+                self._delay(site.latency_ms)
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+                if urlparse(self.path).query != "c=login":
+                    return self._send(404, "not found")
+
+                if form.get('UID') and form.get('PWD') and site.consume_captcha(form.get('NewCode', '')):
+                    token = secrets.token_hex(16)
+                    with site._lock:
+                        site.sessions.add(token)
+                        site.stats['logins'] += 1
+                    return self._redirect("/?c=teacher", {'Set-Cookie': f"{SESSION_COOKIE}={token}; Path=/"})
+                with site._lock:
+                    site.stats['failed_logins'] += 1
+                return self._redirect("/?c=signOut&error=1")
+
+        return Handler